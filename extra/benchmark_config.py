@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# Measures the time it takes to load the configuration of many cameras, with the parsed config files
+# cached (the files are parsed again only when they change on disk) and with every file parsed each time.
+#
+# usage: python extra/benchmark_config.py [-n ITERATIONS] [--cameras COUNT]
+
+import argparse
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'motioneye'))
+
+import settings
+
+
+def make_config(conf_path, count):
+    import config
+
+    main_config = {'thread': []}
+    for camera_id in xrange(1, count + 1):
+        camera_config = {
+            'videodevice': '/dev/video%s' % camera_id,
+            '@name': 'Camera%s' % camera_id,
+            '@enabled': True,
+            'target_dir': os.path.join(conf_path, 'media%s' % camera_id)
+        }
+
+        config._set_default_motion_camera(camera_id, camera_config)
+        name = config._CAMERA_CONFIG_FILE_NAME % {'id': camera_id}
+        with open(os.path.join(conf_path, name), 'w') as f:
+            f.writelines([l + '\n' for l in config._dict_to_conf([], camera_config)])
+
+        main_config['thread'].append(name)
+
+    config._set_default_motion(main_config, old_config_format=False)
+    with open(os.path.join(conf_path, 'motion.conf'), 'w') as f:
+        f.writelines([l + '\n' for l in config._dict_to_conf([], main_config, list_names=['thread'])])
+
+
+def measure(iterations, parse):
+    import config
+
+    start = time.time()
+    for i in xrange(iterations):  # @UnusedVariable
+        config.invalidate()
+        if parse:
+            config._config_file_cache.clear()
+
+        for camera_id in config.get_camera_ids(filter_valid=True):
+            config.get_camera(camera_id)
+
+        config.get_main()
+
+    return (time.time() - start) / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='config loading benchmark')
+    parser.add_argument('-n', dest='iterations', type=int, default=20, help='loads per measurement')
+    parser.add_argument('--cameras', type=int, default=64, help='number of cameras')
+    options = parser.parse_args()
+
+    conf_path = tempfile.mkdtemp()
+    settings.CONF_PATH = conf_path
+
+    import config
+    import mediafiles
+    import motionctl
+
+    # the motion and ffmpeg lookups are cached after the first call on an installed system
+    motionctl._motion_binary_cache = ('motion', '4.1.1')
+    motionctl.has_old_config_format = lambda: False
+    mediafiles._ffmpeg_binary_cache = ('ffmpeg', '3.2', {})
+
+    try:
+        make_config(conf_path, options.cameras)
+        config.get_main()  # fills the cache of parsed files
+
+        print '%s cameras, average of %s iterations of invalidate() and loading all configs' % (
+                options.cameras, options.iterations)
+        print 'parsing every file: %.1f ms' % measure(options.iterations, parse=True)
+        print 'cached parsed files: %.1f ms' % measure(options.iterations, parse=False)
+
+    finally:
+        shutil.rmtree(conf_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# Measures the MJPEG stream parsing throughput, either of the parser alone, fed with reads of the size
+# used by the mjpg client, or of the whole mjpg client, connected to a local server that pushes frames
+# as fast as possible.
+#
+# usage: python extra/benchmark_mjpg.py [--mode parser|client] [--frame-size BYTES] [--frames COUNT]
+#                                       [--no-content-length]
+
+import argparse
+import multiprocessing
+import os
+import os.path
+import resource
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'motioneye'))
+
+import mjpgclient
+
+
+_BOUNDARY = 'BoundaryString'
+
+
+def make_part(frame, content_length):
+    headers = '--%s\r\nContent-Type: image/jpeg\r\n' % _BOUNDARY
+    if content_length:
+        headers += 'Content-Length: %s\r\n' % len(frame)
+
+    return headers + '\r\n' + frame + '\r\n'
+
+
+def get_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    return usage.ru_utime + usage.ru_stime
+
+
+def bench_parser(frame, count, content_length):
+    part = make_part(frame, content_length)
+    data = part * count + '--%s\r\n' % _BOUNDARY
+    read_size = mjpgclient.MjpgClient._READ_SIZE
+
+    parser = mjpgclient.MjpgParser(_BOUNDARY)
+    received = 0
+
+    start_time, start_cpu = time.time(), get_cpu_time()
+    for offset in xrange(0, len(data), read_size):
+        received += len(parser.feed(data[offset:offset + read_size]))
+
+    return received, time.time() - start_time, get_cpu_time() - start_cpu
+
+
+def serve(sock, frame, count, content_length):
+    conn, addr = sock.accept()  # @UnusedVariable
+    conn.recv(4096)
+    conn.sendall('HTTP/1.0 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=%s\r\n\r\n' % _BOUNDARY)
+
+    part = make_part(frame, content_length)
+    batch = 50
+    for i in xrange(0, count + batch, batch):  # a few extra frames, as the last one is only seen with the next part
+        conn.sendall(part * batch)
+
+    conn.close()
+
+
+def bench_client(frame, count, content_length):
+    from tornado.ioloop import IOLoop
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+
+    server = multiprocessing.Process(target=serve, args=(sock, frame, count, content_length))
+    server.start()
+
+    io_loop = IOLoop.instance()
+    received = [0]
+
+    def on_frame(jpg):
+        received[0] += 1
+        if received[0] == count:
+            io_loop.stop()
+
+    mjpgclient.subscribe(1, on_frame)
+    client = mjpgclient.MjpgClient(1, sock.getsockname()[1], None, None, None)
+
+    start_time, start_cpu = time.time(), get_cpu_time()
+    client.do_connect()
+    io_loop.add_timeout(start_time + 60, io_loop.stop)
+    io_loop.start()
+    duration, cpu = time.time() - start_time, get_cpu_time() - start_cpu
+
+    server.terminate()
+
+    return received[0], duration, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description='mjpeg stream parsing benchmark')
+    parser.add_argument('--mode', choices=['parser', 'client'], default='parser')
+    parser.add_argument('--frame-size', type=int, default=50 * 1024, help='size of each frame, in bytes')
+    parser.add_argument('--frames', type=int, default=10000, help='number of frames')
+    parser.add_argument('--no-content-length', action='store_true', help='delimit frames by boundaries only')
+    options = parser.parse_args()
+
+    frame = os.urandom(options.frame_size)
+    content_length = not options.no_content_length
+
+    if options.mode == 'parser':
+        received, duration, cpu = bench_parser(frame, options.frames, content_length)
+
+    else:
+        received, duration, cpu = bench_client(frame, options.frames, content_length)
+
+    print '%s: %s frames of %s bytes, %s content length' % (options.mode, received, options.frame_size,
+                                                            'with' if content_length else 'without')
+    print '%.0f frames/s, %.1f us CPU/frame' % (received / duration, cpu / max(received, 1) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# Measures the time it takes to resize JPEG pictures on the server side (as done for the live previews
+# and the media previews), for several values of the resize_draft_factor setting.
+#
+# usage: python extra/benchmark_resize.py [-n ITERATIONS] [--width W] [--height H] [--factors 0,1,2,4]
+
+import argparse
+import os.path
+import StringIO
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'motioneye'))
+
+from PIL import Image
+
+import mediafiles
+import settings
+
+
+_SOURCE_SIZES = [(1280, 720), (1920, 1080), (3840, 2160)]
+
+
+def make_jpeg(width, height):
+    # noise on top of gradients, so that the picture does not compress unrealistically well
+    noise = Image.effect_noise((width, height), 64)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    image = Image.merge('RGB', (noise, gradient, gradient.transpose(Image.ROTATE_180)))
+
+    sio = StringIO.StringIO()
+    image.save(sio, format='JPEG', quality=85)
+
+    return sio.getvalue()
+
+
+def measure(jpg, width, height, factor, iterations):
+    settings.RESIZE_DRAFT_FACTOR = factor
+    mediafiles.resize_picture(jpg, width, height)  # warm up
+
+    start = time.time()
+    for i in xrange(iterations):  # @UnusedVariable
+        mediafiles.resize_picture(jpg, width, height)
+
+    return (time.time() - start) / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='server-side JPEG resize benchmark')
+    parser.add_argument('-n', dest='iterations', type=int, default=10, help='resizes per measurement')
+    parser.add_argument('--width', type=int, default=320, help='requested width')
+    parser.add_argument('--height', type=int, default=180, help='requested height')
+    parser.add_argument('--factors', default='0,1,2,4', help='comma separated resize_draft_factor values')
+    options = parser.parse_args()
+
+    factors = [int(f) for f in options.factors.split(',')]
+
+    print 'resizing to %sx%s, average of %s iterations (ms)' % (options.width, options.height, options.iterations)
+    print '%-12s' % 'source' + ''.join('%12s' % ('factor %s' % f) for f in factors)
+
+    for width, height in _SOURCE_SIZES:
+        jpg = make_jpeg(width, height)
+        times = [measure(jpg, options.width, options.height, f, options.iterations) for f in factors]
+
+        print '%-12s' % ('%sx%s' % (width, height)) + ''.join('%12.1f' % t for t in times)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,14 +20,24 @@ import logging
 import multiprocessing
 import os
 import signal
+import time
 
 from tornado.ioloop import IOLoop
 
+import config
 import mediafiles
+import mediaindex
+import metrics
 import settings
+import tasks
+import utils
 
 
+_CONTINUE_DELAY = 60  # seconds before continuing a cleanup pass that ran out of its time slice
+_QUOTA_PENDING_TIMEOUT = 300  # seconds after which a storage quota task that didn't report back is forgotten
+
 _process = None
+_quota_pending = {}  # start time of the storage quota tasks, indexed by camera id
 
 
 def start():
@@ -60,32 +70,100 @@ def running():
     return _process is not None and _process.is_alive()
 
 
-def _run_process():
+def check_quota(camera_config):
+    # called whenever a media file is saved; the cheap checks are done here,
+    # while the files are removed by a background task
+
+    camera_id = camera_config['@id']
+    exceeded = False
+
+    max_storage = camera_config.get('@max_storage')
+    if max_storage:
+        total = mediaindex.get_total_size(camera_config)
+        exceeded = total is not None and total > max_storage * 1024 * 1024 * 1024
+
+    if not exceeded and settings.MIN_FREE_SPACE:
+        usage = utils.get_disk_usage(camera_config['target_dir'])
+        if usage:
+            (used_size, total_size) = usage
+            exceeded = (total_size - used_size) * 100.0 < total_size * settings.MIN_FREE_SPACE
+
+    if not exceeded:
+        return
+
+    now = time.time()
+    if now - _quota_pending.get(camera_id, 0) < _QUOTA_PENDING_TIMEOUT:
+        return  # already being enforced
+
+    _quota_pending[camera_id] = now
+
+    volume_camera_configs = []
+    if settings.MIN_FREE_SPACE:
+        volume_camera_configs = mediafiles.get_volume_camera_configs(camera_config)
+
+    def on_done(removed):
+        _quota_pending.pop(camera_id, None)
+
+    tasks.add(0, mediafiles.enforce_storage_quota, tag='enforce_storage_quota(%s)' % camera_id,
+              callback=on_done, priority=tasks.PRIORITY_HIGH,
+              camera_config=camera_config, volume_camera_configs=volume_camera_configs)
+
+
+def _run_process(periodic=True):
     global _process
     
     io_loop = IOLoop.instance()
     
     # schedule the next call
-    io_loop.add_timeout(datetime.timedelta(seconds=settings.CLEANUP_INTERVAL), _run_process)
+    if periodic:
+        io_loop.add_timeout(datetime.timedelta(seconds=settings.CLEANUP_INTERVAL), _run_process)
 
     if not running():  # check that the previous process has finished
         logging.debug('running cleanup process...')
 
-        _process = multiprocessing.Process(target=_do_cleanup)
+        incomplete = multiprocessing.Value('b', 0)
+        _process = multiprocessing.Process(target=_do_cleanup, args=(incomplete,))
         _process.start()
+        _watch_process(_process, incomplete, time.time())
+
+
+def _watch_process(process, incomplete, started):
+    # polls the cleanup process, to measure its running time
+    io_loop = IOLoop.instance()
+    if process.is_alive():
+        io_loop.add_timeout(datetime.timedelta(seconds=1), _watch_process, process, incomplete, started)
 
+    else:
+        logging.debug('cleanup process finished in %.1f seconds' % (time.time() - started))
+        metrics.observe('cleanup_seconds', time.time() - started)
 
-def _do_cleanup():
+        if incomplete.value:
+            logging.debug('cleanup process ran out of its time slice, continuing in %s seconds' % _CONTINUE_DELAY)
+            io_loop.add_timeout(datetime.timedelta(seconds=_CONTINUE_DELAY), _run_process, False)
+
+
+def _do_cleanup(incomplete):
     # this will be executed in a separate subprocess
     
     # ignore the terminate and interrupt signals in this subprocess
     signal.signal(signal.SIGINT, signal.SIG_IGN)
     signal.signal(signal.SIGTERM, signal.SIG_IGN)
     
+    deadline = None
+    if settings.CLEANUP_TIME_SLICE:
+        deadline = time.time() + settings.CLEANUP_TIME_SLICE
+
     try:
-        mediafiles.cleanup_media('picture')
-        mediafiles.cleanup_media('movie')
-        logging.debug('cleanup done')
+        if mediafiles.cleanup_media('picture', deadline) and mediafiles.cleanup_media('movie', deadline):
+            logging.debug('cleanup done')
+
+        else:
+            incomplete.value = 1
+
+        for camera_id in config.get_camera_ids():
+            camera_config = config.get_camera(camera_id)
+            if utils.is_local_motion_camera(camera_config):
+                mediafiles.enforce_storage_quota(camera_config, mediafiles.get_volume_camera_configs(camera_config))
          
     except Exception as e:
         logging.error('failed to cleanup media files: %(msg)s' % {
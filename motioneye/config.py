@@ -46,6 +46,9 @@ _ACTIONS = ['lock', 'unlock', 'light_on', 'light_off', 'alarm_on', 'alarm_off',
 
 _TEXT_DOUBLE_THRESHOLD = 640
 
+_AT_LINE_REGEX = re.compile('^#\s*(@\w+)\s*(.*)')
+_CAMERA_CONFIG_FILE_REGEX = re.compile('^' + _CAMERA_CONFIG_FILE_NAME.replace('%(id)s', '(\d+)') + '$')
+
 _main_config_cache = None
 _camera_config_cache = {}
 _camera_ids_cache = None
@@ -53,6 +56,8 @@ _additional_section_funcs = []
 _additional_config_funcs = []
 _additional_structure_cache = {}
 _monitor_command_cache = {}
+_config_file_cache = {}  # (stat key, parse options, lines, parsed data) indexed by config file path
+_batch = None  # lines of the config files written during a batch, indexed by path
 
 # when using the following video codecs, the ffmpeg_variable_bitrate parameter appears to have an exponential effect
 _EXPONENTIAL_QUALITY_CODECS = ['mpeg4', 'msmpeg4', 'swf', 'flv', 'mov', 'mkv']
@@ -146,42 +151,27 @@ def get_main(as_lines=False):
 
     logging.debug('reading main config from file %(path)s...' % {'path': config_file_path})
 
-    lines = None
     try:
-        f = open(config_file_path, 'r')
+        lines, main_config = _read_config_file(config_file_path, list_names=['thread'], no_convert=[
+                                               '@admin_username', '@admin_password', '@normal_username', '@normal_password'],
+                                               strip=False)
 
-    except IOError as e:
+    except EnvironmentError as e:
         if e.errno == errno.ENOENT:  # file does not exist
             logging.info('main config file %(path)s does not exist, using default values' % {'path': config_file_path})
 
             lines = []
-            f = None
+            main_config = _conf_to_dict(lines)
 
         else:
-            logging.error('could not open main config file %(path)s: %(msg)s' % {
-                'path': config_file_path, 'msg': unicode(e)})
-
-            raise
-
-    if lines is None and f:
-        try:
-            lines = [l[:-1] for l in f.readlines()]
-
-        except Exception as e:
             logging.error('could not read main config file %(path)s: %(msg)s' % {
                 'path': config_file_path, 'msg': unicode(e)})
 
             raise
 
-        finally:
-            f.close()
-
     if as_lines:
         return lines
 
-    main_config = _conf_to_dict(lines, list_names=['thread'], no_convert=[
-                                '@admin_username', '@admin_password', '@normal_username', '@normal_password'])
-
     _get_additional_config(main_config)
     _set_default_motion(main_config, old_config_format=motionctl.has_old_config_format())
 
@@ -207,30 +197,8 @@ def set_main(main_config):
     lines = get_main(as_lines=True)
 
     # write the configuration to file
-    logging.debug('writing main config to %(path)s...' % {'path': config_file_path})
-
-    try:
-        f = open(config_file_path, 'w')
-
-    except Exception as e:
-        logging.error('could not open main config file %(path)s for writing: %(msg)s' % {
-            'path': config_file_path, 'msg': unicode(e)})
-
-        raise
-
     lines = _dict_to_conf(lines, main_config, list_names=['thread'])
-
-    try:
-        f.writelines([utils.make_str(l) + '\n' for l in lines])
-
-    except Exception as e:
-        logging.error('could not write main config file %(path)s: %(msg)s' % {
-            'path': config_file_path, 'msg': unicode(e)})
-
-        raise
-
-    finally:
-        f.close()
+    _write_config_file(config_file_path, lines)
 
 
 def get_camera_ids(filter_valid=True):
@@ -254,9 +222,8 @@ def get_camera_ids(filter_valid=True):
 
     camera_ids = []
 
-    pattern = '^' + _CAMERA_CONFIG_FILE_NAME.replace('%(id)s', '(\d+)') + '$'
     for name in ls:
-        match = re.match(pattern, name)
+        match = _CAMERA_CONFIG_FILE_REGEX.match(name)
         if match:
             camera_id = int(match.groups()[0])
             logging.debug('found camera with id %(id)s' % {
@@ -319,15 +286,11 @@ def get_camera(camera_id, as_lines=False):
     logging.debug('reading camera config from %(path)s...' % {'path': camera_config_path})
 
     try:
-        f = open(camera_config_path, 'r')
-
-    except Exception as e:
-        logging.error('could not open camera config file: %(msg)s' % {'msg': unicode(e)})
-
-        raise
-
-    try:
-        lines = [l.strip() for l in f.readlines()]
+        lines, camera_config = _read_config_file(camera_config_path,
+                                                 no_convert=['@name', '@network_share_name', '@network_server',
+                                                             '@network_username', '@network_password',
+                                                             '@storage_device', '@upload_server',
+                                                             '@upload_username', '@upload_password'])
 
     except Exception as e:
         logging.error('could not read camera config file %(path)s: %(msg)s' % {
@@ -335,17 +298,9 @@ def get_camera(camera_id, as_lines=False):
 
         raise
 
-    finally:
-        f.close()
-
     if as_lines:
         return lines
 
-    camera_config = _conf_to_dict(lines,
-                                  no_convert=['@name', '@network_share_name', '@network_server',
-                                              '@network_username', '@network_password', '@storage_device',
-                                              '@upload_server', '@upload_username', '@upload_password'])
-
     if utils.is_local_motion_camera(camera_config):
         # determine the enabled status
         main_config = get_main()
@@ -483,38 +438,15 @@ def set_camera(camera_id, camera_config):
 
     # read the actual configuration from file
     config_file_path = os.path.join(settings.CONF_PATH, _CAMERA_CONFIG_FILE_NAME) % {'id': camera_id}
-    if os.path.isfile(config_file_path):
+    if (_batch and config_file_path in _batch) or os.path.isfile(config_file_path):
         lines = get_camera(camera_id, as_lines=True)
 
     else:
         lines = []
 
     # write the configuration to file
-    camera_config_path = os.path.join(settings.CONF_PATH, _CAMERA_CONFIG_FILE_NAME) % {'id': camera_id}
-    logging.debug('writing camera config to %(path)s...' % {'path': camera_config_path})
-
-    try:
-        f = open(camera_config_path, 'w')
-
-    except Exception as e:
-        logging.error('could not open camera config file %(path)s for writing: %(msg)s' % {
-            'path': camera_config_path, 'msg': unicode(e)})
-
-        raise
-
     lines = _dict_to_conf(lines, camera_config)
-
-    try:
-        f.writelines([utils.make_str(l) + '\n' for l in lines])
-
-    except Exception as e:
-        logging.error('could not write camera config file %(path)s: %(msg)s' % {
-            'path': camera_config_path, 'msg': unicode(e)})
-
-        raise
-
-    finally:
-        f.close()
+    _write_config_file(config_file_path, lines)
 
 
 def add_camera(device_details):
@@ -743,6 +675,7 @@ def motion_camera_ui_to_dict(ui, old_config=None):
         '@network_share_name': ui['network_share_name'],
         '@network_username': ui['network_username'],
         '@network_password': ui['network_password'],
+        '@max_storage': float(ui.get('max_storage') or 0),  # not sent by older motionEye versions
         '@upload_enabled': ui['upload_enabled'],
         '@upload_movie': ui['upload_movie'],
         '@upload_picture': ui['upload_picture'],
@@ -1139,6 +1072,7 @@ def motion_camera_dict_to_ui(data):
         'network_password': data['@network_password'],
         'disk_used': 0,
         'disk_total': 0,
+        'max_storage': data['@max_storage'],
         'available_disks': diskctl.list_mounted_disks(),
         'upload_enabled': data['@upload_enabled'],
         'upload_picture': data['@upload_picture'],
@@ -1723,6 +1657,109 @@ def restore(content):
         return None
 
 
+def begin_batch():
+    # config files written from now on are kept in memory
+    # and only written to disk, all at once, by commit_batch()
+
+    global _batch
+
+    if _batch is not None:
+        logging.warn('a config batch is already in progress')
+
+        return
+
+    logging.debug('starting config batch')
+
+    _batch = collections.OrderedDict()
+
+
+def commit_batch():
+    # writes the config files changed during the batch;
+    # returns a dictionary with the (old lines, new lines) of each changed file, indexed by path
+
+    global _batch
+
+    batch, _batch = _batch or {}, None
+
+    changes = {}
+    for path, lines in batch.iteritems():
+        try:
+            old_lines = _read_config_file(path)[0]
+
+        except EnvironmentError:
+            old_lines = []
+
+        if not _same_config_lines(old_lines, lines):
+            changes[path] = (old_lines, lines)
+
+    logging.debug('committing config batch: %(changed)s out of %(count)s files changed' % {
+            'changed': len(changes), 'count': len(batch)})
+
+    # write all the temporary files first, so that a failure leaves the old configuration untouched
+    written = []
+    try:
+        for path, (old_lines, lines) in changes.iteritems():
+            written.append(_write_temp_config_file(path, lines))
+
+    except Exception:
+        for temp_path in written:
+            try:
+                os.remove(temp_path)
+
+            except OSError:
+                pass
+
+        invalidate()
+
+        raise
+
+    for path in changes:
+        os.rename(path + '.tmp', path)
+        _config_file_cache.pop(path, None)
+
+    return changes
+
+
+def abort_batch():
+    global _batch
+
+    if _batch is None:
+        return
+
+    logging.debug('aborting config batch')
+
+    _batch = None
+
+    # the cached configs may reflect the discarded changes
+    invalidate()
+
+
+def get_motion_changes(changes):
+    # tells how motion is affected by the given config file changes (as returned by commit_batch());
+    # returns a tuple (main config changed, ids of the cameras whose motion config changed),
+    # taking into account that the @-lines are motionEye's own settings, ignored by motion
+
+    def motion_lines(lines):
+        return [l for l in lines if l.strip() and not l.startswith('#') and not l.startswith(';')]
+
+    restart_all = False
+    camera_ids = []
+    for path, (old_lines, lines) in changes.iteritems():
+        if _same_config_lines(motion_lines(old_lines), motion_lines(lines)):
+            continue
+
+        name = os.path.basename(path)
+        if name == _MAIN_CONFIG_FILE_NAME:
+            restart_all = True
+            continue
+
+        match = _CAMERA_CONFIG_FILE_REGEX.match(name)
+        if match:
+            camera_ids.append(int(match.group(1)))
+
+    return restart_all, sorted(camera_ids)
+
+
 def invalidate():
     global _main_config_cache
     global _camera_config_cache
@@ -1736,6 +1773,93 @@ def invalidate():
     _additional_structure_cache = {}
 
 
+def _read_config_file(path, list_names=None, no_convert=None, strip=True):
+    # returns the lines and the parsed data of a config file;
+    # files are parsed again only if their modification time, size or inode have changed
+    # (invalidate() does not clear these, as they always reflect the files on disk);
+    # when strip is False, only the line terminators are removed from the lines
+
+    if _batch and path in _batch:  # written during the current batch
+        lines = _batch[path]
+
+        return list(lines), dict(_conf_to_dict(lines, list_names=list_names, no_convert=no_convert))
+
+    st = os.stat(path)
+    key = (st.st_mtime, st.st_size, st.st_ino)
+    options = (list_names, no_convert, strip)
+
+    entry = _config_file_cache.get(path)
+    if entry is None or entry[0] != key or entry[1] != options:
+        logging.debug('parsing config file %(path)s...' % {'path': path})
+
+        with open(path, 'r') as f:
+            if strip:
+                lines = [l.strip() for l in f.readlines()]
+
+            else:
+                lines = [l[:-1] for l in f.readlines()]
+
+        entry = (key, options, lines, _conf_to_dict(lines, list_names=list_names, no_convert=no_convert))
+        _config_file_cache[path] = entry
+
+    (key, options, lines, data) = entry
+
+    # callers are free to modify the returned data
+    data = dict(data)
+    for n in list_names or []:
+        if n in data:
+            data[n] = list(data[n])
+
+    return list(lines), data
+
+
+def _write_config_file(path, lines):
+    if _batch is not None:
+        _batch[path] = lines
+
+        return
+
+    try:
+        if _same_config_lines(_read_config_file(path)[0], lines):
+            logging.debug('config file %(path)s is unchanged' % {'path': path})
+
+            return
+
+    except EnvironmentError:
+        pass  # the file does not exist yet
+
+    logging.debug('writing config file %(path)s...' % {'path': path})
+
+    _write_temp_config_file(path, lines)
+    os.rename(path + '.tmp', path)
+    _config_file_cache.pop(path, None)
+
+
+def _same_config_lines(lines1, lines2):
+    # lines are compared the way they are read back from file
+    return [utils.make_str(l).strip() for l in lines1] == [utils.make_str(l).strip() for l in lines2]
+
+
+def _write_temp_config_file(path, lines):
+    # the temporary file is renamed over the actual file by the caller,
+    # so that motion never reads a partially written config file
+
+    temp_path = path + '.tmp'
+
+    try:
+        with open(temp_path, 'w') as f:
+            f.writelines([utils.make_str(l) + '\n' for l in lines])
+            f.flush()
+            os.fsync(f.fileno())
+
+    except Exception as e:
+        logging.error('could not write config file %(path)s: %(msg)s' % {'path': temp_path, 'msg': unicode(e)})
+
+        raise
+
+    return temp_path
+
+
 def _value_to_python(value):
     value_lower = value.lower()
     if value_lower == 'off':
@@ -1783,7 +1907,7 @@ def _conf_to_dict(lines, list_names=None, no_convert=None):
         if len(line) == 0:  # empty line
             continue
 
-        match = re.match('^#\s*(@\w+)\s*(.*)', line)
+        match = _AT_LINE_REGEX.match(line)
         if match:
             name, value = match.groups()[:2]
 
@@ -1827,7 +1951,7 @@ def _dict_to_conf(lines, data, list_names=None):
             conf_lines.append(line)
             continue
 
-        match = re.match('^#\s*(@\w+)\s*(.*)', line)
+        match = _AT_LINE_REGEX.match(line)
         if match:  # @line
             (name, value) = match.groups()[:2]
 
@@ -1958,6 +2082,7 @@ def _set_default_motion_camera(camera_id, data):
     data.setdefault('@network_username', '')
     data.setdefault('@network_password', '')
     data.setdefault('target_dir', os.path.join(settings.MEDIA_PATH, data['@name']))
+    data.setdefault('@max_storage', 0)
     data.setdefault('@upload_enabled', False)
     data.setdefault('@upload_picture', True)
     data.setdefault('@upload_movie', True)
@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
 import datetime
+import functools
 import hashlib
 import json
 import logging
@@ -23,12 +24,16 @@ import os
 import re
 import socket
 import subprocess
+import time
 
 from tornado.ioloop import IOLoop
 from tornado.web import RequestHandler, StaticFileHandler, HTTPError, asynchronous
 
+import cleanup
 import config
 import mediafiles
+import mediaindex
+import metrics
 import mjpgclient
 import mmalctl
 import monitor
@@ -36,14 +41,17 @@ import motionctl
 import powerctl
 import prefs
 import remote
+import remoterelay
 import settings
 import smbctl
 import tasks
 import template
+import thumbnails
 import update
 import uploadservices
 import utils
 import v4l2ctl
+import watchdog
 
 
 class BaseHandler(RequestHandler):
@@ -114,6 +122,39 @@ class BaseHandler(RequestHandler):
         self.set_header('Content-Type', 'application/json')
         self.finish(json.dumps(data))
 
+    def finish_chunks(self, chunks, flush_size=256 * 1024):
+        # writes the chunks produced by the given iterable, waiting for
+        # the output to be flushed every flush_size bytes, so that large
+        # contents are never entirely buffered in memory
+        def write_chunks():
+            size = 0
+            for chunk in chunks:
+                self.write(chunk)
+                size += len(chunk)
+                if size >= flush_size:
+                    return self.flush(callback=write_chunks)
+
+            self.finish()
+
+        write_chunks()
+
+    def check_preview_etag(self, camera_config, path, media_type, width, height):
+        # sets the caching headers of a media preview and answers with 304 Not Modified
+        # (returning True) when the browser already has the current version
+        etag = mediafiles.get_media_preview_etag(camera_config, path, media_type, width, height)
+        if not etag:
+            return False
+
+        self.set_header('ETag', etag)
+        self.set_header('Cache-Control', 'private, max-age=%d' % thumbnails.PREVIEW_MAX_AGE)
+        if not self.check_etag_header():
+            return False
+
+        self.set_status(304)
+        self.finish()
+
+        return True
+
     def get_current_user(self):
         main_config = config.get_main()
         
@@ -167,6 +208,38 @@ class BaseHandler(RequestHandler):
 
         return None
     
+    def get_media_list_arguments(self):
+        # "group" is an alias for "prefix"
+        prefix = self.get_argument('group', None)
+        if prefix is None:
+            prefix = self.get_argument('prefix', None)
+
+        limit = self.get_argument('limit', None)
+        cursor = self.get_argument('cursor', None)
+        since = self.get_argument('since', None)
+        until = self.get_argument('until', None)
+
+        try:
+            limit = int(limit) if limit else None
+            since = float(since) if since else None
+            until = float(until) if until else None
+            if cursor:
+                mediafiles.parse_media_list_cursor(cursor)
+
+        except ValueError:
+            raise HTTPError(400, 'invalid media list arguments')
+
+        if limit is not None and limit <= 0:
+            raise HTTPError(400, 'invalid media list arguments')
+
+        return {
+            'prefix': prefix,
+            'limit': limit,
+            'cursor': cursor or None,
+            'since': since,
+            'until': until
+        }
+
     def get_pref(self, key):
         return prefs.get(self.current_user or 'anonymous', key)
         
@@ -371,10 +444,14 @@ class ConfigHandler(BaseHandler):
             
             local_config = config.get_camera(camera_id)
             if utils.is_local_motion_camera(local_config):
+                old_motion_detection = local_config.get('@motion_detection')
                 local_config = config.motion_camera_ui_to_dict(ui_config, local_config)
 
                 config.set_camera(camera_id, local_config)
-            
+
+                if local_config.get('@motion_detection') != old_motion_detection:
+                    motion_detection_changes[camera_id] = local_config['@motion_detection']
+
                 on_finish(None, True)  # (no error, motion needs restart)
 
             elif utils.is_remote_camera(local_config):
@@ -460,7 +537,30 @@ class ConfigHandler(BaseHandler):
         reboot = [False]  # indicates that the server will reboot immediately
         restart = [False]  # indicates that the local motion instance was modified and needs to be restarted
         error = [None]
-        
+        changes = [{}]  # config files changed by this request
+        motion_detection_changes = {}  # new motion detection state, indexed by camera id
+
+        def restart_motion():
+            if settings.SMB_SHARES:
+                # the mounts are updated only after motion has exited
+                def on_stopped():
+                    logging.debug('updating SMB mounts')
+                    stop, start = smbctl.update_mounts()  # @UnusedVariable
+
+                    if start:
+                        motionctl.start()
+
+                motionctl.stop(callback=on_stopped)
+
+            else:
+                motionctl.stop()
+                motionctl.start()  # deferred until the previous motion process has exited
+
+        def apply_motion_detection():
+            # applied to a running motion, when only the @motion_detection setting changed
+            for camera_id, enabled in motion_detection_changes.iteritems():
+                motionctl.set_motion_detection(camera_id, enabled)
+
         def finish():
             if reboot[0]:
                 if settings.ENABLE_REBOOT:
@@ -475,70 +575,81 @@ class ConfigHandler(BaseHandler):
                     reboot[0] = False
 
             if restart[0]:
-                logging.debug('motion needs to be restarted')
-                
-                motionctl.stop()
-                
-                if settings.SMB_SHARES:
-                    logging.debug('updating SMB mounts')
-                    stop, start = smbctl.update_mounts()  # @UnusedVariable
+                # motion only reads its config files when (re)started as a whole;
+                # restarting a single motion thread reuses the config it has in memory
+                restart_all, camera_ids = config.get_motion_changes(changes[0])
+
+                if restart_all or camera_ids or settings.SMB_SHARES or not motionctl.running():
+                    logging.debug('motion needs to be restarted')
+
+                    restart_motion()
 
-                    if start:
-                        motionctl.start()
-                
                 else:
-                    motionctl.start()
+                    logging.debug('motion configuration unchanged, no restart needed')
+
+                    apply_motion_detection()
 
             self.finish({'reload': reload, 'reboot': reboot[0], 'error': error[0]})
         
-        if camera_id is not None:
-            if camera_id == 0:  # multiple camera configs
-                if len(ui_config) > 1:
-                    logging.debug('setting multiple configs')
+        # all the config files are written at once, when the changes have been applied
+        io_loop = IOLoop.instance()
+        config.begin_batch()
+
+        try:
+            if camera_id is not None:
+                if camera_id == 0:  # multiple camera configs
+                    if len(ui_config) > 1:
+                        logging.debug('setting multiple configs')
                 
-                elif len(ui_config) == 0:
-                    logging.warn('no configuration to set')
+                    elif len(ui_config) == 0:
+                        logging.warn('no configuration to set')
                     
-                    self.finish()
+                        self.finish()
                 
-                so_far = [0]
+                    so_far = [0]
 
-                def check_finished(e, r):
-                    restart[0] = restart[0] or r
-                    error[0] = error[0] or e
-                    so_far[0] += 1
+                    def check_finished(e, r):
+                        restart[0] = restart[0] or r
+                        error[0] = error[0] or e
+                        so_far[0] += 1
                     
-                    if so_far[0] >= len(ui_config):  # finished
-                        finish()
-
-                # make sure main config is handled first
-                items = ui_config.items()
-                items.sort(key=lambda (key, cfg): key != 'main')
-
-                for key, cfg in items:
-                    if key == 'main':
-                        result = set_main_config(cfg)
-                        reload = result['reload'] or reload
-                        reboot[0] = result['reboot'] or reboot[0]
-                        restart[0] = result['restart'] or restart[0]
-                        check_finished(None, False)
+                        if so_far[0] >= len(ui_config):  # finished
+                            io_loop.add_callback(finish)  # after the config batch is committed
+
+                    # make sure main config is handled first
+                    items = ui_config.items()
+                    items.sort(key=lambda (key, cfg): key != 'main')
+
+                    for key, cfg in items:
+                        if key == 'main':
+                            result = set_main_config(cfg)
+                            reload = result['reload'] or reload
+                            reboot[0] = result['reboot'] or reboot[0]
+                            restart[0] = result['restart'] or restart[0]
+                            check_finished(None, False)
                         
-                    else:
-                        set_camera_config(int(key), cfg, check_finished)
+                        else:
+                            set_camera_config(int(key), cfg, check_finished)
             
-            else:  # single camera config
-                def on_finish(e, r):
-                    error[0] = e
-                    restart[0] = r
-                    finish()
+                else:  # single camera config
+                    def on_finish(e, r):
+                        error[0] = e
+                        restart[0] = r
+                        io_loop.add_callback(finish)  # after the config batch is committed
 
-                set_camera_config(camera_id, ui_config, on_finish)
+                    set_camera_config(camera_id, ui_config, on_finish)
 
-        else:  # main config
-            result = set_main_config(ui_config)
-            reload = result['reload']
-            reboot[0] = result['reboot']
-            restart[0] = result['restart']
+            else:  # main config
+                result = set_main_config(ui_config)
+                reload = result['reload']
+                reboot[0] = result['reboot']
+                restart[0] = result['restart']
+
+        except Exception:
+            config.abort_batch()
+            raise
+
+        changes[0] = config.commit_batch()
 
     @BaseHandler.auth(admin=True)
     def set_preview(self, camera_id):
@@ -670,15 +781,26 @@ class ConfigHandler(BaseHandler):
                 camera_ids = []
                 
             length = [len(camera_ids)]
+            finished = [False]
+            pending = {}  # local configs of remote cameras still waiting for their config
+            
+            # unless explicitly asked to wait, remote cameras that are not cached yet
+            # are listed as pending and are expected to be fetched again by the client
+            wait = self.get_argument('wait', None) == 'true' or not settings.REMOTE_CONFIG_CACHE_TTL
 
             def check_finished():
-                if len(cameras) == length[0]:
+                if len(cameras) == length[0] and not finished[0]:
+                    finished[0] = True
                     cameras.sort(key=lambda c: c['id'])
                     self.finish_json({'cameras': cameras})
                     
             def on_response_builder(camera_id, local_config):
 
                 def on_response(remote_ui_config=None, error=None):
+                    if finished[0]:
+                        return  # already listed as pending
+                    
+                    pending.pop(camera_id, None)
                     if error:
                         cameras.append({
                             'id': camera_id,
@@ -721,7 +843,8 @@ class ConfigHandler(BaseHandler):
 
                 elif utils.is_remote_camera(local_config):
                     if local_config.get('@enabled') or self.get_argument('force', None) == 'true':
-                        remote.get_config(local_config, on_response_builder(camera_id, local_config))
+                        pending[camera_id] = local_config
+                        remote.get_cached_config(local_config, on_response_builder(camera_id, local_config))
                     
                     else:  # don't try to reach the remote of the camera is disabled
                         on_response_builder(camera_id, local_config)(error=True)
@@ -731,8 +854,22 @@ class ConfigHandler(BaseHandler):
                     cameras.append(ui_config)
                     check_finished()
             
-            if length[0] == 0:        
-                self.finish_json({'cameras': []})
+            if not wait:
+                for camera_id, local_config in pending.items():
+                    cameras.append({
+                        'id': camera_id,
+                        'name': '&lt;' + remote.pretty_camera_url(local_config) + '&gt;',
+                        'enabled': False,
+                        'pending': True,
+                        'streaming_framerate': 1,
+                        'framerate': 1
+                    })
+                
+                pending.clear()
+                check_finished()
+
+            if length[0] == 0:
+                check_finished()
 
     @BaseHandler.auth(admin=True)
     def add_camera(self):
@@ -749,16 +886,19 @@ class ConfigHandler(BaseHandler):
         camera_config = config.add_camera(device_details)
 
         if utils.is_local_motion_camera(camera_config):
-            motionctl.stop()
-            
             if settings.SMB_SHARES:
-                stop, start = smbctl.update_mounts()  # @UnusedVariable
+                # the mounts are updated only after motion has exited
+                def on_stopped():
+                    stop, start = smbctl.update_mounts()  # @UnusedVariable
+
+                    if start:
+                        motionctl.start()
 
-                if start:
-                    motionctl.start()
+                motionctl.stop(callback=on_stopped)
             
             else:
-                motionctl.start()
+                motionctl.stop()
+                motionctl.start()  # deferred until the previous motion process has exited
             
             ui_config = config.motion_camera_dict_to_ui(camera_config)
             
@@ -851,7 +991,7 @@ class ConfigHandler(BaseHandler):
                 service_name = data['service']
                 ConfigHandler._upload_service_test_info = (self, service_name)
 
-                tasks.add(0, uploadservices.test_access, tag='uploadservices.test(%s)' % service_name,
+                tasks.add(0, uploadservices.test_access, tag='uploadservices.test(%s)' % service_name, priority=tasks.PRIORITY_HIGH,
                         camera_id=camera_id, service_name=service_name, data=data, callback=self._on_test_result)
 
             elif what == 'email':
@@ -959,6 +1099,8 @@ class ConfigHandler(BaseHandler):
 
 
 class PictureHandler(BaseHandler):
+    _STREAM_BOUNDARY = 'motioneyeframe'
+
     @asynchronous
     def get(self, camera_id, op, filename=None, group=None):
         if camera_id is not None:
@@ -971,10 +1113,19 @@ class PictureHandler(BaseHandler):
             
         elif op == 'list':
             self.list(camera_id)
-            
+
+        elif op == 'groups':
+            self.groups(camera_id)
+
+        elif op == 'stream':
+            self.stream(camera_id)
+
         elif op == 'frame':
             self.frame(camera_id)
             
+        elif op == 'burst':
+            self.burst(camera_id)
+            
         elif op == 'download':
             self.download(camera_id, filename)
         
@@ -1049,28 +1200,165 @@ class PictureHandler(BaseHandler):
 
                 self.try_finish(picture)
             
-            remote.get_current_picture(camera_config, width=width, height=height, callback=on_response)
+            remoterelay.get_current_picture(camera_config, width=width, height=height, callback=on_response)
             
         else:  # assuming simple mjpeg camera
             raise HTTPError(400, 'unknown operation')
             
+    @BaseHandler.auth(prompt=False)
+    def stream(self, camera_id):
+        camera_config = config.get_camera(camera_id)
+        if not utils.is_local_motion_camera(camera_config):
+            raise HTTPError(400, 'unknown operation')
+
+        logging.debug('starting picture stream for camera %(id)s' % {'id': camera_id})
+
+        width = self.get_argument('width', None)
+        height = self.get_argument('height', None)
+        fps = self.get_argument('fps', None)
+
+        try:
+            width = float(width) if width else None
+            height = float(height) if height else None
+            fps = float(fps) if fps else None
+
+        except ValueError:
+            raise HTTPError(400, 'invalid stream arguments')
+
+        for value in (width, height, fps):
+            if value is not None and not 0 < value < float('inf'):  # also rejects nan
+                raise HTTPError(400, 'invalid stream arguments')
+
+        self._stream = {
+            'camera_id': camera_id,
+            'camera_config': camera_config,
+            'width': width,
+            'height': height,
+            'interval': fps and 1.0 / fps or 0,
+            'last_frame_time': 0,
+            'monitor_info': '',
+            'monitor_info_time': 0,
+            'flushing': False,
+            'timeout': None
+        }
+
+        self.set_header('Content-Type', 'multipart/x-mixed-replace; boundary=%s' % self._STREAM_BOUNDARY)
+        self.set_header('Cache-Control', 'no-store, must-revalidate')
+        self.set_header('Pragma', 'no-cache')
+        self.flush()
+
+        mjpgclient.subscribe(camera_id, self._on_stream_frame)
+        self._stream_keepalive()
+
+    def on_connection_close(self):
+        self._stop_stream()
+
+    def on_finish(self):
+        self._stop_stream()
+
+    def _stop_stream(self):
+        stream = getattr(self, '_stream', None)
+        if not stream:
+            return
+
+        logging.debug('stopping picture stream for camera %(id)s' % {'id': stream['camera_id']})
+
+        self._stream = None
+        mjpgclient.unsubscribe(stream['camera_id'], self._on_stream_frame)
+        if stream['timeout']:
+            IOLoop.instance().remove_timeout(stream['timeout'])
+
+    def _stream_keepalive(self):
+        # makes sure the mjpg client is (re)started and not considered idle,
+        # even when no frames are coming in
+        stream = self._stream
+        if not stream:
+            return
+
+        mjpgclient.get_jpg(stream['camera_id'])
+        stream['timeout'] = IOLoop.instance().add_timeout(datetime.timedelta(seconds=1), self._stream_keepalive)
+
+    def _on_stream_frame(self, jpg):
+        stream = self._stream
+        if not stream:
+            return
+
+        if self.request.connection.stream.closed():
+            return self._stop_stream()
+
+        # slow clients simply skip frames, rather than accumulating them in the output buffer
+        if stream['flushing']:
+            return
+
+        now = time.time()
+        if now - stream['last_frame_time'] < stream['interval']:
+            return
+
+        camera_id = stream['camera_id']
+        picture = mediafiles.get_current_picture(stream['camera_config'], width=stream['width'], height=stream['height'])
+        if not picture:
+            return
+
+        # monitor info may be expensive to compute, there's no point in doing it for every frame
+        if now - stream['monitor_info_time'] > 1:
+            stream['monitor_info'] = monitor.get_monitor_info(camera_id)
+            stream['monitor_info_time'] = now
+
+        stream['last_frame_time'] = now
+        stream['flushing'] = True
+
+        self.write('--%(boundary)s\r\n'
+                   'Content-Type: image/jpeg\r\n'
+                   'Content-Length: %(length)s\r\n'
+                   'X-Timestamp: %(timestamp).3f\r\n'
+                   'X-Motion-Detected: %(motion_detected)s\r\n'
+                   'X-Capture-Fps: %(capture_fps).1f\r\n'
+                   'X-Monitor-Info: %(monitor_info)s\r\n\r\n' % {
+                        'boundary': self._STREAM_BOUNDARY,
+                        'length': len(picture),
+                        'timestamp': now,
+                        'motion_detected': str(motionctl.is_motion_detected(camera_id)).lower(),
+                        'capture_fps': mjpgclient.get_fps(camera_id),
+                        'monitor_info': stream['monitor_info']})
+
+        self.write(picture)
+        self.write('\r\n')
+        self.flush(callback=self._on_stream_flushed)
+
+    def _on_stream_flushed(self):
+        if self._stream:
+            self._stream['flushing'] = False
+
     @BaseHandler.auth()
     def list(self, camera_id):
         logging.debug('listing pictures for camera %(id)s' % {'id': camera_id})
         
+        args = self.get_media_list_arguments()
+        limit = args['limit']
+
         camera_config = config.get_camera(camera_id)
         if utils.is_local_motion_camera(camera_config):
             def on_media_list(media_list):
                 if media_list is None:
                     return self.finish_json({'error': 'Failed to get pictures list.'})
 
-                self.finish_json({
+                media_list, next_cursor = mediafiles.paginate_media_list(media_list, limit)
+                response = {
                     'mediaList': media_list,
                     'cameraName': camera_config['@name']
-                })
-            
-            mediafiles.list_media(camera_config, media_type='picture',
-                    callback=on_media_list, prefix=self.get_argument('prefix', None))
+                }
+
+                if limit is not None:
+                    response['nextCursor'] = next_cursor
+
+                self.finish_json(response)
+
+            cursor = args['cursor'] and mediafiles.parse_media_list_cursor(args['cursor'])
+
+            # one more entry is listed to find out if there's a next page
+            mediafiles.list_media(camera_config, media_type='picture', callback=on_media_list, prefix=args['prefix'],
+                                  since=args['since'], until=args['until'], cursor=cursor,
+                                  limit=limit and limit + 1)
 
         elif utils.is_remote_camera(camera_config):
             def on_response(remote_list=None, error=None):
@@ -1080,8 +1368,38 @@ class PictureHandler(BaseHandler):
 
                 self.finish_json(remote_list)
             
-            remote.list_media(camera_config, media_type='picture', prefix=self.get_argument('prefix', None),
-                              callback=on_response)
+            remote.list_media(camera_config, media_type='picture', prefix=args['prefix'], callback=on_response,
+                              since=args['since'], until=args['until'], cursor=args['cursor'], limit=limit)
+
+        else:  # assuming simple mjpeg camera
+            raise HTTPError(400, 'unknown operation')
+
+    @BaseHandler.auth()
+    def groups(self, camera_id):
+        logging.debug('listing picture groups for camera %(id)s' % {'id': camera_id})
+
+        camera_config = config.get_camera(camera_id)
+        if utils.is_local_motion_camera(camera_config):
+            def on_groups(groups):
+                if groups is None:
+                    return self.finish_json({'error': 'Failed to get picture groups.'})
+
+                self.finish_json({
+                    'groups': groups,
+                    'cameraName': camera_config['@name']
+                })
+
+            mediafiles.list_media_groups(camera_config, media_type='picture', callback=on_groups)
+
+        elif utils.is_remote_camera(camera_config):
+            def on_response(remote_groups=None, error=None):
+                if error:
+                    return self.finish_json({'error': 'Failed to get picture groups for %(url)s: %(msg)s.' % {
+                            'url': remote.pretty_camera_url(camera_config), 'msg': error}})
+
+                self.finish_json(remote_groups)
+
+            remote.list_media_groups(camera_config, media_type='picture', callback=on_response)
 
         else:  # assuming simple mjpeg camera
             raise HTTPError(400, 'unknown operation')
@@ -1123,6 +1441,68 @@ class PictureHandler(BaseHandler):
 
             remote.get_config(camera_config, on_response)
         
+    @BaseHandler.auth()
+    def burst(self, camera_id):
+        # exports the recent frames buffered by the mjpg client, either as a zip of pictures or as an mjpeg file
+        camera_config = config.get_camera(camera_id)
+        if not utils.is_local_motion_camera(camera_config):
+            raise HTTPError(400, 'unknown operation')
+
+        seconds = self.get_argument('seconds', None)
+        fmt = self.get_argument('format', 'zip')
+        if fmt not in ['zip', 'mjpeg']:
+            raise HTTPError(400, 'unknown format')
+
+        if seconds is not None:
+            try:
+                seconds = float(seconds)
+
+            except ValueError:
+                raise HTTPError(400, 'invalid seconds')
+
+            if not 0 < seconds < float('inf'):  # also rejects nan
+                raise HTTPError(400, 'invalid seconds')
+
+            # frames are not buffered for longer than this anyway
+            if settings.FRAME_BUFFER_DURATION:
+                seconds = min(seconds, settings.FRAME_BUFFER_DURATION)
+
+        frames = mjpgclient.get_frames(camera_id, seconds)
+        if not frames:
+            raise HTTPError(404, 'no frames available')
+
+        logging.debug('exporting a burst of %(count)s frames of camera %(id)s as %(format)s' % {
+                'count': len(frames), 'id': camera_id, 'format': fmt})
+
+        def frame_name(timestamp):
+            return time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(timestamp)) + '.%03d' % (timestamp % 1 * 1000)
+
+        pretty_filename = camera_config['@name'] + '_' + frame_name(frames[-1][0])
+        if fmt == 'zip':
+            files = [(jpg, frame_name(timestamp) + '.jpg', timestamp) for (timestamp, jpg) in frames]
+            
+            self.set_header('Content-Type', 'application/zip')
+            self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + '.zip;')
+            self.finish_chunks(mediafiles.iter_zipped_content(files))
+
+        else:
+            def iter_parts():
+                for (timestamp, jpg) in frames:
+                    yield ('--%(boundary)s\r\n'
+                           'Content-Type: image/jpeg\r\n'
+                           'Content-Length: %(length)s\r\n'
+                           'X-Timestamp: %(timestamp).3f\r\n\r\n' % {
+                                'boundary': self._STREAM_BOUNDARY,
+                                'length': len(jpg),
+                                'timestamp': timestamp})
+
+                    yield jpg
+                    yield '\r\n'
+
+            self.set_header('Content-Type', 'multipart/x-mixed-replace; boundary=%s' % self._STREAM_BOUNDARY)
+            self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + '.mjpg;')
+            self.finish_chunks(iter_parts())
+
     @BaseHandler.auth()
     def download(self, camera_id, filename):
         logging.debug('downloading picture %(filename)s of camera %(id)s' % {
@@ -1162,9 +1542,12 @@ class PictureHandler(BaseHandler):
         
         camera_config = config.get_camera(camera_id)
         if utils.is_local_motion_camera(camera_config):
-            content = mediafiles.get_media_preview(camera_config, filename, 'picture',
-                    width=self.get_argument('width', None),
-                    height=self.get_argument('height', None))
+            width = self.get_argument('width', None)
+            height = self.get_argument('height', None)
+            if self.check_preview_etag(camera_config, filename, 'picture', width, height):
+                return
+
+            content = mediafiles.get_media_preview(camera_config, filename, 'picture', width=width, height=height)
             
             if content:
                 self.set_header('Content-Type', 'image/jpeg')
@@ -1231,8 +1614,8 @@ class PictureHandler(BaseHandler):
                     'group': group or 'ungrouped', 'id': camera_id, 'key': key})
             
             if utils.is_local_motion_camera(camera_config):
-                data = mediafiles.get_prepared_cache(key)
-                if not data:
+                files = mediafiles.get_prepared_cache(key)
+                if files is None:
                     logging.error('prepared cache data for key "%s" does not exist' % key)
                     
                     raise HTTPError(404, 'no such key')
@@ -1242,7 +1625,9 @@ class PictureHandler(BaseHandler):
          
                 self.set_header('Content-Type', 'application/zip')
                 self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + '.zip;')
-                self.finish(data)
+
+                # the archive is generated while being sent
+                self.finish_chunks(mediafiles.iter_zipped_content(files))
                 
             elif utils.is_remote_camera(camera_config):
                 def on_response(response=None, error=None):
@@ -1265,16 +1650,16 @@ class PictureHandler(BaseHandler):
                     'group': group or 'ungrouped', 'id': camera_id})
 
             if utils.is_local_motion_camera(camera_config):
-                def on_zip(data):
-                    if data is None:
+                def on_zip(files):
+                    if files is None:
                         return self.finish_json({'error': 'Failed to create zip file.'})
     
-                    key = mediafiles.set_prepared_cache(data)
+                    key = mediafiles.set_prepared_cache(files)
                     logging.debug('prepared zip file for group "%(group)s" of camera %(id)s with key %(key)s' % {
                             'group': group or 'ungrouped', 'id': camera_id, 'key': key})
                     self.finish_json({'key': key})
     
-                mediafiles.get_zipped_content(camera_config, media_type='picture', group=group, callback=on_zip)
+                mediafiles.get_zipped_files(camera_config, media_type='picture', group=group, callback=on_zip)
     
             elif utils.is_remote_camera(camera_config):
                 def on_response(response=None, error=None):
@@ -1293,6 +1678,10 @@ class PictureHandler(BaseHandler):
     def timelapse(self, camera_id, group):
         key = self.get_argument('key', None)
         check = self.get_argument('check', False)
+        interval = self.get_argument('interval', None)
+        framerate = self.get_argument('framerate', None)
+        interval = interval and int(interval)
+        framerate = framerate and int(framerate)
         camera_config = config.get_camera(camera_id)
 
         if key:  # download
@@ -1300,8 +1689,8 @@ class PictureHandler(BaseHandler):
                     'group': group or 'ungrouped', 'id': camera_id, 'key': key})
             
             if utils.is_local_motion_camera(camera_config):
-                data = mediafiles.get_prepared_cache(key)
-                if data is None:
+                path = mediafiles.get_prepared_cache(key)
+                if path is None:
                     logging.error('prepared cache data for key "%s" does not exist' % key)
 
                     raise HTTPError(404, 'no such key')
@@ -1309,10 +1698,17 @@ class PictureHandler(BaseHandler):
                 pretty_filename = camera_config['@name'] + '_' + group
                 pretty_filename = re.sub('[^a-zA-Z0-9]', '_', pretty_filename)
                 pretty_filename += '.' + mediafiles.FFMPEG_EXT_MAPPING.get(camera_config['ffmpeg_video_codec'], 'avi')
-    
+
+                try:
+                    size = os.path.getsize(path)
+
+                except OSError:
+                    raise HTTPError(404, 'no such key')
+
                 self.set_header('Content-Type', 'video/x-msvideo')
                 self.set_header('Content-Disposition', 'attachment; filename=' + pretty_filename + ';')
-                self.finish(data)
+                self.set_header('Content-Length', size)
+                self.finish_chunks(mediafiles.iter_file_content(path))
 
             elif utils.is_remote_camera(camera_config):
                 def on_response(response=None, error=None):
@@ -1336,15 +1732,15 @@ class PictureHandler(BaseHandler):
                     'group': group or 'ungrouped', 'id': camera_id})
 
             if utils.is_local_motion_camera(camera_config):
-                status = mediafiles.check_timelapse_movie()
-                if status['progress'] == -1 and status['data']:
-                    key = mediafiles.set_prepared_cache(status['data'])
+                status = mediafiles.check_timelapse_movie(camera_config, framerate, interval, group)
+                if status['progress'] == -1 and status['path']:
+                    key = mediafiles.set_prepared_cache(status['path'])
                     logging.debug('prepared timelapse movie for group "%(group)s" of camera %(id)s with key %(key)s' % {
                             'group': group or 'ungrouped', 'id': camera_id, 'key': key})
                     self.finish_json({'key': key, 'progress': -1})
 
                 else:
-                    self.finish_json(status)
+                    self.finish_json({'progress': status['progress']})
 
             elif utils.is_remote_camera(camera_config):
                 def on_response(response=None, error=None):
@@ -1360,21 +1756,22 @@ class PictureHandler(BaseHandler):
                     else:
                         self.finish_json(response)
 
-                remote.check_timelapse_movie(camera_config, group=group, callback=on_response)
+                remote.check_timelapse_movie(camera_config, group=group, callback=on_response,
+                                             framerate=framerate, interval=interval)
 
             else:  # assuming simple mjpeg camera
                 raise HTTPError(400, 'unknown operation')
 
         else:  # start timelapse
-            interval = int(self.get_argument('interval'))
-            framerate = int(self.get_argument('framerate'))
+            if not interval or not framerate:
+                raise HTTPError(400, 'interval and framerate are required')
 
             msg = 'preparing timelapse movie for group "%(group)s" of camera %(id)s with rate %(framerate)s/%(int)s' % {
                     'group': group or 'ungrouped', 'id': camera_id, 'framerate': framerate, 'int': interval}
             logging.debug(msg)
 
             if utils.is_local_motion_camera(camera_config):
-                status = mediafiles.check_timelapse_movie()
+                status = mediafiles.check_timelapse_movie(camera_config, framerate, interval, group)
                 if status['progress'] != -1:
                     self.finish_json({'progress': status['progress']})  # timelapse already active
 
@@ -1400,7 +1797,8 @@ class PictureHandler(BaseHandler):
                     
                     remote.make_timelapse_movie(camera_config, framerate, interval, group=group, callback=on_make)
 
-                remote.check_timelapse_movie(camera_config, group=group, callback=on_status)
+                remote.check_timelapse_movie(camera_config, group=group, callback=on_status,
+                                             framerate=framerate, interval=interval)
 
             else:  # assuming simple mjpeg camera
                 raise HTTPError(400, 'unknown operation')
@@ -1450,7 +1848,10 @@ class MovieHandler(BaseHandler):
         
         if op == 'list':
             self.list(camera_id)
-            
+
+        elif op == 'groups':
+            self.groups(camera_id)
+
         elif op == 'preview':
             self.preview(camera_id, filename)
         
@@ -1480,19 +1881,32 @@ class MovieHandler(BaseHandler):
     def list(self, camera_id):
         logging.debug('listing movies for camera %(id)s' % {'id': camera_id})
         
+        args = self.get_media_list_arguments()
+        limit = args['limit']
+
         camera_config = config.get_camera(camera_id)
         if utils.is_local_motion_camera(camera_config):
             def on_media_list(media_list):
                 if media_list is None:
                     return self.finish_json({'error': 'Failed to get movies list.'})
 
-                self.finish_json({
+                media_list, next_cursor = mediafiles.paginate_media_list(media_list, limit)
+                response = {
                     'mediaList': media_list,
                     'cameraName': camera_config['@name']
-                })
-            
-            mediafiles.list_media(camera_config, media_type='movie',
-                    callback=on_media_list, prefix=self.get_argument('prefix', None))
+                }
+
+                if limit is not None:
+                    response['nextCursor'] = next_cursor
+
+                self.finish_json(response)
+
+            cursor = args['cursor'] and mediafiles.parse_media_list_cursor(args['cursor'])
+
+            # one more entry is listed to find out if there's a next page
+            mediafiles.list_media(camera_config, media_type='movie', callback=on_media_list, prefix=args['prefix'],
+                                  since=args['since'], until=args['until'], cursor=cursor,
+                                  limit=limit and limit + 1)
         
         elif utils.is_remote_camera(camera_config):
             def on_response(remote_list=None, error=None):
@@ -1502,8 +1916,38 @@ class MovieHandler(BaseHandler):
 
                 self.finish_json(remote_list)
             
-            remote.list_media(camera_config, media_type='movie', prefix=self.get_argument('prefix', None),
-                              callback=on_response)
+            remote.list_media(camera_config, media_type='movie', prefix=args['prefix'], callback=on_response,
+                              since=args['since'], until=args['until'], cursor=args['cursor'], limit=limit)
+
+        else:  # assuming simple mjpeg camera
+            raise HTTPError(400, 'unknown operation')
+
+    @BaseHandler.auth()
+    def groups(self, camera_id):
+        logging.debug('listing movie groups for camera %(id)s' % {'id': camera_id})
+
+        camera_config = config.get_camera(camera_id)
+        if utils.is_local_motion_camera(camera_config):
+            def on_groups(groups):
+                if groups is None:
+                    return self.finish_json({'error': 'Failed to get movie groups.'})
+
+                self.finish_json({
+                    'groups': groups,
+                    'cameraName': camera_config['@name']
+                })
+
+            mediafiles.list_media_groups(camera_config, media_type='movie', callback=on_groups)
+
+        elif utils.is_remote_camera(camera_config):
+            def on_response(remote_groups=None, error=None):
+                if error:
+                    return self.finish_json({'error': 'Failed to get movie groups for %(url)s: %(msg)s.' % {
+                            'url': remote.pretty_camera_url(camera_config), 'msg': error}})
+
+                self.finish_json(remote_groups)
+
+            remote.list_media_groups(camera_config, media_type='movie', callback=on_response)
 
         else:  # assuming simple mjpeg camera
             raise HTTPError(400, 'unknown operation')
@@ -1515,9 +1959,12 @@ class MovieHandler(BaseHandler):
         
         camera_config = config.get_camera(camera_id)
         if utils.is_local_motion_camera(camera_config):
-            content = mediafiles.get_media_preview(camera_config, filename, 'movie',
-                    width=self.get_argument('width', None),
-                    height=self.get_argument('height', None))
+            width = self.get_argument('width', None)
+            height = self.get_argument('height', None)
+            if self.check_preview_etag(camera_config, filename, 'movie', width, height):
+                return
+
+            content = mediafiles.get_media_preview(camera_config, filename, 'movie', width=width, height=height)
             
             if content:
                 self.set_header('Content-Type', 'image/jpeg')
@@ -1784,6 +2231,8 @@ class PrefsHandler(BaseHandler):
     
 
 class RelayEventHandler(BaseHandler):
+    _upload_batches = {}  # files waiting to be uploaded, indexed by (camera id, service name, target dir)
+
     @BaseHandler.auth(admin=True)
     def post(self):
         event = self.get_argument('event')
@@ -1816,8 +2265,11 @@ class RelayEventHandler(BaseHandler):
         elif event == 'movie_end':
             filename = self.get_argument('filename')
             
+            mediaindex.add_file(camera_config, filename)
+            cleanup.check_quota(camera_config)
+
             # generate preview (thumbnail)
-            tasks.add(5, mediafiles.make_movie_preview, tag='make_movie_preview(%s)' % filename,
+            tasks.add(5, mediafiles.make_movie_preview, tag='make_movie_preview(%s)' % filename, priority=tasks.PRIORITY_HIGH,
                     camera_config=camera_config, full_path=filename)
 
             # upload to external service
@@ -1827,6 +2279,14 @@ class RelayEventHandler(BaseHandler):
         elif event == 'picture_save':
             filename = self.get_argument('filename')
             
+            mediaindex.add_file(camera_config, filename)
+            cleanup.check_quota(camera_config)
+
+            # create the preview thumbnails right away, while the picture is likely to be in the disk cache
+            if thumbnails.enabled():
+                tasks.add(0, thumbnails.make_thumbnails, tag='make_thumbnails(%s)' % filename,
+                        callback=thumbnails.add_files, priority=tasks.PRIORITY_LOW, full_path=filename)
+
             # upload to external service
             if camera_config['@upload_enabled'] and camera_config['@upload_picture']:
                 self.upload_media_file(filename, camera_id, camera_config)
@@ -1838,11 +2298,35 @@ class RelayEventHandler(BaseHandler):
     
     def upload_media_file(self, filename, camera_id, camera_config):
         service_name = camera_config['@upload_service']
-        
-        tasks.add(5, uploadservices.upload_media_file, tag='upload_media_file(%s)' % filename,
-                camera_id=camera_id, service_name=service_name,
-                target_dir=camera_config['@upload_subfolders'] and camera_config['target_dir'],
-                filename=filename)
+        target_dir = camera_config['@upload_subfolders'] and camera_config['target_dir']
+
+        if not settings.UPLOAD_BATCH_WINDOW:
+            tasks.add(5, uploadservices.upload_media_file, tag='upload_media_file(%s)' % filename,
+                    priority=tasks.PRIORITY_LOW, camera_id=camera_id, service_name=service_name,
+                    target_dir=target_dir, filename=filename)
+
+            return
+
+        # files arriving within the batch window are uploaded together, in one task
+        key = (camera_id, service_name, target_dir)
+        batch = RelayEventHandler._upload_batches.get(key)
+        if batch is None:
+            batch = RelayEventHandler._upload_batches[key] = []
+
+            io_loop = IOLoop.instance()
+            io_loop.add_timeout(datetime.timedelta(seconds=settings.UPLOAD_BATCH_WINDOW),
+                    functools.partial(RelayEventHandler._add_upload_batch_task, key))
+
+        batch.append(filename)
+
+    @staticmethod
+    def _add_upload_batch_task(key):
+        (camera_id, service_name, target_dir) = key
+        filenames = RelayEventHandler._upload_batches.pop(key, [])
+
+        tasks.add(5, uploadservices.upload_media_files, tag='upload_media_files(%s files)' % len(filenames),
+                priority=tasks.PRIORITY_LOW, camera_id=camera_id, service_name=service_name,
+                target_dir=target_dir, filenames=filenames)
 
 
 class LogHandler(BaseHandler):
@@ -1924,6 +2408,25 @@ class PowerHandler(BaseHandler):
         io_loop.add_timeout(datetime.timedelta(seconds=2), powerctl.reboot)
 
 
+class StatsHandler(BaseHandler):
+    @BaseHandler.auth(admin=True)
+    def get(self):
+        self.finish_json({
+            'cameras': mjpgclient.get_stats(),
+            'tasks': tasks.get_stats(),
+            'remote': remote.get_stats(),
+            'remote_relay': remoterelay.get_stats(),
+            'ioloop': watchdog.get_stats()
+        })
+
+
+class MetricsHandler(BaseHandler):
+    @BaseHandler.auth(admin=True)
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.finish(metrics.render())
+
+
 class VersionHandler(BaseHandler):
     def get(self):
         motion_info = motionctl.find_motion()
@@ -15,9 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import collections
 import datetime
 import errno
-import fcntl
 import functools
 import hashlib
 import logging
@@ -25,24 +25,36 @@ import multiprocessing
 import os.path
 import pipes
 import re
+import shutil
 import signal
 import stat
 import StringIO
+import struct
 import subprocess
 import time
-import zipfile
+import zlib
 
 from PIL import Image
 from tornado.ioloop import IOLoop
 
 import config
+import mediaindex
+import metrics
 import settings
+import thumbnails
 import utils
 
 
 _PICTURE_EXTS = ['.jpg']
 _MOVIE_EXTS = ['.avi', '.mp4', '.mov', '.swf', '.flv', '.mkv']
 
+_CLEANUP_BATCH_SIZE = 1000  # number of expired files removed between two media index queries
+_QUOTA_BATCH_SIZE = 100  # maximum number of files removed between two storage quota checks
+_ZIP_CHUNK_SIZE = 128 * 1024
+_FILE_CHUNK_SIZE = 128 * 1024
+_TIMELAPSE_CACHE_MAX_AGE = 7 * 86400
+_ZIP_32BIT_LIMIT = 0xFFFFFFFF
+
 FFMPEG_CODEC_MAPPING = {
     'mpeg4': 'mpeg4',
     'msmpeg4': 'msmpeg4v2',
@@ -81,11 +93,13 @@ FFMPEG_EXT_MAPPING = {
 # a cache of prepared files (whose preparing time is significant)
 _prepared_files = {}
 
-_timelapse_process = None
-_timelapse_data = None
+_timelapse_jobs = {}  # indexed by (camera id, group, framerate, interval)
 
 _ffmpeg_binary_cache = None
 
+# mimics the relevant part of os.stat() results for indexed media files
+_MediaStat = collections.namedtuple('_MediaStat', ['st_size', 'st_mtime'])
+
 
 def findfiles(path):
     files = []
@@ -149,7 +163,133 @@ def _list_media_files(directory, exts, prefix=None):
     return media_files
 
 
-def _remove_older_files(directory, moment, exts):
+def _list_camera_media_files(camera_config, media_type, prefix=None, since=None, until=None, cursor=None, limit=None):
+    # the media index is used whenever it's available for the camera,
+    # otherwise the target directory is walked
+
+    target_dir = camera_config.get('target_dir')
+
+    group = prefix
+    if group is not None:
+        group = '' if group == 'ungrouped' else group.strip('/')
+
+    entries = mediaindex.list_files(camera_config, media_type, group=group,
+                                    since=since, until=until, cursor=cursor, limit=limit)
+    if entries is not None:
+        return [(os.path.join(target_dir, path), _MediaStat(size, mtime)) for (path, size, mtime) in entries]
+
+    if media_type == 'picture':
+        exts = _PICTURE_EXTS
+
+    else:  # media_type == 'movie'
+        exts = _MOVIE_EXTS
+
+    media_files = _list_media_files(target_dir, exts=exts, prefix=prefix)
+
+    if since is not None:
+        media_files = [(p, st) for (p, st) in media_files if st.st_mtime >= since]
+
+    if until is not None:
+        media_files = [(p, st) for (p, st) in media_files if st.st_mtime < until]
+
+    if cursor is not None or limit is not None:
+        # same ordering as the one used by the media index
+        def sort_key(m):
+            return m[1].st_mtime, os.path.relpath(m[0], target_dir)
+
+        media_files.sort(key=sort_key, reverse=True)
+        if cursor is not None:
+            media_files = [m for m in media_files if sort_key(m) < cursor]
+
+        if limit is not None:
+            media_files = media_files[:limit]
+
+    return media_files
+
+
+def _make_media_list_entry(target_dir, full_path, st):
+    import mimetypes
+
+    path = full_path[len(target_dir):]
+    if not path.startswith('/'):
+        path = '/' + path
+
+    timestamp = st.st_mtime
+    size = st.st_size
+    mime_type = mimetypes.guess_type(path)[0]
+
+    return {
+        'path': path,
+        'mimeType': mime_type if mime_type is not None else 'video/mpeg',
+        'momentStr': utils.pretty_date_time(datetime.datetime.fromtimestamp(timestamp)),
+        'momentStrShort': utils.pretty_date_time(datetime.datetime.fromtimestamp(timestamp), short=True),
+        'sizeStr': utils.pretty_size(size),
+        'timestamp': timestamp
+    }
+
+
+def _run_listing_process(func, callback, what, timeout=None):
+    # runs func(send) in a subprocess, collecting everything passed to send();
+    # callback is called with the collected list, or with None on timeout
+
+    def do_list(pipe):
+        parent_pipe.close()
+        func(pipe.send)
+        pipe.close()
+
+    logging.debug('starting %(what)s listing process...' % {'what': what})
+
+    (parent_pipe, child_pipe) = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=do_list, args=(child_pipe,))
+    process.start()
+    child_pipe.close()
+
+    # poll the subprocess to see when it has finished
+    started = datetime.datetime.now()
+    timeout = timeout or settings.LIST_MEDIA_TIMEOUT
+    result = []
+
+    def read_result():
+        while parent_pipe.poll():
+            try:
+                result.append(parent_pipe.recv())
+
+            except EOFError:
+                break
+
+    def poll_process():
+        io_loop = IOLoop.instance()
+        if process.is_alive():  # not finished yet
+            now = datetime.datetime.now()
+            delta = now - started
+            if delta.seconds < timeout:
+                io_loop.add_timeout(datetime.timedelta(seconds=0.5), poll_process)
+                read_result()
+
+            else:  # process did not finish in time
+                logging.error('timeout waiting for the %(what)s listing process to finish' % {'what': what})
+                metrics.observe('media_listing_seconds', delta.total_seconds(), kind=what)
+                try:
+                    os.kill(process.pid, signal.SIGTERM)
+
+                except:
+                    pass  # nevermind
+
+                callback(None)
+
+        else:  # finished
+            read_result()
+            logging.debug('%(what)s listing process has returned %(count)s entries' % {
+                    'what': what, 'count': len(result)})
+            metrics.observe('media_listing_seconds', (datetime.datetime.now() - started).total_seconds(), kind=what)
+            callback(result)
+
+    poll_process()
+
+
+def _remove_older_files(camera_config, moment, exts):
+    directory = camera_config.get('target_dir')
+    dir_paths = set()
     for (full_path, st) in _list_media_files(directory, exts):
         file_moment = datetime.datetime.fromtimestamp(st.st_mtime)
         if file_moment < moment:
@@ -158,6 +298,7 @@ def _remove_older_files(directory, moment, exts):
             # remove the file itself
             try:
                 os.remove(full_path)
+                mediaindex.remove_file(camera_config, full_path)
             
             except OSError as e:
                 if e.errno == errno.ENOENT:
@@ -166,31 +307,203 @@ def _remove_older_files(directory, moment, exts):
                 else:
                     logging.error('failed to remove %s: %s' % (full_path, e))
 
-            # remove the parent directories if empty or contain only thumb files
-            dir_path = os.path.dirname(full_path)
-            if not os.path.exists(dir_path):
-                continue
-            
-            listing = os.listdir(dir_path)
-            thumbs = [l for l in listing if l.endswith('.thumb')]
-            
-            if len(listing) == len(thumbs):  # only thumbs
-                for p in thumbs:
-                    try:
-                        os.remove(os.path.join(dir_path, p))
-                    
-                    except:
-                        logging.error('failed to remove %s: %s' % (p, e))
-
-            if not listing or len(listing) == len(thumbs):
-                # this will possibly cause following paths that are in the media files for loop
-                # to be removed in advance; the os.remove call will raise ENOENT which is silently ignored 
-                logging.debug('removing empty directory %(path)s...' % {'path': dir_path})
-                try:
-                    os.removedirs(dir_path)
-                
-                except:
-                    logging.error('failed to remove %s: %s' % (dir_path, e))
+            dir_paths.add(os.path.dirname(full_path))
+
+    # the parent directories are only checked once all the files have been removed
+    for dir_path in sorted(dir_paths, reverse=True):
+        _remove_dir_if_empty(dir_path)
+
+
+def _remove_expired_files(camera_config, media_type, moment, deadline=None):
+    # removes the expired files oldest first, as listed by the media index;
+    # whole groups (date directories) are removed at once when all their files expired;
+    # returns False if the deadline was reached or the media index could not be updated
+    # before all the expired files were removed, or None if the media index cannot be used for this camera
+
+    until = time.mktime(moment.timetuple())
+
+    groups = mediaindex.list_expired_groups(camera_config, media_type, until)
+    if groups is None:
+        return None
+
+    for group in groups:
+        if deadline and time.time() > deadline:
+            return False
+
+        _remove_group_dir(camera_config, media_type, group, until)
+
+    last_paths = None
+    while True:
+        if deadline and time.time() > deadline:
+            return False
+
+        paths = mediaindex.list_expired_files(camera_config, media_type, until, _CLEANUP_BATCH_SIZE)
+        if paths is None:
+            return None
+
+        if not paths:
+            return True
+
+        if paths == last_paths:  # the index did not change, even though it was updated successfully
+            logging.error('expired files are still listed by the media index of camera %(id)s, '
+                          'stopping cleanup' % {'id': camera_config['@id']})
+
+            return False
+
+        # the pass is stopped (and continued later) rather than listing the same files again and again,
+        # e.g. while the index is locked by the reconcile process
+        if not _remove_indexed_files(camera_config, [(p, media_type) for p in paths]):
+            return False
+
+        last_paths = paths
+
+
+def _remove_indexed_files(camera_config, entries):
+    # removes a batch of (relative path, media type) entries of the media index, along with their files
+    target_dir = camera_config.get('target_dir')
+    dir_paths = set()
+    for (path, media_type) in entries:
+        full_path = os.path.join(target_dir, path)
+        logging.debug('removing file %(path)s...' % {'path': full_path})
+
+        remove_paths = [full_path]
+        if media_type == 'movie':
+            remove_paths.append(full_path + '.thumb')
+
+        for p in remove_paths:
+            try:
+                os.remove(p)
+
+            except OSError as e:
+                if e.errno != errno.ENOENT:  # the file might have been removed in the meantime
+                    logging.error('failed to remove %s: %s' % (p, e))
+
+        dir_paths.add(os.path.dirname(full_path))
+
+    for dir_path in sorted(dir_paths, reverse=True):
+        if os.path.normpath(dir_path) != os.path.normpath(target_dir):
+            _remove_dir_if_empty(dir_path)
+
+    # files that could not be removed are dropped from the index anyway, so that they don't stall
+    # the cleanup; the next reconcile pass of the index adds them back;
+    # returns False if the index could not be updated
+    return mediaindex.remove_files(camera_config, [path for (path, media_type) in entries])
+
+
+def _list_quota_files(camera_config, needed):
+    # returns the oldest indexed (relative path, media type) entries that add up to the needed size,
+    # in a single batch of at most _QUOTA_BATCH_SIZE entries
+    rows = mediaindex.list_oldest_files(camera_config, _QUOTA_BATCH_SIZE) or []
+    entries = []
+    for (path, media_type, size) in rows:
+        entries.append((path, media_type))
+        needed -= size
+        if needed <= 0:
+            break
+
+    return entries
+
+
+def _remove_group_dir(camera_config, media_type, group, until):
+    # removes a group directory with a single rmtree, as long as it contains only expired media files
+    # (and the thumbnails of its movies); files that are not indexed yet are checked here as well
+    dir_path = os.path.join(camera_config.get('target_dir'), group)
+    try:
+        listing = os.listdir(dir_path)
+
+    except OSError as e:
+        if e.errno == errno.ENOENT:  # already gone
+            mediaindex.remove_group(camera_config, group, media_type)
+
+        else:
+            logging.error('failed to list %s: %s' % (dir_path, e))
+
+        return
+
+    names = set(listing)
+    for name in listing:
+        if name.startswith('.'):
+            return  # leave it to the file by file removal
+
+        if media_type == 'movie' and name.endswith('.thumb') and name[:-6] in names:
+            media_name = name[:-6]
+
+        else:
+            media_name = name
+
+        if get_media_type(media_name) != media_type:
+            return
+
+        try:
+            st = os.lstat(os.path.join(dir_path, name))
+
+        except OSError as e:
+            logging.error('stat failed: %s' % e)
+            return
+
+        if not stat.S_ISREG(st.st_mode) or st.st_mtime >= until:
+            return
+
+    logging.debug('removing expired directory %(path)s...' % {'path': dir_path})
+    try:
+        shutil.rmtree(dir_path)
+
+    except OSError as e:
+        logging.error('failed to remove %s: %s' % (dir_path, e))
+        return
+
+    mediaindex.remove_group(camera_config, group, media_type)
+
+    _remove_dir_if_empty(os.path.dirname(dir_path))
+
+
+def _remove_dir_if_empty(dir_path):
+    # removes the directory (and its empty parents) if empty or contains only thumb files
+    if not os.path.exists(dir_path):
+        return
+
+    listing = os.listdir(dir_path)
+    thumbs = [l for l in listing if l.endswith('.thumb')]
+
+    if len(listing) == len(thumbs):  # only thumbs
+        for p in thumbs:
+            try:
+                os.remove(os.path.join(dir_path, p))
+
+            except Exception as e:
+                logging.error('failed to remove %s: %s' % (p, e))
+
+    if not listing or len(listing) == len(thumbs):
+        logging.debug('removing empty directory %(path)s...' % {'path': dir_path})
+        try:
+            os.removedirs(dir_path)
+
+        except Exception as e:
+            logging.error('failed to remove %s: %s' % (dir_path, e))
+
+
+def _make_thumbnail(image, width, height, resample):
+    # JPEG images can be decoded directly at 1/2, 1/4 or 1/8 of their size,
+    # which is a lot faster than decoding them at full resolution
+    factor = settings.RESIZE_DRAFT_FACTOR
+    if factor:
+        image.draft(None, (width * factor, height * factor))
+
+    else:
+        image.load()  # prevents thumbnail() from choosing the draft scale by itself
+
+    image.thumbnail((width, height), resample)
+
+
+def get_media_type(path):
+    path_lower = path.lower()
+    if [e for e in _PICTURE_EXTS if path_lower.endswith(e)]:
+        return 'picture'
+
+    if [e for e in _MOVIE_EXTS if path_lower.endswith(e)]:
+        return 'movie'
+
+    return None
 
 
 def find_ffmpeg():
@@ -258,7 +571,8 @@ def find_ffmpeg():
     return _ffmpeg_binary_cache
 
 
-def cleanup_media(media_type):
+def cleanup_media(media_type, deadline=None):
+    # returns False if the deadline was reached before all the expired files were removed
     logging.debug('cleaning up %(media_type)ss...' % {'media_type': media_type})
     
     if media_type == 'picture':
@@ -292,7 +606,114 @@ def cleanup_media(media_type):
             # create a sentinel file to make sure the target dir is never removed
             open(os.path.join(target_dir, '.keep'), 'w').close()
 
-        _remove_older_files(target_dir, preserve_moment, exts=exts)
+        done = _remove_expired_files(camera_config, media_type, preserve_moment, deadline)
+        if done is None:  # media index not usable
+            _remove_older_files(camera_config, preserve_moment, exts=exts)
+
+        elif not done:
+            return False
+
+    return True
+
+
+def get_volume_camera_configs(camera_config):
+    # returns the configs of the local cameras whose media files reside on the same volume as the given camera
+    try:
+        dev = os.stat(camera_config['target_dir']).st_dev
+
+    except OSError:
+        return []
+
+    camera_configs = []
+    for camera_id in config.get_camera_ids():
+        other_config = config.get_camera(camera_id)
+        if not utils.is_local_motion_camera(other_config):
+            continue
+
+        try:
+            if os.stat(other_config['target_dir']).st_dev == dev:
+                camera_configs.append(other_config)
+
+        except OSError:
+            pass
+
+    return camera_configs
+
+
+def enforce_storage_quota(camera_config, volume_camera_configs):
+    # removes the oldest media files of the camera while it exceeds its maximum storage,
+    # then the oldest media files of the cameras on the same volume while its free space is below
+    # MIN_FREE_SPACE; requires the media index, so that the cost depends only on what is removed;
+    # returns the number of removed files
+
+    camera_id = camera_config['@id']
+    target_dir = camera_config['target_dir']
+    removed = 0
+
+    max_storage = camera_config.get('@max_storage')
+    if max_storage:
+        limit = int(max_storage * 1024 * 1024 * 1024)
+        while True:
+            total = mediaindex.get_total_size(camera_config)
+            if total is None or total <= limit:
+                break
+
+            entries = _list_quota_files(camera_config, total - limit)
+            if not entries:
+                break
+
+            logging.debug('camera %(id)s uses %(total)s bytes, more than its %(limit)s bytes quota, '
+                          'removing %(count)s files...' % {
+                    'id': camera_id, 'total': total, 'limit': limit, 'count': len(entries)})
+
+            removed += len(entries)
+            if not _remove_indexed_files(camera_config, entries):
+                break  # the index could not be updated, the same files would be listed again
+
+    if settings.MIN_FREE_SPACE and volume_camera_configs:
+        while True:
+            usage = utils.get_disk_usage(target_dir)
+            if not usage:
+                break
+
+            (used_size, total_size) = usage
+            needed = total_size * settings.MIN_FREE_SPACE / 100.0 - (total_size - used_size)
+            if needed <= 0:
+                break
+
+            # the camera that holds the oldest file of the volume gives it up first
+            oldest = []
+            for c in volume_camera_configs:
+                mtime = mediaindex.get_oldest_mtime(c)
+                if mtime:
+                    oldest.append((mtime, c))
+
+            if not oldest:
+                logging.warning('free space on the volume of %(dir)s is below %(min)s%%, '
+                                'but there are no more media files to remove' % {
+                        'dir': target_dir, 'min': settings.MIN_FREE_SPACE})
+
+                break
+
+            other_config = min(oldest)[1]
+            entries = _list_quota_files(other_config, needed)
+            if not entries:
+                break
+
+            logging.debug('free space on the volume of %(dir)s is below %(min)s%%, '
+                          'removing %(count)s files of camera %(id)s...' % {
+                    'dir': target_dir, 'min': settings.MIN_FREE_SPACE, 'count': len(entries),
+                    'id': other_config['@id']})
+
+            removed += len(entries)
+            if not _remove_indexed_files(other_config, entries):
+                break
+
+    if removed:
+        logging.info('removed %(count)s media files to enforce the storage quotas of camera %(id)s' % {
+                'count': removed, 'id': camera_id})
+
+    return removed
 
 
 def make_movie_preview(camera_config, full_path):
@@ -363,84 +784,92 @@ def make_movie_preview(camera_config, full_path):
     return thumb_path
 
 
-def list_media(camera_config, media_type, callback, prefix=None):
+def list_media(camera_config, media_type, callback, prefix=None, since=None, until=None, cursor=None, limit=None):
     target_dir = camera_config.get('target_dir')
 
-    if media_type == 'picture':
-        exts = _PICTURE_EXTS
-        
-    elif media_type == 'movie':
-        exts = _MOVIE_EXTS
+    # a page of entries can be served right away by the media index,
+    # without spawning a listing process
+    if limit is not None and mediaindex.is_ready(camera_config):
+        mf = _list_camera_media_files(camera_config, media_type, prefix=prefix,
+                                      since=since, until=until, cursor=cursor, limit=limit)
+        media_list = [_make_media_list_entry(target_dir, p, st) for (p, st) in mf]
+        logging.debug('media index has returned %(count)s files' % {'count': len(media_list)})
 
-    # create a subprocess to retrieve media files
-    def do_list_media(pipe):
-        import mimetypes
-        parent_pipe.close()
+        return callback(media_list)
 
-        mf = _list_media_files(target_dir, exts=exts, prefix=prefix)
+    # create a subprocess to retrieve media files
+    def do_list_media(send):
+        mf = _list_camera_media_files(camera_config, media_type, prefix=prefix,
+                                      since=since, until=until, cursor=cursor, limit=limit)
         for (p, st) in mf:
-            path = p[len(target_dir):]
-            if not path.startswith('/'):
-                path = '/' + path
+            send(_make_media_list_entry(target_dir, p, st))
 
-            timestamp = st.st_mtime
-            size = st.st_size
+    _run_listing_process(do_list_media, callback, 'media')
 
-            pipe.send({
-                'path': path,
-                'mimeType': mimetypes.guess_type(path)[0] if mimetypes.guess_type(path)[0] is not None else 'video/mpeg',
-                'momentStr': utils.pretty_date_time(datetime.datetime.fromtimestamp(timestamp)),
-                'momentStrShort': utils.pretty_date_time(datetime.datetime.fromtimestamp(timestamp), short=True),
-                'sizeStr': utils.pretty_size(size),
-                'timestamp': timestamp
-            })
 
-        pipe.close()
-    
-    logging.debug('starting media listing process...')
-    
-    (parent_pipe, child_pipe) = multiprocessing.Pipe(duplex=False)
-    process = multiprocessing.Process(target=do_list_media, args=(child_pipe,))
-    process.start()
-    child_pipe.close()
-    
-    # poll the subprocess to see when it has finished
-    started = datetime.datetime.now()
-    media_list = []
+def list_media_groups(camera_config, media_type, callback):
+    def make_groups(entries):
+        groups = {}
+        for (path, size, mtime) in entries:
+            group = groups.setdefault(os.path.dirname(path), [0, 0, 0])
+            group[0] += 1
+            group[1] += size
+            group[2] = max(group[2], mtime)
 
-    def read_media_list():
-        while parent_pipe.poll():
-            try:
-                media_list.append(parent_pipe.recv())
+        return [(name, count, size, mtime) for (name, (count, size, mtime)) in groups.iteritems()]
 
-            except EOFError:
-                break
+    def make_group_entry(name, count, size, mtime):
+        return {
+            'group': name,
+            'count': count,
+            'size': size,
+            'timestamp': mtime
+        }
 
-    def poll_process():
-        io_loop = IOLoop.instance()
-        if process.is_alive():  # not finished yet
-            now = datetime.datetime.now()
-            delta = now - started
-            if delta.seconds < settings.LIST_MEDIA_TIMEOUT:
-                io_loop.add_timeout(datetime.timedelta(seconds=0.5), poll_process)
-                read_media_list()
+    def on_groups(groups):
+        if groups is not None:
+            groups.sort(key=lambda g: g['group'], reverse=True)
 
-            else:  # process did not finish in time
-                logging.error('timeout waiting for the media listing process to finish')
-                try:
-                    os.kill(process.pid, signal.SIGTERM)
+        callback(groups)
 
-                except:
-                    pass  # nevermind
+    groups = mediaindex.list_groups(camera_config, media_type)
+    if groups is not None:
+        return on_groups([make_group_entry(*g) for g in groups])
 
-                callback(None)
+    # no media index available yet, the target directory has to be walked
+    target_dir = camera_config.get('target_dir')
 
-        else:  # finished
-            read_media_list()
-            logging.debug('media listing process has returned %(count)s files' % {'count': len(media_list)})
-            callback(media_list)
-    
-    poll_process()
+    def do_list_groups(send):
+        mf = _list_camera_media_files(camera_config, media_type)
+        entries = [(os.path.relpath(p, target_dir), st.st_size, st.st_mtime) for (p, st) in mf]
+        for g in make_groups(entries):
+            send(make_group_entry(*g))
+
+    _run_listing_process(do_list_groups, on_groups, 'media group')
+
+
+def make_media_list_cursor(entry):
+    return '%r:%s' % (entry['timestamp'], entry['path'].lstrip('/'))
+
+
+def parse_media_list_cursor(cursor):
+    # raises ValueError if the cursor is malformed
+    timestamp, path = cursor.split(':', 1)
+
+    return float(timestamp), path
+
+
+def paginate_media_list(media_list, limit):
+    # media_list is expected to be listed with limit + 1 entries,
+    # so that the existence of a following page can be detected;
+    # returns a (page, next cursor) tuple
+
+    if limit is None or len(media_list) <= limit:
+        return media_list, None
+
+    media_list = media_list[:limit]
+
+    return media_list, make_media_list_cursor(media_list[-1])
 
 
 def get_media_path(camera_config, path, media_type):
@@ -465,317 +894,405 @@ def get_media_content(camera_config, path, media_type):
         return None
 
 
-def get_zipped_content(camera_config, media_type, group, callback):
+def get_zipped_files(camera_config, media_type, group, callback):
+    # only the list of files is prepared here, the archive itself
+    # is generated on the fly by iter_zipped_content(), while downloading
     target_dir = camera_config.get('target_dir')
 
-    if media_type == 'picture':
-        exts = _PICTURE_EXTS
-        
-    elif media_type == 'movie':
-        exts = _MOVIE_EXTS
-        
-    working = multiprocessing.Value('b')
-    working.value = True
-
-    # create a subprocess to add files to zip
-    def do_zip(pipe):
-        parent_pipe.close()
-
-        mf = _list_media_files(target_dir, exts=exts, prefix=group)
-        paths = []
+    def do_list_files(send):
+        mf = _list_camera_media_files(camera_config, media_type, prefix=group)
         for (p, st) in mf:  # @UnusedVariable
             path = p[len(target_dir):]
             if path.startswith('/'):
                 path = path[1:]
 
-            paths.append(path)
-            
-        zip_filename = os.path.join(settings.MEDIA_PATH, '.zip-%s' % int(time.time()))
-        logging.debug('adding %d files to zip file "%s"' % (len(paths), zip_filename))
+            send((p, path))
 
-        try:
-            with zipfile.ZipFile(zip_filename, mode='w') as f:
-                for path in paths:
-                    full_path = os.path.join(target_dir, path)
-                    f.write(full_path, path)
+    _run_listing_process(do_list_files, callback, 'zip file', timeout=settings.ZIP_TIMEOUT)
 
-        except Exception as e:
-            logging.error('failed to create zip file "%s": %s' % (zip_filename, e))
 
-            working.value = False
-            pipe.close()
-            return
+def iter_zipped_content(files):
+    # generates a store-only (uncompressed) zip archive, piece by piece, out of a list of
+    # (full path, archive path) tuples, or (data, archive path, mtime) tuples for in-memory contents;
+    # the CRC of each file is computed while reading it and is placed in a data descriptor,
+    # so that each file is read only once;
+    # zip64 records are used whenever the archive outgrows the classic zip format limits
 
-        logging.debug('reading zip file "%s" into memory' % zip_filename)
+    started = time.time()
+    offset = 0
+    entries = []
+    for item in files:
+        if len(item) == 3:  # in-memory content
+            data, path, mtime = item
+            f = StringIO.StringIO(data)
+            size = len(data)
+
+        else:
+            full_path, path = item
+            try:
+                f = open(full_path, 'rb')
+                st = os.fstat(f.fileno())
 
+            except (IOError, OSError) as e:
+                logging.error('failed to add file "%s" to zip: %s' % (full_path, e))
+                continue
+
+            size = st.st_size
+            mtime = st.st_mtime
+
+        if isinstance(path, unicode):
+            path = path.encode('utf8')
+
+        flags = 0x08  # crc and sizes are (also) found in the data descriptor
         try:
-            with open(zip_filename, mode='r') as f:
-                data = f.read()
+            path.decode('ascii')
 
-            working.value = False
-            pipe.send(data)
-            logging.debug('zip data ready')
+        except UnicodeDecodeError:
+            flags |= 0x800  # utf8 file name
 
-        except Exception as e:
-            logging.error('failed to read zip file "%s": %s' % (zip_filename, e))
-            working.value = False
+        try:
+            dos_time, dos_date = _zip_dos_time(mtime)
+
+            zip64 = size >= _ZIP_32BIT_LIMIT
+            extra = ''
+            if zip64:
+                extra = struct.pack('<HHQQ', 0x0001, 16, size, size)
+
+            header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, flags, 0, dos_time, dos_date, 0,
+                                 0xFFFFFFFF if zip64 else size, 0xFFFFFFFF if zip64 else size,
+                                 len(path), len(extra)) + path + extra
+
+            yield header
+
+            crc = 0
+            remaining = size
+            while remaining > 0:
+                data = f.read(min(_ZIP_CHUNK_SIZE, remaining))
+                if not data:  # the file has shrunk in the meantime, pad it to the announced size
+                    data = '\0' * min(_ZIP_CHUNK_SIZE, remaining)
+
+                crc = zlib.crc32(data, crc)
+                remaining -= len(data)
+
+                yield data
+
+            crc &= 0xFFFFFFFF
+
+            if zip64:
+                descriptor = struct.pack('<IIQQ', 0x08074b50, crc, size, size)
+
+            else:
+                descriptor = struct.pack('<IIII', 0x08074b50, crc, size, size)
+
+            yield descriptor
 
         finally:
-            os.remove(zip_filename)
-            pipe.close()
+            f.close()
 
-    logging.debug('starting zip process...')
+        entries.append((path, flags, crc, size, dos_time, dos_date, offset))
+        offset += len(header) + size + len(descriptor)
 
-    (parent_pipe, child_pipe) = multiprocessing.Pipe(duplex=False)
-    process = multiprocessing.Process(target=do_zip, args=(child_pipe, ))
-    process.start()
-    child_pipe.close()
+    logging.debug('zipped %(count)s files, %(size)s bytes' % {'count': len(entries), 'size': offset})
 
-    # poll the subprocess to see when it has finished
-    started = datetime.datetime.now()
+    # central directory
+    cd_offset = offset
+    cd_size = 0
+    for (path, flags, crc, size, dos_time, dos_date, header_offset) in entries:
+        zip64_fields = []
+        if size >= _ZIP_32BIT_LIMIT:
+            zip64_fields += [size, size]
+            size = 0xFFFFFFFF
 
-    def poll_process():
-        io_loop = IOLoop.instance()
-        if working.value:
-            now = datetime.datetime.now()
-            delta = now - started
-            if delta.seconds < settings.ZIP_TIMEOUT:
-                io_loop.add_timeout(datetime.timedelta(seconds=0.5), poll_process)
+        if header_offset >= _ZIP_32BIT_LIMIT:
+            zip64_fields.append(header_offset)
+            header_offset = 0xFFFFFFFF
 
-            else:  # process did not finish in time
-                logging.error('timeout waiting for the zip process to finish')
-                try:
-                    os.kill(process.pid, signal.SIGTERM)
-                
-                except:
-                    pass  # nevermind
+        extra = ''
+        version = 20
+        if zip64_fields:
+            extra = struct.pack('<HH%dQ' % len(zip64_fields), 0x0001, 8 * len(zip64_fields), *zip64_fields)
+            version = 45
 
-                callback(None)
+        record = struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 0x0300 | version, version, flags, 0,
+                             dos_time, dos_date, crc, size, size, len(path), len(extra), 0, 0, 0,
+                             0100644 << 16, header_offset) + path + extra
 
-        else:  # finished
-            try:
-                data = parent_pipe.recv()
-                logging.debug('zip process has returned %d bytes' % len(data))
-                
-            except:
-                data = None
-            
-            callback(data)
+        cd_size += len(record)
 
-    poll_process()
+        yield record
+
+    count = len(entries)
+    if count >= 0xFFFF or cd_offset >= _ZIP_32BIT_LIMIT or cd_size >= _ZIP_32BIT_LIMIT:
+        yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset)
+        yield struct.pack('<IIQI', 0x07064b50, 0, cd_offset + cd_size, 1)
+
+        count, cd_size, cd_offset = 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF
+
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0)
+
+    metrics.observe('zip_seconds', time.time() - started)
+    metrics.inc('zip_bytes_total', offset + cd_size)
+
+
+def _zip_dos_time(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # zip dates can't go before 1980-01-01
+
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+    return dos_time, dos_date
 
 
 def make_timelapse_movie(camera_config, framerate, interval, group):
-    global _timelapse_process
-    global _timelapse_data
-    
-    target_dir = camera_config.get('target_dir')
+    # starts a timelapse job; jobs are identified by camera, group, framerate and interval,
+    # so that different timelapse movies can be created at the same time
+    job_key = (camera_config['@id'], group, framerate, interval)
+    job = _timelapse_jobs.get(job_key)
+    if job and not job['done']:
+        return  # already running
+
     codec = camera_config.get('ffmpeg_video_codec')
-    
     codec = FFMPEG_CODEC_MAPPING.get(codec, codec)
     fmt = FFMPEG_FORMAT_MAPPING.get(codec, codec)
 
-    # create a subprocess to retrieve media files
-    def do_list_media(pipe):
+    progress = multiprocessing.Value('d')
+    progress.value = 0
+
+    # this will be executed in a separate subprocess
+    def do_make_timelapse(pipe):
         parent_pipe.close()
 
-        mf = _list_media_files(target_dir, exts=_PICTURE_EXTS, prefix=group)
-        for (p, st) in mf:
-            timestamp = st.st_mtime
+        mf = _list_camera_media_files(camera_config, 'picture', prefix=group)
+        media_list = [{'path': p, 'timestamp': st.st_mtime, 'size': st.st_size} for (p, st) in mf]
+        if not media_list:
+            logging.error('no pictures to make the timelapse movie of')
+            return
 
-            pipe.send({
-                'path': p,
-                'timestamp': timestamp
-            })
+        pictures = _select_timelapse_pictures(media_list, interval)
 
+        # movies are cached on disk, as long as the selected pictures don't change
+        job_digest = hashlib.sha1(repr(job_key + (codec, fmt))).hexdigest()[:16]
+        selection_digest = hashlib.sha1(repr([(p['path'], p['timestamp'], p['size']) for p in pictures])).hexdigest()
+        path = os.path.join(_get_timelapse_cache_dir(), '%s-%s-%s.avi' % (
+                camera_config['@id'], job_digest, selection_digest[:16]))
+
+        pipe.send(path)
         pipe.close()
 
-    logging.debug('starting media listing process...')
-    
-    (parent_pipe, child_pipe) = multiprocessing.Pipe(duplex=False)
-    _timelapse_process = multiprocessing.Process(target=do_list_media, args=(child_pipe, ))
-    _timelapse_process.progress = 0
-    _timelapse_process.start()
-    _timelapse_data = None
+        if os.path.exists(path):
+            logging.debug('using cached timelapse movie "%s"' % path)
+            os.utime(path, None)
+            progress.value = 1
 
-    child_pipe.close()
+            return
 
-    started = [datetime.datetime.now()]
-    media_list = []
-    
-    tmp_filename = os.path.join(settings.MEDIA_PATH, '.%s.avi' % int(time.time()))
+        tmp_path = path + '.tmp'
+        cmd = ['ffmpeg', '-y', '-framerate', str(framerate), '-f', 'image2pipe', '-vcodec', 'mjpeg', '-i', '-',
+               '-vcodec', codec, '-format', fmt, '-b:v', '9999999', '-qscale:v', '0.1', '-f', 'avi', tmp_path]
+
+        logging.debug('executing "%s"' % ' '.join(cmd))
+
+        # the pictures are fed to ffmpeg one by one, through its stdin
+        ffmpeg = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=utils.DEV_NULL, stderr=utils.DEV_NULL)
+        try:
+            for i, picture in enumerate(pictures):
+                try:
+                    with open(picture['path'], 'rb') as f:
+                        shutil.copyfileobj(f, ffmpeg.stdin)
+
+                except IOError as e:
+                    if e.errno == errno.EPIPE:
+                        raise  # ffmpeg has died
+
+                    logging.error('failed to read picture "%s": %s' % (picture['path'], e))
+
+                # the last percent is reserved for ffmpeg to finish writing the movie
+                progress.value = max(0.01, 0.99 * (i + 1) / len(pictures))
+
+            ffmpeg.stdin.close()
+
+        except IOError as e:
+            logging.error('failed to feed pictures to ffmpeg: %s' % e)
+
+        if ffmpeg.wait() != 0:
+            logging.error('ffmpeg process failed')
 
-    def read_media_list():
-        while parent_pipe.poll():
             try:
-                media_list.append(parent_pipe.recv())
+                os.remove(tmp_path)
 
-            except EOFError:
-                break
-        
-    def poll_media_list_process():
-        io_loop = IOLoop.instance()
-        if _timelapse_process.is_alive():  # not finished yet
-            now = datetime.datetime.now()
-            delta = now - started[0]
-            if delta.seconds < settings.TIMELAPSE_TIMEOUT:  # the subprocess has limited time to complete its job
-                io_loop.add_timeout(datetime.timedelta(seconds=0.5), poll_media_list_process)
-                read_media_list()
+            except:
+                pass
 
-            else:  # process did not finish in time
-                logging.error('timeout waiting for the media listing process to finish')
-                try:
-                    os.kill(_timelapse_process.pid, signal.SIGTERM)
-                
-                except:
-                    pass  # nevermind
+            return
 
-                _timelapse_process.progress = -1
+        os.rename(tmp_path, path)
+        progress.value = 1
 
-        else:  # finished
-            read_media_list()
-            logging.debug('media listing process has returned %(count)s files' % {'count': len(media_list)})
-            
-            if not media_list:
-                _timelapse_process.progress = -1
-                
-                return
-
-            pictures = select_pictures(media_list)
-            make_movie(pictures)
-
-    def select_pictures(media_list):
-        media_list.sort(key=lambda e: e['timestamp'])
-        start = media_list[0]['timestamp']
-        slices = {}
-        max_idx = 0
-        for m in media_list:
-            offs = m['timestamp'] - start
-            pos = float(offs) / interval - 0.5
-            idx = int(round(pos))
-            max_idx = idx
-            m['delta'] = abs(pos - idx)
-            slices.setdefault(idx, []).append(m)
-
-        selected = []
-        for i in xrange(max_idx + 1):
-            s = slices.get(i)
-            if not s:
-                continue
+        logging.debug('timelapse movie "%s" ready' % path)
 
-            selected.append(min(s, key=lambda m: m['delta']))
+    logging.debug('starting timelapse process...')
 
-        logging.debug('selected %d/%d media files' % (len(selected), len(media_list)))
-        
-        return selected
+    (parent_pipe, child_pipe) = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=do_make_timelapse, args=(child_pipe,))
+    process.start()
+    child_pipe.close()
 
-    def make_movie(pictures):
-        global _timelapse_process
+    job = _timelapse_jobs[job_key] = {
+        'process': process,
+        'pipe': parent_pipe,
+        'progress': progress,
+        'last_progress': 0,
+        'started': time.time(),
+        'last_progress_time': time.time(),
+        'path': None,
+        'done': False
+    }
 
-        cmd = 'rm -f %(tmp_filename)s;'
-        cmd += 'cat %(jpegs)s | ffmpeg -framerate %(framerate)s -f image2pipe -vcodec mjpeg -i - -vcodec %(codec)s ' \
-               '-format %(format)s -b:v %(bitrate)s -qscale:v 0.1 -f avi %(tmp_filename)s'
+    _poll_timelapse_job(job_key, job)
 
-        bitrate = 9999999
 
-        cmd = cmd % {
-            'tmp_filename': tmp_filename,
-            'jpegs': ' '.join((('"' + p['path'] + '"') for p in pictures)),
-            'framerate': framerate,
-            'codec': codec,
-            'format': fmt,
-            'bitrate': bitrate
-        }
-        
-        logging.debug('executing "%s"' % cmd)
+def check_timelapse_movie(camera_config, framerate, interval, group):
+    # returns the progress of the timelapse job (-1 if not running)
+    # and the path to the resulting movie file, once ready
+    job_key = (camera_config['@id'], group, framerate, interval)
+    job = _timelapse_jobs.get(job_key)
+    if job is None and framerate is None and interval is None:
+        # older clients don't tell the framerate and interval, use the latest job of the group
+        jobs = [j for (k, j) in _timelapse_jobs.iteritems() if k[:2] == job_key[:2]]
+        job = jobs and max(jobs, key=lambda j: j['started'])
 
-        _timelapse_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-        _timelapse_process.progress = 0.01  # 1%
-        
-        # make subprocess stdout pipe non-blocking
-        fd = _timelapse_process.stdout.fileno()
-        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+    if not job:
+        return {'progress': -1, 'path': None}
 
-        poll_movie_process(pictures)
+    if not job['done']:
+        return {'progress': job['progress'].value, 'path': None}
 
-    def poll_movie_process(pictures):
-        global _timelapse_process
-        global _timelapse_data
-        
-        io_loop = IOLoop.instance()
-        if _timelapse_process.poll() is None:  # not finished yet
-            io_loop.add_timeout(datetime.timedelta(seconds=0.5), functools.partial(poll_movie_process, pictures))
+    return {'progress': -1, 'path': job['path']}
 
-            try:
-                output = _timelapse_process.stdout.read()
-            
-            except IOError as e:
-                if e.errno == errno.EAGAIN:
-                    output = ''
-                
-                else:
-                    raise
-                
-            frame_index = re.findall('frame=\s*(\d+)', output)
-            try:
-                frame_index = int(frame_index[-1])
-            
-            except (IndexError, ValueError):
-                return
 
-            _timelapse_process.progress = max(0.01, float(frame_index) / len(pictures))
-            
-            logging.debug('timelapse progress: %s' % int(100 * _timelapse_process.progress))
+def _poll_timelapse_job(job_key, job):
+    io_loop = IOLoop.instance()
+    process = job['process']
 
-        else:  # finished
-            exit_code = _timelapse_process.poll()
-            _timelapse_process = None
-            
-            if exit_code != 0:
-                logging.error('ffmpeg process failed')
-                _timelapse_data = None
+    if job['path'] is None and job['pipe'].poll():
+        try:
+            job['path'] = job['pipe'].recv()
 
-                try:
-                    os.remove(tmp_filename)
+        except EOFError:
+            pass
 
-                except:
-                    pass
+    if process.is_alive():  # not finished yet
+        now = time.time()
+        progress = job['progress'].value
+        if progress != job['last_progress']:
+            job['last_progress'] = progress
+            job['last_progress_time'] = now
+            logging.debug('timelapse progress: %s' % int(100 * progress))
 
-            else:
-                logging.debug('reading timelapse movie file "%s" into memory' % tmp_filename)
-    
-                try:
-                    with open(tmp_filename, mode='r') as f:
-                        _timelapse_data = f.read()
-    
-                    logging.debug('timelapse movie process has returned %d bytes' % len(_timelapse_data))
-    
-                except Exception as e:
-                    logging.error('failed to read timelapse movie file "%s": %s' % (tmp_filename, e))
-    
-                finally:
-                    try:
-                        os.remove(tmp_filename)
+        if now - job['last_progress_time'] < settings.TIMELAPSE_TIMEOUT:
+            io_loop.add_timeout(datetime.timedelta(seconds=0.5), functools.partial(_poll_timelapse_job, job_key, job))
+            return
 
-                    except:
-                        pass
+        logging.error('timeout waiting for the timelapse process to make progress')
+        try:
+            os.kill(process.pid, signal.SIGTERM)
 
-    poll_media_list_process()
+        except:
+            pass  # nevermind
 
+    process.join(timeout=1)
+    job['pipe'].close()
+    job['done'] = True
 
-def check_timelapse_movie():
-    if _timelapse_process:
-        if ((hasattr(_timelapse_process, 'poll') and _timelapse_process.poll() is None) or
-            (hasattr(_timelapse_process, 'is_alive') and _timelapse_process.is_alive())):
-        
-            return {'progress': _timelapse_process.progress, 'data': None}
-        
-        else:
-            return {'progress': _timelapse_process.progress, 'data': _timelapse_data}
+    path = job['path']
+    if path and os.path.exists(path):
+        _cleanup_timelapse_cache(path)
 
     else:
-        return {'progress': -1, 'data': _timelapse_data}
+        logging.error('timelapse movie could not be created')
+
+        if path:
+            try:
+                os.remove(path + '.tmp')
+
+            except:
+                pass
+
+        job['path'] = None
+
+    # the job (and thus its result) is forgotten after one hour
+    def forget():
+        if _timelapse_jobs.get(job_key) is job:
+            del _timelapse_jobs[job_key]
+
+    io_loop.add_timeout(datetime.timedelta(seconds=3600), forget)
+
+
+def _select_timelapse_pictures(media_list, interval):
+    media_list.sort(key=lambda e: e['timestamp'])
+    start = media_list[0]['timestamp']
+    slices = {}
+    max_idx = 0
+    for m in media_list:
+        offs = m['timestamp'] - start
+        pos = float(offs) / interval - 0.5
+        idx = int(round(pos))
+        max_idx = idx
+        m['delta'] = abs(pos - idx)
+        slices.setdefault(idx, []).append(m)
+
+    selected = []
+    for i in xrange(max_idx + 1):
+        s = slices.get(i)
+        if not s:
+            continue
+
+        selected.append(min(s, key=lambda m: m['delta']))
+
+    logging.debug('selected %d/%d media files' % (len(selected), len(media_list)))
+
+    return selected
+
+
+def _get_timelapse_cache_dir():
+    path = os.path.join(settings.MEDIA_PATH, '.timelapse')
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    return path
+
+
+def _cleanup_timelapse_cache(keep_path):
+    # removes the older movies of the same job as well as
+    # the movies that haven't been used for a while
+    cache_dir = os.path.dirname(keep_path)
+    prefix = os.path.basename(keep_path).rsplit('-', 1)[0] + '-'
+    now = time.time()
+
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if path == keep_path:
+            continue
+
+        try:
+            if name.startswith(prefix) or now - os.path.getmtime(path) > _TIMELAPSE_CACHE_MAX_AGE:
+                logging.debug('removing cached timelapse movie "%s"' % path)
+                os.remove(path)
+
+        except OSError as e:
+            logging.error('failed to remove cached timelapse movie "%s": %s' % (path, e))
+
+
+def iter_file_content(path):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(_FILE_CHUNK_SIZE)
+            if not data:
+                break
+
+            yield data
 
 
 def get_media_preview(camera_config, path, media_type, width, height):
@@ -792,7 +1309,12 @@ def get_media_preview(camera_config, path, media_type, width, height):
                 return None
         
         full_path += '.thumb'
-    
+
+    if (width or height) and thumbnails.enabled():
+        content = thumbnails.get_thumbnail(full_path, width, height)
+        if content:
+            return content
+
     try:
         with open(full_path) as f:
             content = f.read()
@@ -817,7 +1339,7 @@ def get_media_preview(camera_config, path, media_type, width, height):
     width = width and int(width) or image.size[0]
     height = height and int(height) or image.size[1]
     
-    image.thumbnail((width, height), Image.LINEAR)
+    _make_thumbnail(image, width, height, Image.LINEAR)
 
     sio = StringIO.StringIO()
     image.save(sio, format='JPEG')
@@ -825,6 +1347,14 @@ def get_media_preview(camera_config, path, media_type, width, height):
     return sio.getvalue()
 
 
+def get_media_preview_etag(camera_config, path, media_type, width, height):
+    full_path = os.path.join(camera_config.get('target_dir'), path)
+    if media_type == 'movie':
+        full_path += '.thumb'
+
+    return thumbnails.get_etag(full_path, width, height)
+
+
 def del_media_content(camera_config, path, media_type):
     target_dir = camera_config.get('target_dir')
 
@@ -836,6 +1366,7 @@ def del_media_content(camera_config, path, media_type):
     try:
         # remove the file itself
         os.remove(full_path)
+        mediaindex.remove_file(camera_config, full_path)
         
         # remove the thumb file
         try:
@@ -865,29 +1396,28 @@ def del_media_content(camera_config, path, media_type):
 
 
 def del_media_group(camera_config, group, media_type):
-    if media_type == 'picture':
-        exts = _PICTURE_EXTS
-        
-    else:  # media_type == 'movie'
-        exts = _MOVIE_EXTS
-        
     target_dir = camera_config.get('target_dir')
     full_path = os.path.join(target_dir, group)
 
     # create a sentinel file to make sure the target dir is never removed
     open(os.path.join(target_dir, '.keep'), 'w').close()
 
-    mf = _list_media_files(target_dir, exts=exts, prefix=group)
+    mf = _list_camera_media_files(camera_config, media_type, prefix=group)
     for (path, st) in mf:  # @UnusedVariable
         try:
             os.remove(path)
     
-        except Exception as e:
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue  # the index might not have caught up with the file being removed
+
             logging.error('failed to remove file %(path)s: %(msg)s' % {
                     'path': full_path, 'msg': unicode(e)})
 
             raise
 
+    mediaindex.remove_group(camera_config, group, media_type)
+
     # remove the group directory if empty or contains only thumb files
     listing = os.listdir(full_path)
     thumbs = [l for l in listing if l.endswith('.thumb')]
@@ -912,6 +1442,15 @@ def get_current_picture(camera_config, width, height):
     if width is height is None:
         return jpg  # no server-side resize needed
 
+    return resize_picture(jpg, width, height, max_percent=camera_config['@webcam_resolution'],
+                          cache=mjpgclient.get_resized_jpgs(camera_config['@id']))
+
+
+def resize_picture(jpg, width, height, max_percent=100, cache=None):
+    # width and height may be given as fractions of the picture size;
+    # cache is an optional dictionary of resized versions of the same picture, indexed by size,
+    # so that a picture is resized at most once for a given size, regardless of the number of clients
+
     sio = StringIO.StringIO(jpg)
     image = Image.open(sio)
     
@@ -923,22 +1462,28 @@ def get_current_picture(camera_config, width, height):
     width = width and int(width) or image.size[0]
     height = height and int(height) or image.size[1]
     
-    webcam_resolution = camera_config['@webcam_resolution']
-    max_width = image.size[0] * webcam_resolution / 100
-    max_height = image.size[1] * webcam_resolution / 100
+    max_width = image.size[0] * max_percent / 100
+    max_height = image.size[1] * max_percent / 100
     
     width = min(max_width, width)
     height = min(max_height, height)
     
     if width >= image.size[0] and height >= image.size[1]:
         return jpg  # no enlarging of the picture on the server side
-    
-    image.thumbnail((width, height), Image.CUBIC)
+
+    if cache is not None and (width, height) in cache:
+        return cache[(width, height)]
+
+    _make_thumbnail(image, width, height, Image.CUBIC)
 
     sio = StringIO.StringIO()
     image.save(sio, format='JPEG')
+    resized_jpg = sio.getvalue()
 
-    return sio.getvalue()
+    if cache is not None:
+        cache[(width, height)] = resized_jpg
+
+    return resized_jpg
 
 
 def get_prepared_cache(key):
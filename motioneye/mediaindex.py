@@ -0,0 +1,516 @@
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import logging
+import multiprocessing
+import os.path
+import signal
+import sqlite3
+
+from tornado.ioloop import IOLoop
+
+import settings
+
+
+_INDEX_FILE_NAME = '.media-index-%(id)s.db'
+_DB_TIMEOUT = 30
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS media ('
+    '    path TEXT PRIMARY KEY,'
+    '    grp TEXT NOT NULL,'
+    '    media_type TEXT NOT NULL,'
+    '    size INTEGER NOT NULL,'
+    '    mtime REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS media_type_grp_mtime ON media (media_type, grp, mtime)',
+    'CREATE INDEX IF NOT EXISTS media_type_mtime ON media (media_type, mtime)',
+    'CREATE INDEX IF NOT EXISTS media_mtime ON media (mtime)',
+    'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)',
+
+    # per media type totals, kept up to date by triggers
+    'CREATE TABLE IF NOT EXISTS totals ('
+    '    media_type TEXT PRIMARY KEY,'
+    '    count INTEGER NOT NULL,'
+    '    size INTEGER NOT NULL)',
+    # (the conflict clause of the statement that fires a trigger overrides those inside the trigger,
+    # so the totals row is created without relying on one)
+    'CREATE TRIGGER IF NOT EXISTS media_insert AFTER INSERT ON media BEGIN'
+    '    INSERT INTO totals (media_type, count, size) SELECT NEW.media_type, 0, 0'
+    '        WHERE NOT EXISTS (SELECT 1 FROM totals WHERE media_type = NEW.media_type);'
+    '    UPDATE totals SET count = count + 1, size = size + NEW.size WHERE media_type = NEW.media_type;'
+    '    END',
+    'CREATE TRIGGER IF NOT EXISTS media_delete AFTER DELETE ON media BEGIN'
+    '    UPDATE totals SET count = count - 1, size = size - OLD.size WHERE media_type = OLD.media_type;'
+    '    END'
+]
+
+_process = None
+_connections = {}  # (pid, camera id) -> (connection, target dir)
+
+
+def start():
+    if not settings.MEDIA_INDEX_INTERVAL:
+        return
+
+    # the first reconcile pass is scheduled right after startup,
+    # so that the index becomes usable as soon as possible
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=5), _run_process)
+
+
+def stop():
+    global _process
+
+    if not running():
+        _process = None
+        return
+
+    if _process.is_alive():
+        _process.join(timeout=10)
+
+    if _process.is_alive():
+        logging.error('media index process did not finish in time, killing it...')
+        os.kill(_process.pid, signal.SIGKILL)
+
+    _process = None
+
+
+def running():
+    return _process is not None and _process.is_alive()
+
+
+def enabled():
+    return bool(settings.MEDIA_INDEX_INTERVAL)
+
+
+def is_ready(camera_config):
+    if not enabled():
+        return False
+
+    conn = _get_conn(camera_config)
+    if conn is None:
+        return False
+
+    return _get_meta(conn, 'ready') == '1'
+
+
+def add_file(camera_config, full_path):
+    conn = _get_conn(camera_config)
+    if conn is None:
+        return
+
+    entry = _make_entry(camera_config, full_path)
+    if entry is None:
+        return
+
+    logging.debug('adding %(path)s to media index of camera %(id)s' % {
+            'path': full_path, 'id': camera_config['@id']})
+
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO media (path, grp, media_type, size, mtime) VALUES (?, ?, ?, ?, ?)',
+                         entry)
+
+    except sqlite3.Error as e:
+        logging.error('failed to add %(path)s to media index: %(msg)s' % {
+                'path': full_path, 'msg': unicode(e)})
+
+
+def remove_file(camera_config, full_path):
+    conn = _get_conn(camera_config)
+    if conn is None:
+        return
+
+    path = _rel_path(camera_config, full_path)
+
+    try:
+        with conn:
+            conn.execute('DELETE FROM media WHERE path = ?', (path,))
+
+    except sqlite3.Error as e:
+        logging.error('failed to remove %(path)s from media index: %(msg)s' % {
+                'path': full_path, 'msg': unicode(e)})
+
+
+def remove_group(camera_config, group, media_type):
+    conn = _get_conn(camera_config)
+    if conn is None:
+        return
+
+    try:
+        with conn:
+            conn.execute('DELETE FROM media WHERE media_type = ? AND grp = ?', (media_type, group or ''))
+
+    except sqlite3.Error as e:
+        logging.error('failed to remove group "%(group)s" from media index: %(msg)s' % {
+                'group': group, 'msg': unicode(e)})
+
+
+def remove_files(camera_config, paths):
+    # removes a batch of relative paths from the index; returns False if the index could not be updated
+    conn = _get_conn(camera_config)
+    if conn is None:
+        return False
+
+    try:
+        with conn:
+            conn.executemany('DELETE FROM media WHERE path = ?', [(p,) for p in paths])
+
+    except sqlite3.Error as e:
+        logging.error('failed to remove %(count)s files from media index: %(msg)s' % {
+                'count': len(paths), 'msg': unicode(e)})
+
+        return False
+
+    return True
+
+
+def list_expired_files(camera_config, media_type, until, limit):
+    # returns at most limit relative paths older than until, oldest first,
+    # or None if the index cannot be used for this camera
+
+    if not is_ready(camera_config):
+        return None
+
+    conn = _get_conn(camera_config)
+
+    try:
+        return [r[0] for r in conn.execute('SELECT path FROM media WHERE media_type = ? AND mtime < ? '
+                                           'ORDER BY mtime LIMIT ?', (media_type, until, limit))]
+
+    except sqlite3.Error as e:
+        logging.error('failed to query media index of camera %(id)s: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def list_expired_groups(camera_config, media_type, until):
+    # returns the groups (other than the root one) that contain only media_type files older than until,
+    # oldest first, or None if the index cannot be used for this camera
+
+    if not is_ready(camera_config):
+        return None
+
+    conn = _get_conn(camera_config)
+
+    try:
+        return [r[0] for r in conn.execute('SELECT grp FROM media WHERE grp != \'\' GROUP BY grp '
+                                           'HAVING MAX(mtime) < ? AND SUM(media_type != ?) = 0 '
+                                           'ORDER BY MAX(mtime)', (until, media_type))]
+
+    except sqlite3.Error as e:
+        logging.error('failed to query media index of camera %(id)s: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def list_oldest_files(camera_config, limit):
+    # returns at most limit (relative path, media type, size) tuples, oldest first,
+    # or None if the index cannot be used for this camera
+
+    if not is_ready(camera_config):
+        return None
+
+    conn = _get_conn(camera_config)
+
+    try:
+        return conn.execute('SELECT path, media_type, size FROM media ORDER BY mtime LIMIT ?', (limit,)).fetchall()
+
+    except sqlite3.Error as e:
+        logging.error('failed to query media index of camera %(id)s: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def get_oldest_mtime(camera_config):
+    # returns the modification time of the oldest indexed file (None if there are no files),
+    # or False if the index cannot be used for this camera
+
+    if not is_ready(camera_config):
+        return False
+
+    conn = _get_conn(camera_config)
+
+    try:
+        return conn.execute('SELECT MIN(mtime) FROM media').fetchone()[0]
+
+    except sqlite3.Error as e:
+        logging.error('failed to query media index of camera %(id)s: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return False
+
+
+def get_total_size(camera_config):
+    # returns the total size of the indexed media files, in bytes,
+    # or None if the index cannot be used for this camera
+
+    if not is_ready(camera_config):
+        return None
+
+    conn = _get_conn(camera_config)
+
+    try:
+        return conn.execute('SELECT SUM(size) FROM totals').fetchone()[0] or 0
+
+    except sqlite3.Error as e:
+        logging.error('failed to query media index of camera %(id)s: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def list_files(camera_config, media_type, group=None, since=None, until=None, cursor=None, limit=None):
+    # returns a list of (relative path, size, mtime) tuples,
+    # or None if the index cannot be used for this camera;
+    # when paging (cursor or limit given), entries are sorted newest first
+    # and the cursor is the (mtime, relative path) of the last entry already seen
+
+    if not is_ready(camera_config):
+        return None
+
+    conn = _get_conn(camera_config)
+
+    query = 'SELECT path, size, mtime FROM media WHERE media_type = ?'
+    args = [media_type]
+    if group is not None:
+        query += ' AND grp = ?'
+        args.append(group)
+
+    if since is not None:
+        query += ' AND mtime >= ?'
+        args.append(since)
+
+    if until is not None:
+        query += ' AND mtime < ?'
+        args.append(until)
+
+    if cursor is not None:
+        query += ' AND (mtime < ? OR (mtime = ? AND path < ?))'
+        args += [cursor[0], cursor[0], cursor[1]]
+
+    if cursor is not None or limit is not None:
+        query += ' ORDER BY mtime DESC, path DESC'
+
+    if limit is not None:
+        query += ' LIMIT ?'
+        args.append(limit)
+
+    try:
+        return conn.execute(query, args).fetchall()
+
+    except sqlite3.Error as e:
+        logging.error('failed to query media index of camera %(id)s: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def list_groups(camera_config, media_type):
+    # returns a list of (group, count, total size, newest mtime) tuples,
+    # or None if the index cannot be used for this camera
+
+    if not is_ready(camera_config):
+        return None
+
+    conn = _get_conn(camera_config)
+
+    try:
+        return conn.execute('SELECT grp, COUNT(*), SUM(size), MAX(mtime) FROM media '
+                            'WHERE media_type = ? GROUP BY grp', (media_type,)).fetchall()
+
+    except sqlite3.Error as e:
+        logging.error('failed to query media index of camera %(id)s: %(msg)s' % {
+                'id': camera_config['@id'], 'msg': unicode(e)})
+
+        return None
+
+
+def reconcile(camera_config):
+    import mediafiles
+
+    conn = _get_conn(camera_config)
+    if conn is None:
+        return
+
+    target_dir = camera_config.get('target_dir')
+    camera_id = camera_config['@id']
+
+    logging.debug('reconciling media index of camera %(id)s with %(dir)s...' % {
+            'id': camera_id, 'dir': target_dir})
+
+    indexed = {}
+    for (path, size, mtime) in conn.execute('SELECT path, size, mtime FROM media'):
+        indexed[path] = (size, mtime)
+
+    changed = []
+    if os.path.isdir(target_dir):
+        for (full_path, name, st) in mediafiles.findfiles(target_dir):  # @UnusedVariable
+            entry = _make_entry(camera_config, full_path, st)
+            if entry is None:
+                continue
+
+            old = indexed.pop(entry[0], None)
+            if old != (entry[3], entry[4]):
+                changed.append(entry)
+
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO media (path, grp, media_type, size, mtime) VALUES (?, ?, ?, ?, ?)',
+                         changed)
+        conn.executemany('DELETE FROM media WHERE path = ?', [(p,) for p in indexed.iterkeys()])
+        _set_meta(conn, 'ready', '1')
+
+    logging.debug('media index of camera %(id)s reconciled: %(changed)s changed, %(removed)s removed' % {
+            'id': camera_id, 'changed': len(changed), 'removed': len(indexed)})
+
+
+def get_index_path(camera_id):
+    return os.path.join(settings.MEDIA_PATH, _INDEX_FILE_NAME % {'id': camera_id})
+
+
+def _get_conn(camera_config):
+    if not enabled():
+        return None
+
+    camera_id = camera_config['@id']
+    target_dir = os.path.normpath(camera_config.get('target_dir') or '')
+    key = (os.getpid(), camera_id)  # sqlite connections must not be shared across forked processes
+    conn, conn_target_dir = _connections.get(key, (None, None))
+    if conn is not None and conn_target_dir == target_dir:
+        return conn
+
+    path = get_index_path(camera_id)
+    try:
+        if conn is None:
+            conn = sqlite3.connect(path, timeout=_DB_TIMEOUT)
+            conn.text_factory = str
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+
+            # rows replaced by INSERT OR REPLACE must go through the delete trigger as well
+            conn.execute('PRAGMA recursive_triggers=ON')
+
+        with conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+            # the index is only valid for the directory it was built upon
+            if _get_meta(conn, 'target_dir') != target_dir:
+                logging.debug('target directory of camera %(id)s changed, clearing media index' % {'id': camera_id})
+
+                conn.execute('DELETE FROM media')
+                _set_meta(conn, 'target_dir', target_dir)
+                _set_meta(conn, 'ready', '0')
+
+            # indexes created before the totals table was introduced need their totals computed once
+            if _get_meta(conn, 'totals') != '1':
+                conn.execute('DELETE FROM totals')
+                conn.execute('INSERT INTO totals (media_type, count, size) '
+                             'SELECT media_type, COUNT(*), SUM(size) FROM media GROUP BY media_type')
+                _set_meta(conn, 'totals', '1')
+
+    except sqlite3.Error as e:
+        logging.error('failed to open media index %(path)s: %(msg)s' % {'path': path, 'msg': unicode(e)})
+
+        return None
+
+    _connections[key] = (conn, target_dir)
+
+    return conn
+
+
+def _get_meta(conn, name):
+    row = conn.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+
+    return row and row[0]
+
+
+def _set_meta(conn, name, value):
+    conn.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (name, value))
+
+
+def _rel_path(camera_config, full_path):
+    target_dir = os.path.normpath(camera_config.get('target_dir'))
+    path = os.path.normpath(full_path)[len(target_dir):]
+
+    return path.lstrip('/')
+
+
+def _make_entry(camera_config, full_path, st=None):
+    import mediafiles
+
+    path = _rel_path(camera_config, full_path)
+    parts = path.split('/')
+
+    # ignore hidden files/dirs and other unwanted files
+    if [p for p in parts if p.startswith('.')] or parts[-1] == 'lastsnap.jpg':
+        return None
+
+    media_type = mediafiles.get_media_type(path)
+    if media_type is None:
+        return None
+
+    if st is None:
+        try:
+            st = os.stat(full_path)
+
+        except Exception as e:
+            logging.error('stat failed: ' + unicode(e))
+            return None
+
+    return path, os.path.dirname(path), media_type, st.st_size, st.st_mtime
+
+
+def _run_process():
+    global _process
+
+    io_loop = IOLoop.instance()
+
+    # schedule the next call
+    io_loop.add_timeout(datetime.timedelta(seconds=settings.MEDIA_INDEX_INTERVAL), _run_process)
+
+    if not running():  # check that the previous process has finished
+        logging.debug('running media index process...')
+
+        _process = multiprocessing.Process(target=_do_reconcile)
+        _process.start()
+
+
+def _do_reconcile():
+    # this will be executed in a separate subprocess
+
+    import config
+    import utils
+
+    # ignore the terminate and interrupt signals in this subprocess
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    for camera_id in config.get_camera_ids():
+        camera_config = config.get_camera(camera_id)
+        if not utils.is_local_motion_camera(camera_config):
+            continue
+
+        try:
+            reconcile(camera_config)
+
+        except Exception as e:
+            logging.error('failed to reconcile media index of camera %(id)s: %(msg)s' % {
+                    'id': camera_id, 'msg': unicode(e)}, exc_info=True)
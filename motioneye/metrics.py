@@ -0,0 +1,152 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import datetime
+import logging
+import time
+
+from tornado.ioloop import IOLoop
+
+
+_PREFIX = 'motioneye_'
+_LAG_INTERVAL = 1  # seconds between two IO loop lag measurements
+
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# name: (type, help, histogram buckets)
+_DEFINITIONS = {
+    'http_request_duration_seconds': ('histogram', 'HTTP request latency, by handler, operation and status',
+                                      _LATENCY_BUCKETS),
+    'mjpg_frames_total': ('counter', 'Frames received by the mjpg client of each camera', None),
+    'mjpg_bytes_total': ('counter', 'Bytes received by the mjpg client of each camera', None),
+    'mjpg_fps': ('gauge', 'Current frame rate of the mjpg client of each camera', None),
+    'tasks_queued': ('gauge', 'Background tasks waiting to be executed', None),
+    'tasks_running': ('gauge', 'Background tasks being executed', None),
+    'task_wait_seconds': ('histogram', 'Time background tasks spent waiting for a worker, by function',
+                          _DURATION_BUCKETS),
+    'task_run_seconds': ('histogram', 'Execution time of background tasks, by function', _DURATION_BUCKETS),
+    'media_listing_seconds': ('histogram', 'Duration of media listing processes, by kind', _DURATION_BUCKETS),
+    'zip_seconds': ('histogram', 'Duration of zip archive downloads', _DURATION_BUCKETS),
+    'zip_bytes_total': ('counter', 'Bytes sent as zip archives', None),
+    'upload_seconds': ('histogram', 'Duration of media uploads, by service', _DURATION_BUCKETS),
+    'upload_files_total': ('counter', 'Media files uploaded, by service', None),
+    'upload_failures_total': ('counter', 'Media files that failed to upload, by service', None),
+    'upload_bytes_total': ('counter', 'Bytes uploaded, by service', None),
+    'cleanup_seconds': ('histogram', 'Duration of media cleanup processes', _DURATION_BUCKETS),
+    'ioloop_lag_seconds': ('histogram', 'Delay of IO loop timeouts with respect to their deadline',
+                           _LATENCY_BUCKETS),
+    'thumbnail_cache_hits_total': ('counter', 'Media previews made out of a cached thumbnail', None),
+    'thumbnail_cache_misses_total': ('counter', 'Media previews that required creating thumbnails', None),
+    'thumbnail_cache_bytes': ('gauge', 'Total size of the cached thumbnails', None),
+    'thumbnail_cache_files': ('gauge', 'Number of cached thumbnails', None),
+    'ioloop_blocked_seconds': ('histogram', 'Duration of IO loop stalls longer than the blocking threshold, '
+                               'by call site', _LATENCY_BUCKETS)
+}
+
+_values = {}  # counter and gauge values, indexed by (name, labels)
+_histograms = {}  # [bucket counts..., +Inf count, sum, count] lists, indexed by (name, labels)
+_collectors = []  # functions called upon rendering, returning (name, labels dict, value) samples
+
+
+def start():
+    # schedule the first IO loop lag measurement
+    _schedule_lag_check()
+
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    _values[key] = _values.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    histogram = _histograms.get(key)
+    buckets = _DEFINITIONS[name][2]
+    if histogram is None:
+        histogram = _histograms[key] = [0] * (len(buckets) + 3)
+
+    histogram[bisect.bisect_left(buckets, value)] += 1
+    histogram[-2] += value
+    histogram[-1] += 1
+
+
+def add_collector(func):
+    _collectors.append(func)
+
+
+def render():
+    # returns all the metrics in the Prometheus text exposition format
+
+    values = dict(_values)
+    for func in _collectors:
+        try:
+            for (name, labels, value) in func():
+                values[(name, tuple(sorted(labels.items())))] = value
+
+        except Exception as e:
+            logging.error('failed to collect metrics: %s' % e, exc_info=True)
+
+    samples = {}
+    for ((name, labels), value) in sorted(values.iteritems()):
+        samples.setdefault(name, []).append(_format_sample(name, labels, value))
+
+    for ((name, labels), histogram) in sorted(_histograms.iteritems()):
+        lines = samples.setdefault(name, [])
+        buckets = _DEFINITIONS[name][2]
+        count = 0
+        for (i, bound) in enumerate(buckets + ('+Inf',)):
+            count += histogram[i]
+            lines.append(_format_sample(name + '_bucket', labels + (('le', str(bound)),), count))
+
+        lines.append(_format_sample(name + '_sum', labels, histogram[-2]))
+        lines.append(_format_sample(name + '_count', labels, histogram[-1]))
+
+    output = []
+    for name in sorted(samples):
+        (_type, _help, buckets) = _DEFINITIONS[name]  # @UnusedVariable
+        output.append('# HELP %s%s %s' % (_PREFIX, name, _help))
+        output.append('# TYPE %s%s %s' % (_PREFIX, name, _type))
+        output += samples[name]
+
+    return '\n'.join(output) + '\n'
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        labels = '{' + ','.join('%s="%s"' % (n, _escape(v)) for (n, v) in labels) + '}'
+
+    else:
+        labels = ''
+
+    return '%s%s%s %s' % (_PREFIX, name, labels, repr(float(value)))
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').encode('utf8')
+
+
+def _schedule_lag_check():
+    deadline = time.time() + _LAG_INTERVAL
+
+    def check_lag():
+        observe('ioloop_lag_seconds', max(0, time.time() - deadline))
+        _schedule_lag_check()
+
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=_LAG_INTERVAL), check_lag)
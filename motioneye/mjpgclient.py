@@ -15,9 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import collections
 import datetime
 import errno
 import logging
+import math
 import re
 import socket
 import time
@@ -26,13 +28,106 @@ from tornado.ioloop import IOLoop
 from tornado.iostream import IOStream
 
 import config
+import metrics
 import motionctl
 import settings
 import utils
 
 
+_subscribers = {}  # lists of frame callbacks indexed by camera id
+
+_BOUNDARY_REGEX = re.compile('boundary="?([^";\r\n]+)', re.I)
+_CONTENT_LENGTH_REGEX = re.compile('content-length:\s*(\d+)', re.I)
+
+
+class MjpgParser(object):
+    # extracts the jpeg frames out of a multipart mjpeg stream, as data comes in;
+    # all the data is accumulated in a single receive buffer, without intermediate copies:
+    # each frame is copied exactly once, out of the buffer, when it's complete;
+    # frames are delimited by their Content-Length header or, when it's missing, by the next boundary
+    
+    _MAX_BUFFER_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, boundary=None):
+        self._buffer = bytearray()
+        self._boundary = boundary and ('--' + boundary)
+        self._start = None  # the offset of the current frame in the buffer, once its headers are parsed
+        self._length = None  # the length of the current frame, if given by its headers
+        self._scan = 0  # the offset in the buffer where to resume looking for a boundary
+
+    def feed(self, data):
+        # returns the list of the frames completed by data;
+        # raises an exception if the data doesn't look like an mjpeg stream
+
+        buf = self._buffer
+        buf += data
+        
+        frames = []
+        pos = 0
+        while True:
+            if self._start is None:  # looking for the headers of the next frame
+                end = buf.find('\r\n\r\n', pos)
+                if end < 0:
+                    break
+
+                self._parse_headers(buf[pos:end])
+                self._start = self._scan = end + 4
+
+            if self._length is not None:
+                end = self._start + self._length
+                if end > len(buf):
+                    break
+                
+                frames.append(bytes(buf[self._start:end]))
+                pos = end
+
+            elif self._boundary:
+                end = buf.find(self._boundary, self._scan)
+                if end < 0:
+                    self._scan = max(self._start, len(buf) - len(self._boundary))
+                    break
+
+                pos = end
+                if buf[end - 2:end] == '\r\n':
+                    end -= 2
+
+                frames.append(bytes(buf[self._start:end]))
+
+            else:
+                raise Exception('no content length nor boundary for mjpeg frame')
+
+            self._start = None
+            self._length = None
+
+        # discard everything before the current position
+        if pos:
+            del buf[:pos]
+            if self._start is not None:
+                self._start -= pos
+                self._scan -= pos
+
+        if len(buf) > self._MAX_BUFFER_SIZE:
+            raise Exception('mjpeg frame exceeds %s bytes' % self._MAX_BUFFER_SIZE)
+
+        return frames
+    
+    def _parse_headers(self, headers):
+        # the headers of each part may also contain the trailing end of line of the previous part
+        # and the boundary line itself
+        if self._boundary is None:
+            for line in bytes(headers).split('\r\n'):
+                if line.startswith('--'):
+                    self._boundary = line.strip()
+                    break
+
+        match = _CONTENT_LENGTH_REGEX.search(headers)
+        self._length = int(match.group(1)) if match else None
+
+
 class MjpgClient(IOStream):
-    _FPS_LEN = 4
+    _STATS_TIME_CONSTANT = 2.0  # seconds over which the frame statistics are averaged
+    _INTERVALS_LEN = 32  # number of recent frame intervals kept
+    _READ_SIZE = 64 * 1024
     
     clients = {}  # dictionary of clients indexed by camera id
     _last_erroneous_close_time = 0  # helps detecting erroneous connections and restart motion
@@ -44,10 +139,22 @@ class MjpgClient(IOStream):
         self._password = (password or '').encode('utf8')
         self._auth_mode = auth_mode
         self._auth_digest_state = {}
+        self._parser = None
         
         self._last_access = 0
         self._last_jpg = None
-        self._last_jpg_times = []
+        self._last_jpg_time = None
+        self._resized_jpgs = {}  # resized versions of the last jpg, indexed by size
+        self._frames = collections.deque()  # recent (timestamp, jpg) frames, bounded by duration and total size
+        self._frames_size = 0
+        
+        # frame statistics, as exponentially weighted moving averages
+        self._intervals = collections.deque(maxlen=self._INTERVALS_LEN)
+        self._avg_interval = None
+        self._avg_jitter = 0
+        self._avg_size = 0
+        self._frame_count = 0
+        self._byte_count = 0
         
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         IOStream.__init__(self, s)
@@ -86,23 +193,46 @@ class MjpgClient(IOStream):
         self._last_access = time.time()
         return self._last_jpg
 
+    def get_resized_jpgs(self):
+        return self._resized_jpgs
+
     def get_last_access(self):
         return self._last_access
 
+    def get_frames(self, seconds=None):
+        if seconds is None:
+            return list(self._frames)
+
+        since = time.time() - seconds
+
+        return [f for f in self._frames if f[0] >= since]
+
     def get_last_jpg_time(self):
-        if not self._last_jpg_times:
-            self._last_jpg_times.append(time.time())
+        if self._last_jpg_time is None:
+            self._last_jpg_time = time.time()
 
-        return self._last_jpg_times[-1]
+        return self._last_jpg_time
 
     def get_fps(self):
-        if len(self._last_jpg_times) < self._FPS_LEN:
+        if not self._avg_interval:
             return 0  # not enough "samples"
         
-        if time.time() - self._last_jpg_times[-1] > 1:
-            return 0  # everything below 1 fps is considered 0
+        # when frames stop coming in, the rate decreases gradually as the last frame gets older
+        return 1 / max(self._avg_interval, time.time() - self._last_jpg_time)
+
+    def get_stats(self):
+        fps = self.get_fps()
         
-        return (len(self._last_jpg_times) - 1) / (self._last_jpg_times[-1] - self._last_jpg_times[0])
+        return {
+            'fps': fps,
+            'jitter': self._avg_jitter,
+            'max_interval': max(self._intervals) if self._intervals else 0,
+            'frame_size': self._avg_size,
+            'bytes_per_sec': self._avg_size * fps,
+            'frames': self._frame_count,
+            'bytes': self._byte_count,
+            'last_frame_age': time.time() - self._last_jpg_time if self._frame_count else None
+        }
 
     def _check_error(self):
         if self.socket is None:
@@ -156,8 +286,8 @@ class MjpgClient(IOStream):
         if data.endswith('401 '):
             self._seek_www_authenticate()
 
-        else:  # no authorization required, skip to content length
-            self._seek_content_length()
+        else:  # no authorization required, skip to the content
+            self._seek_headers()
 
     def _seek_www_authenticate(self):
         if self._check_error():
@@ -200,42 +330,91 @@ class MjpgClient(IOStream):
             return
 
         logging.error('mjpg client unknown authentication header: "%s"' % data)
-        self._seek_content_length()
+        self._seek_headers()
 
-    def _seek_content_length(self):
+    def _seek_headers(self):
         if self._check_error():
             return
         
-        self.read_until('Content-Length:', self._on_before_content_length)
+        self.read_until('\r\n\r\n', self._on_headers)
     
-    def _on_before_content_length(self, data):
+    def _on_headers(self, data):
         if self._check_error():
             return
         
-        self.read_until('\r\n\r\n', self._on_content_length)
-    
-    def _on_content_length(self, data):
+        match = _BOUNDARY_REGEX.search(data)
+        self._parser = MjpgParser(match and match.group(1).strip())
+        self._seek_data()
+
+    def _seek_data(self):
         if self._check_error():
             return
-        
-        matches = re.findall('(\d+)', data)
-        if not matches:
-            self._error('could not find content length in mjpg header line "%(header)s"' % {
-                    'header': data})
-            
+
+        self.read_bytes(self._READ_SIZE, self._on_data, partial=True)
+
+    def _on_data(self, data):
+        if self._check_error():
             return
-        
-        length = int(matches[0])
-        
-        self.read_bytes(length, self._on_jpg)
-    
+
+        try:
+            frames = self._parser.feed(data)
+
+        except Exception as e:
+            return self._error(e)
+
+        for jpg in frames:
+            self._on_jpg(jpg)
+
+        self._seek_data()
+
     def _on_jpg(self, data):
+        now = time.time()
         self._last_jpg = data
-        self._last_jpg_times.append(time.time())
-        while len(self._last_jpg_times) > self._FPS_LEN:
-            self._last_jpg_times.pop(0)
+        self._resized_jpgs = {}
+        self._update_stats(now, len(data))
+        self._last_jpg_time = now
+        
+        if settings.FRAME_BUFFER_DURATION:
+            self._buffer_frame(now, data)
+
+        # push the new frame to the streaming subscribers
+        for callback in list(_subscribers.get(self._camera_id, [])):
+            try:
+                callback(data)
+
+            except Exception as e:
+                logging.error('mjpg client subscriber for camera %(camera_id)s failed: %(msg)s' % {
+                        'camera_id': self._camera_id, 'msg': unicode(e)}, exc_info=True)
+
+    def _update_stats(self, now, size):
+        self._frame_count += 1
+        self._byte_count += size
+        if self._frame_count == 1:
+            self._avg_size = size
+            return
+
+        interval = now - self._last_jpg_time
+        self._intervals.append(interval)
+        if self._avg_interval is None:
+            self._avg_interval = interval
+            return
 
-        self._seek_content_length()
+        # the weight of each sample depends on the time it covers, rather than on the number of samples,
+        # so that the averages span the same period of time, regardless of the frame rate
+        alpha = 1 - math.exp(-interval / self._STATS_TIME_CONSTANT)
+        self._avg_jitter += alpha * (abs(interval - self._avg_interval) - self._avg_jitter)
+        self._avg_interval += alpha * (interval - self._avg_interval)
+        self._avg_size += alpha * (size - self._avg_size)
+
+    def _buffer_frame(self, now, data):
+        self._frames.append((now, data))
+        self._frames_size += len(data)
+
+        # drop the oldest frames, keeping the buffer within its duration and size limits
+        since = now - settings.FRAME_BUFFER_DURATION
+        max_size = settings.FRAME_BUFFER_SIZE * 1024 * 1024
+        while self._frames and (self._frames[0][0] < since or self._frames_size > max_size):
+            self._frames_size -= len(self._frames.popleft()[1])
 
 
 def start():
@@ -275,6 +454,61 @@ def get_jpg(camera_id):
     return client.get_last_jpg()
 
 
+def get_resized_jpgs(camera_id):
+    # returns the resized versions of the last jpg, indexed by size;
+    # the resized jpgs are discarded as soon as a new frame is received
+    client = MjpgClient.clients.get(camera_id)
+    if client is None:
+        return None
+
+    return client.get_resized_jpgs()
+
+
+def subscribe(camera_id, callback):
+    # callback will be called with each new jpeg frame received for the camera
+    _subscribers.setdefault(camera_id, []).append(callback)
+
+    logging.debug('mjpg client subscriber added for camera %(camera_id)s (%(count)s subscribers)' % {
+            'camera_id': camera_id, 'count': len(_subscribers[camera_id])})
+
+
+def unsubscribe(camera_id, callback):
+    callbacks = _subscribers.get(camera_id, [])
+    if callback in callbacks:
+        callbacks.remove(callback)
+
+    if not callbacks:
+        _subscribers.pop(camera_id, None)
+
+    logging.debug('mjpg client subscriber removed for camera %(camera_id)s (%(count)s subscribers)' % {
+            'camera_id': camera_id, 'count': len(callbacks)})
+
+
+def get_frames(camera_id, seconds=None):
+    # returns the buffered (timestamp, jpg) frames of the last given seconds, oldest first
+    client = MjpgClient.clients.get(camera_id)
+    if client is None:
+        return []
+
+    return client.get_frames(seconds)
+
+
+def get_stats():
+    # returns the frame statistics of all the running mjpg clients, indexed by camera id
+    return dict((camera_id, client.get_stats()) for (camera_id, client) in MjpgClient.clients.items())
+
+
+def _collect_metrics():
+    samples = []
+    for (camera_id, client) in MjpgClient.clients.items():
+        stats = client.get_stats()
+        samples.append(('mjpg_frames_total', {'camera': camera_id}, stats['frames']))
+        samples.append(('mjpg_bytes_total', {'camera': camera_id}, stats['bytes']))
+        samples.append(('mjpg_fps', {'camera': camera_id}, stats['fps']))
+
+    return samples
+
+
 def get_fps(camera_id):
     client = MjpgClient.clients.get(camera_id)
     if client is None:
@@ -316,9 +550,10 @@ def _garbage_collector():
             
             break
 
-        # check for last access timeout
+        # check for last access timeout (clients are never idle while buffering frames)
         delta = now - client.get_last_access()
-        if settings.MJPG_CLIENT_IDLE_TIMEOUT and delta > settings.MJPG_CLIENT_IDLE_TIMEOUT:
+        if (settings.MJPG_CLIENT_IDLE_TIMEOUT and not settings.FRAME_BUFFER_DURATION and
+            delta > settings.MJPG_CLIENT_IDLE_TIMEOUT):
             msg = ('mjpg client for camera %(camera_id)s on port %(port)s has been idle '
                    'for %(timeout)s seconds, removing it' % {
                     'camera_id': camera_id, 'port': port, 'timeout': settings.MJPG_CLIENT_IDLE_TIMEOUT})
@@ -328,3 +563,12 @@ def _garbage_collector():
             client.close()
 
             continue
+
+    # make sure the frames of all cameras are buffered, even after their clients were closed
+    if settings.FRAME_BUFFER_DURATION and motionctl.running():
+        for camera_config in config.get_enabled_local_motion_cameras():
+            if camera_config['@id'] not in MjpgClient.clients:
+                get_jpg(camera_config['@id'])
+
+
+metrics.add_collector(_collect_metrics)
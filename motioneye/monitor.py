@@ -15,51 +15,135 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import datetime
 import logging
 import subprocess
+import tempfile
 import time
 import urllib
 
+from tornado.ioloop import IOLoop
+
 import config
+import settings
 
 
 DEFAULT_INTERVAL = 1  # seconds
 
-_monitor_info_cache_by_camera_id = {}
-_last_call_time_by_camera_id = {}
-_interval_by_camera_id = {}
+_POLL_INTERVAL = 0.1  # seconds between two checks of a running monitor command
+_IDLE_TIMEOUT = 60  # commands whose info was not requested for this many seconds are no longer run
+_MAX_BACKOFF = 300  # maximum delay in seconds before running a failing command again
+
+_commands = {}  # scheduled monitor commands, indexed by command
 
 
 def get_monitor_info(camera_id):
-    now = time.time()
+    # monitor commands are run in the background, at the interval they request;
+    # this only returns the last known info and never waits for the command
+
     command = config.get_monitor_command(camera_id)
     if command is None:
         return ''
 
-    monitor_info = _monitor_info_cache_by_camera_id.get(camera_id)
-    last_call_time = _last_call_time_by_camera_id.get(camera_id, 0)
-    interval = _interval_by_camera_id.get(camera_id, DEFAULT_INTERVAL)
-    if monitor_info is None or now - last_call_time > interval:
-        monitor_info, interval = _exec_monitor_command(command)
-        monitor_info = urllib.quote(monitor_info, safe='')
-        _interval_by_camera_id[camera_id] = interval
-        _monitor_info_cache_by_camera_id[camera_id] = monitor_info
-        _last_call_time_by_camera_id[camera_id] = now
+    entry = _commands.get(command)
+    if entry is None:
+        logging.debug('scheduling monitor command "%s"' % command)
+
+        entry = _commands[command] = {
+            'command': command,
+            'info': '',
+            'interval': DEFAULT_INTERVAL,
+            'failures': 0,
+            'last_access': 0
+        }
+
+        io_loop = IOLoop.instance()
+        io_loop.add_callback(_run, entry)
+
+    entry['last_access'] = time.time()
+
+    return entry['info']
+
+
+def _run(entry):
+    command = entry['command']
+    if time.time() - entry['last_access'] > _IDLE_TIMEOUT:
+        logging.debug('monitor command "%s" is no longer used, unscheduling it' % command)
+        _commands.pop(command, None)
+
+        return
+
+    # output goes to temporary files rather than pipes, so that a verbose command can't block on writing
+    stdout = tempfile.TemporaryFile()
+    stderr = tempfile.TemporaryFile()
+    try:
+        process = subprocess.Popen([command], stdout=stdout, stderr=stderr, close_fds=True)
+
+    except Exception as e:
+        stdout.close()
+        stderr.close()
+
+        return _on_failure(entry, 'failed to execute monitor command "%(cmd)s": %(msg)s' % {
+                'cmd': command, 'msg': unicode(e)})
 
-    return monitor_info 
+    _poll(entry, process, stdout, stderr, time.time())
 
 
-def _exec_monitor_command(command):
-    process = subprocess.Popen([command], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = process.communicate()
+def _poll(entry, process, stdout, stderr, started):
+    io_loop = IOLoop.instance()
+    command = entry['command']
+
+    if process.poll() is None:
+        if time.time() - started < settings.MONITOR_COMMAND_TIMEOUT:
+            io_loop.add_timeout(datetime.timedelta(seconds=_POLL_INTERVAL), _poll, entry, process, stdout, stderr,
+                                started)
+
+            return
+
+        try:
+            process.kill()
+            process.wait()
+
+        except OSError:
+            pass
+
+        stdout.close()
+        stderr.close()
+
+        return _on_failure(entry, 'monitor command "%(cmd)s" timed out after %(timeout)s seconds' % {
+                'cmd': command, 'timeout': settings.MONITOR_COMMAND_TIMEOUT})
+
+    stdout.seek(0)
+    stderr.seek(0)
+    out = stdout.read()
+    err = stderr.read()
+    stdout.close()
+    stderr.close()
 
     try:
         interval = int(err)
-    
+        if interval <= 0:
+            interval = DEFAULT_INTERVAL
+
     except:
         interval = DEFAULT_INTERVAL
-    
+
     out = out.strip()
     logging.debug('monitoring command "%s" returned "%s"' % (command, out))
 
-    return out, interval
+    entry['info'] = urllib.quote(out, safe='')
+    entry['interval'] = interval
+    entry['failures'] = 0
+
+    io_loop.add_timeout(datetime.timedelta(seconds=interval), _run, entry)
+
+
+def _on_failure(entry, message):
+    # the last known info is kept, while the command is retried with an exponential backoff
+    entry['failures'] += 1
+    delay = min(entry['interval'] * 2 ** entry['failures'], _MAX_BACKOFF)
+
+    logging.error('%(msg)s (retrying in %(delay)s seconds)' % {'msg': message, 'delay': delay})
+
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=delay), _run, entry)
@@ -15,7 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>. 
 
+import datetime
 import errno
+import functools
 import logging
 import os.path
 import re
@@ -32,11 +34,19 @@ import update
 import utils
 
 _MOTION_CONTROL_TIMEOUT = 5
+_MOTION_START_TIMEOUT = 10  # seconds to wait for the control port of a newly started motion process
+_MOTION_POLL_INTERVAL = 0.2
+_MOTION_STOP_TIMEOUT = 5  # seconds to wait for motion to exit after TERM, before sending KILL
+_MOTION_KILL_TIMEOUT = 2  # seconds to wait for motion to exit after KILL
 
 # starting with r490 motion config directives have changed a bit 
 _LAST_OLD_CONFIG_VERSIONS = (490, '3.2.12')
 
 _started = False
+_starting_process = None  # the motion process that has been started but is not ready yet
+_stopping_pid = None  # the pid of the motion process that has been signaled but has not exited yet
+_stop_callbacks = []  # called when the motion process being stopped has exited
+_start_pending = False  # motion is to be started once the process being stopped has exited
 _motion_binary_cache = None
 _motion_detected = {}
 
@@ -78,15 +88,21 @@ def find_motion():
 
 def start(deferred=False):
     import config
-    import mjpgclient
     
     if deferred:
         io_loop = IOLoop.instance()
         io_loop.add_callback(start, deferred=False)
 
     global _started
+    global _start_pending
     
     _started = True
+
+    if _stopping_pid is not None:
+        # the previous motion process has not exited yet
+        _start_pending = True
+
+        return
     
     enabled_local_motion_cameras = config.get_enabled_local_motion_cameras()
     if running() or not enabled_local_motion_cameras:
@@ -123,37 +139,111 @@ def start(deferred=False):
     log_file = open(motion_log_path, 'w')
     
     process = subprocess.Popen(args, stdout=log_file, stderr=log_file, close_fds=True, cwd=settings.CONF_PATH)
-    
-    # wait 2 seconds to see that the process has successfully started
-    for i in xrange(20):  # @UnusedVariable
-        time.sleep(0.1)
-        exit_code = process.poll()
-        if exit_code is not None and exit_code != 0:
-            raise Exception('motion failed to start')
+    log_file.close()
 
-    pid = process.pid
-    
     # write the pid to file
     with open(motion_pid_path, 'w') as f:
-        f.write(str(pid) + '\n')
-    
+        f.write(str(process.pid) + '\n')
+
+    # wait for motion to become ready without blocking the IO loop
+    global _starting_process
+
+    _starting_process = process
+    _poll_started(process, time.time())
+
+
+def _poll_started(process, start_time):
+    from tornado.httpclient import HTTPRequest, AsyncHTTPClient
+
+    if process is not _starting_process:
+        return  # motion has been stopped or restarted meanwhile
+
+    exit_code = process.poll()
+    if exit_code is not None:
+        _on_start_failed(process, 'motion exited with code %s' % exit_code)
+
+        return
+
+    def on_response(response):
+        if process is not _starting_process:
+            return
+
+        if response.code != 599:  # any http response means that the control port is up
+            _on_started(process, start_time)
+
+        elif time.time() - start_time > _MOTION_START_TIMEOUT:
+            # motion is running, even though its control port is not reachable
+            logging.warning('motion control port %s is not reachable after %s seconds' % (
+                    settings.MOTION_CONTROL_PORT, _MOTION_START_TIMEOUT))
+
+            _on_started(process, start_time)
+
+        else:
+            io_loop = IOLoop.instance()
+            io_loop.add_timeout(datetime.timedelta(seconds=_MOTION_POLL_INTERVAL),
+                                functools.partial(_poll_started, process, start_time))
+
+    url = 'http://127.0.0.1:%(port)s/' % {'port': settings.MOTION_CONTROL_PORT}
+    request = HTTPRequest(url, connect_timeout=_MOTION_POLL_INTERVAL, request_timeout=_MOTION_CONTROL_TIMEOUT)
+    http_client = AsyncHTTPClient()
+    http_client.fetch(request, on_response)
+
+
+def _on_started(process, start_time):
+    import config
+    import mjpgclient
+
+    global _starting_process
+
+    _starting_process = None
+
+    logging.debug('motion started in %.1f seconds' % (time.time() - start_time))
+
     _disable_initial_motion_detection()
     
-    # if mjpg client idle timeout is disabled, create mjpg clients for all cameras by default
-    if not settings.MJPG_CLIENT_IDLE_TIMEOUT:
+    # if mjpg client idle timeout is disabled or frames are buffered,
+    # create mjpg clients for all cameras by default
+    if not settings.MJPG_CLIENT_IDLE_TIMEOUT or settings.FRAME_BUFFER_DURATION:
         logging.debug('creating default mjpg clients for local cameras')
-        for camera in enabled_local_motion_cameras:
+        for camera in config.get_enabled_local_motion_cameras():
             mjpgclient.get_jpg(camera['@id'])
 
 
-def stop(invalidate=False):
+def _on_start_failed(process, msg):
+    global _starting_process
+
+    _starting_process = None
+
+    logging.error('motion failed to start: %s' % msg)
+
+
+def stop(invalidate=False, wait=False, callback=None):
+    # the motion process is waited for in the background, unless wait is True;
+    # the optional callback is called once the process has exited
+
     import mjpgclient
     
     global _started
+    global _starting_process
+    global _stopping_pid
+    global _start_pending
     
     _started = False
+    _starting_process = None
+    _start_pending = False
+
+    if _stopping_pid is not None and not wait:  # already stopping
+        if callback:
+            _stop_callbacks.append(callback)
+
+        return
+
+    _stopping_pid = None
     
     if not running():
+        if callback:
+            callback()
+
         return
     
     logging.debug('stopping motion')
@@ -165,20 +255,25 @@ def stop(invalidate=False):
         try:
             # send the TERM signal once
             os.kill(pid, signal.SIGTERM)
-            
+
+            if not wait:
+                _stopping_pid = pid
+                if callback:
+                    _stop_callbacks.append(callback)
+
+                return _poll_stopped(pid, time.time(), killed=False)
+
             # wait 5 seconds for the process to exit
-            for i in xrange(50):  # @UnusedVariable
-                os.waitpid(pid, os.WNOHANG)
-                time.sleep(0.1)
+            if _wait_exit(pid, _MOTION_STOP_TIMEOUT):
+                return
 
             # send the KILL signal once
             os.kill(pid, signal.SIGKILL)
             
             # wait 2 seconds for the process to exit
-            for i in xrange(20):  # @UnusedVariable
-                time.sleep(0.1)
-                os.waitpid(pid, os.WNOHANG)
-                
+            if _wait_exit(pid, _MOTION_KILL_TIMEOUT):
+                return
+
             # the process still did not exit
             if settings.ENABLE_REBOOT:
                 logging.error('could not terminate the motion process')
@@ -191,6 +286,110 @@ def stop(invalidate=False):
             if e.errno not in (errno.ESRCH, errno.ECHILD):
                 raise
 
+    if callback:
+        callback()
+
+
+def _poll_stopped(pid, signal_time, killed):
+    global _stopping_pid
+
+    if pid != _stopping_pid:
+        return  # motion has been stopped synchronously meanwhile
+
+    try:
+        if _has_exited(pid):
+            return _on_stopped()
+
+        if time.time() - signal_time > (_MOTION_KILL_TIMEOUT if killed else _MOTION_STOP_TIMEOUT):
+            if killed:  # the process still did not exit
+                _stopping_pid = None
+                del _stop_callbacks[:]
+
+                logging.error('could not terminate the motion process')
+                if settings.ENABLE_REBOOT:
+                    powerctl.reboot()
+
+                return
+
+            logging.debug('motion did not exit in %s seconds, killing it' % _MOTION_STOP_TIMEOUT)
+
+            os.kill(pid, signal.SIGKILL)
+            killed = True
+            signal_time = time.time()
+
+    except OSError as e:
+        if e.errno not in (errno.ESRCH, errno.ECHILD):
+            _stopping_pid = None
+            del _stop_callbacks[:]
+
+            logging.error('failed to stop motion: %s' % e)
+
+            return
+
+        return _on_stopped()
+
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=_MOTION_POLL_INTERVAL),
+                        functools.partial(_poll_stopped, pid, signal_time, killed))
+
+
+def _on_stopped():
+    global _stopping_pid
+    global _stop_callbacks
+    global _start_pending
+
+    logging.debug('motion stopped')
+
+    _stopping_pid = None
+    callbacks, _stop_callbacks = _stop_callbacks, []
+
+    for callback in callbacks:
+        try:
+            callback()
+
+        except Exception as e:
+            logging.error('motion stop callback failed: %s' % e, exc_info=True)
+
+    if _start_pending:
+        _start_pending = False
+
+        try:
+            start()
+
+        except Exception as e:
+            logging.error('failed to start motion: %(msg)s' % {'msg': unicode(e)}, exc_info=True)
+
+
+def _has_exited(pid):
+    try:
+        os.waitpid(pid, os.WNOHANG)
+
+    except OSError as e:
+        if e.errno != errno.ECHILD:  # motion may not be our child process
+            raise
+
+    try:
+        os.kill(pid, 0)
+
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return True
+
+        raise
+
+    return False
+
+
+def _wait_exit(pid, timeout):
+    # returns as soon as the process has exited, instead of waiting for the whole timeout
+    for i in xrange(int(timeout * 10)):  # @UnusedVariable
+        if _has_exited(pid):
+            return True
+
+        time.sleep(0.1)
+
+    return False
+
 
 def running():
     pid = _get_pid()
@@ -18,15 +18,106 @@
 import functools
 import json
 import logging
+import os.path
 import re
+import time
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+import pycurl
+
+from tornado.curl_httpclient import CurlAsyncHTTPClient
+from tornado.httpclient import HTTPRequest
 
 import settings
 import utils
 
 _DOUBLE_SLASH_REGEX = re.compile('//+')
 
+_config_cache = {}  # remote camera configs, fetch state and pending callbacks, indexed by remote host
+
+_http_client = None
+_stats = {
+    'requests': 0,
+    'reused': 0,
+    'errors': 0,
+    'total_time': 0.0,
+    'connect_time': 0.0
+}
+
+
+class _RemoteHTTPClient(CurlAsyncHTTPClient):
+    # a curl client whose connections to the remote motionEye servers are kept alive and reused;
+    # libcurl keeps the idle connections in the connection cache of the multi handle,
+    # and queues the requests exceeding the per-host connection limit
+
+    def initialize(self, *args, **kwargs):
+        # the arguments differ between tornado versions (io_loop was removed in tornado 5)
+        CurlAsyncHTTPClient.initialize(self, *args, **kwargs)
+
+        # these options are missing from older libcurl/pycurl builds
+        max_host_connections = getattr(pycurl, 'M_MAX_HOST_CONNECTIONS', None)
+        if max_host_connections is not None:
+            self._multi.setopt(max_host_connections, max(1, settings.REMOTE_HOST_CONNECTIONS))
+
+        max_connects = getattr(pycurl, 'M_MAXCONNECTS', None)
+        if max_connects is not None:
+            self._multi.setopt(max_connects, len(self._curls))
+
+    def get_in_flight(self):
+        return len(self._curls) - len(self._free_list)
+    
+    def get_queued(self):
+        return len(self._requests)
+
+    def fetch_impl(self, request, callback):
+        def on_response(response):
+            _stats['requests'] += 1
+            if response.code == 599:  # no http response
+                _stats['errors'] += 1
+
+            elif response.time_info:
+                # curl reports no connect time for requests sent over a reused connection
+                if not response.time_info.get('connect'):
+                    _stats['reused'] += 1
+
+                _stats['total_time'] += response.time_info.get('total', 0)
+                _stats['connect_time'] += response.time_info.get('connect', 0)
+
+            callback(response)
+
+        CurlAsyncHTTPClient.fetch_impl(self, request, on_response)
+
+
+def _prepare_curl(curl):
+    curl.setopt(pycurl.HTTP_VERSION, pycurl.CURL_HTTP_VERSION_1_1)
+
+    tcp_keepalive = getattr(pycurl, 'TCP_KEEPALIVE', None)
+    if tcp_keepalive is not None:
+        curl.setopt(tcp_keepalive, 1)
+
+
+def _get_http_client():
+    global _http_client
+    
+    if _http_client is None:
+        _http_client = _RemoteHTTPClient(force_instance=True, max_clients=max(1, settings.REMOTE_MAX_IN_FLIGHT))
+    
+    return _http_client
+
+
+def get_stats():
+    succeeded = _stats['requests'] - _stats['errors']
+    
+    return {
+        'requests': _stats['requests'],
+        'errors': _stats['errors'],
+        'in_flight': _http_client.get_in_flight() if _http_client else 0,
+        'queued': _http_client.get_queued() if _http_client else 0,
+        'reused': _stats['reused'],
+        'reuse_rate': succeeded and float(_stats['reused']) / succeeded,
+        'avg_time': succeeded and _stats['total_time'] / succeeded,
+        'avg_connect_time': succeeded and _stats['connect_time'] / succeeded
+    }
+
 
 def _make_request(scheme, host, port, username, password, path, method='GET', data=None, query=None,
                   timeout=None, content_type=None):
@@ -59,7 +150,7 @@ def _make_request(scheme, host, port, username, password, path, method='GET', da
         headers['Content-Type'] = content_type
 
     return HTTPRequest(url, method, body=data, connect_timeout=timeout, request_timeout=timeout, headers=headers,
-                       validate_cert=settings.VALIDATE_CERTS)
+                       validate_cert=settings.VALIDATE_CERTS, prepare_curl_callback=_prepare_curl)
 
 
 def _callback_wrapper(callback):
@@ -166,7 +257,7 @@ def list(local_config, callback):
         
         callback(cameras)
     
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
     
 
@@ -204,10 +295,102 @@ def get_config(local_config, callback):
             
         callback(response)
     
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
     
 
+def get_cached_config(local_config, callback):
+    # calls back right away if the config of the remote camera is cached (even if it's stale),
+    # otherwise as soon as the configs of all the cameras on the remote host are retrieved;
+    # configs are fetched and refreshed in the background with a single request per remote host
+    
+    scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
+    key = (scheme, host, port, username, password, path)
+    
+    entry = _config_cache.get(key)
+    if entry is None:
+        entry = _config_cache[key] = {'time': 0, 'cameras': None, 'error': None, 'fetching': False, 'callbacks': []}
+
+    ttl = settings.REMOTE_CONFIG_CACHE_TTL
+    if ttl > 0 and entry['time']:
+        _respond_cached_config(entry, camera_id, callback)
+        
+    else:
+        entry['callbacks'].append((camera_id, callback))
+
+    if not entry['fetching'] and time.time() - entry['time'] >= ttl:
+        _fetch_host_config(local_config, key)
+
+
+def invalidate_cached_config(local_config):
+    scheme, host, port, username, password, path, _ = _remote_params(local_config)
+    entry = _config_cache.get((scheme, host, port, username, password, path))
+    if entry:
+        entry['time'] = 0
+
+
+def _fetch_host_config(local_config, key):
+    scheme, host, port, username, password, path, _ = _remote_params(local_config)
+    entry = _config_cache[key]
+    entry['fetching'] = True
+    
+    logging.debug('getting config for remote cameras on %(url)s' % {
+            'url': pretty_camera_url(local_config, camera=False)})
+
+    # ask the remote to wait for its own remote cameras, so that we get complete configs
+    request = _make_request(scheme, host, port, username, password,
+                            path + '/config/list/', query={'wait': 'true'})
+    
+    def on_response(response):
+        entry['fetching'] = False
+        entry['time'] = time.time()
+        entry['cameras'] = None
+        entry['error'] = None
+
+        if response.error:
+            logging.error('failed to get config for remote cameras on %(url)s: %(msg)s' % {
+                    'url': pretty_camera_url(local_config, camera=False),
+                    'msg': utils.pretty_http_error(response)})
+            
+            entry['error'] = utils.pretty_http_error(response)
+
+        else:
+            try:
+                cameras = json.loads(response.body)['cameras']
+                
+            except Exception as e:
+                logging.error('failed to decode json answer from %(url)s: %(msg)s' % {
+                        'url': pretty_camera_url(local_config, camera=False),
+                        'msg': unicode(e)})
+                
+                entry['error'] = unicode(e)
+            
+            else:
+                entry['cameras'] = {}
+                for camera in cameras:
+                    camera['host'] = host
+                    camera['port'] = port
+                    entry['cameras'][str(camera['id'])] = camera
+
+        callbacks, entry['callbacks'] = entry['callbacks'], []
+        for camera_id, callback in callbacks:
+            _respond_cached_config(entry, camera_id, callback)
+
+    http_client = _get_http_client()
+    http_client.fetch(request, _callback_wrapper(on_response))
+
+
+def _respond_cached_config(entry, camera_id, callback):
+    if entry['error']:
+        return callback(error=entry['error'])
+    
+    camera = entry['cameras'].get(str(camera_id))
+    if camera is None:
+        return callback(error='no such camera')
+    
+    callback(dict(camera))  # callers are free to alter the returned config
+
+
 def set_config(local_config, ui_config, callback):
     scheme = local_config.get('@scheme', local_config.get('scheme'))
     host = local_config.get('@host', local_config.get('host')) 
@@ -236,9 +419,10 @@ def set_config(local_config, ui_config, callback):
             
             return callback(error=utils.pretty_http_error(response))
     
+        invalidate_cached_config(local_config)
         callback()
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -266,7 +450,7 @@ def set_preview(local_config, controls, callback):
         
         callback()
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -296,7 +480,7 @@ def test(local_config, data, callback):
         
         callback()
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -335,11 +519,11 @@ def get_current_picture(local_config, width, height, callback):
 
         callback(motion_detected, capture_fps, monitor_info, response.body)
     
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
-def list_media(local_config, media_type, prefix, callback):
+def list_media(local_config, media_type, prefix, callback, since=None, until=None, cursor=None, limit=None):
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
     
     logging.debug('getting media list for remote camera %(id)s on %(url)s' % {
@@ -349,6 +533,18 @@ def list_media(local_config, media_type, prefix, callback):
     query = {}
     if prefix is not None:
         query['prefix'] = prefix
+
+    if since is not None:
+        query['since'] = repr(since)
+
+    if until is not None:
+        query['until'] = repr(until)
+
+    if cursor is not None:
+        query['cursor'] = cursor
+
+    if limit is not None:
+        query['limit'] = str(limit)
     
     # timeout here is 10 times larger than usual - we expect a big delay when fetching the media list
     p = path + '/%(media_type)s/%(id)s/list/' % {'id': camera_id, 'media_type': media_type}
@@ -376,7 +572,64 @@ def list_media(local_config, media_type, prefix, callback):
         
         return callback(response)
     
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
+    http_client.fetch(request, _callback_wrapper(on_response))
+
+
+def list_media_groups(local_config, media_type, callback):
+    scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
+
+    logging.debug('getting media groups for remote camera %(id)s on %(url)s' % {
+            'id': camera_id,
+            'url': pretty_camera_url(local_config)})
+
+    p = path + '/%(media_type)s/%(id)s/groups/' % {'id': camera_id, 'media_type': media_type}
+    request = _make_request(scheme, host, port, username, password, p,
+                            timeout=10 * settings.REMOTE_REQUEST_TIMEOUT)
+
+    def on_media_list(remote_list=None, error=None):
+        if error:
+            return callback(error=error)
+
+        # older remote servers don't know about groups,
+        # so they're computed here from the complete media list
+        groups = {}
+        for media in remote_list.get('mediaList', []):
+            name = os.path.dirname(media['path']).strip('/')
+            group = groups.setdefault(name, {'group': name, 'count': 0, 'size': None, 'timestamp': 0})
+            group['count'] += 1
+            group['timestamp'] = max(group['timestamp'], media.get('timestamp', 0))
+
+        callback({
+            'groups': sorted(groups.values(), key=lambda g: g['group'], reverse=True),
+            'cameraName': remote_list.get('cameraName')
+        })
+
+    def on_response(response):
+        if response.code in (400, 404):
+            return list_media(local_config, media_type, prefix=None, callback=on_media_list)
+
+        if response.error:
+            logging.error('failed to get media groups for remote camera %(id)s on %(url)s: %(msg)s' % {
+                    'id': camera_id,
+                    'url': pretty_camera_url(local_config),
+                    'msg': utils.pretty_http_error(response)})
+
+            return callback(error=utils.pretty_http_error(response))
+
+        try:
+            response = json.loads(response.body)
+
+        except Exception as e:
+            logging.error('failed to decode json answer from %(url)s: %(msg)s' % {
+                    'url': pretty_camera_url(local_config),
+                    'msg': unicode(e)})
+
+            return callback(error=unicode(e))
+
+        return callback(response)
+
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -409,7 +662,7 @@ def get_media_content(local_config, filename, media_type, callback):
         
         return callback(response.body)
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -455,7 +708,7 @@ def make_zipped_content(local_config, media_type, group, callback):
 
         callback({'key': key})
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -490,7 +743,7 @@ def get_zipped_content(local_config, media_type, key, group, callback):
             'content_disposition': response.headers.get('Content-Disposition')
         })
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -543,11 +796,11 @@ def make_timelapse_movie(local_config, framerate, interval, group, callback):
         
         callback(response)
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
-def check_timelapse_movie(local_config, group, callback):
+def check_timelapse_movie(local_config, group, callback, framerate=None, interval=None):
     scheme, host, port, username, password, path, camera_id = _remote_params(local_config)
     
     logging.debug('checking timelapse movie status for remote camera %(id)s on %(url)s' % {
@@ -557,7 +810,16 @@ def check_timelapse_movie(local_config, group, callback):
     p = path + '/picture/%(id)s/timelapse/%(group)s/?check=true' % {
             'id': camera_id,
             'group': group}
-    request = _make_request(scheme, host, port, username, password, p)
+
+    # timelapse jobs are identified by framerate and interval as well
+    query = {}
+    if framerate:
+        query['framerate'] = str(framerate)
+
+    if interval:
+        query['interval'] = str(interval)
+
+    request = _make_request(scheme, host, port, username, password, p, query=query)
     
     def on_response(response):
         if response.error:
@@ -580,7 +842,7 @@ def check_timelapse_movie(local_config, group, callback):
         
         callback(response)
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -614,7 +876,7 @@ def get_timelapse_movie(local_config, key, group, callback):
             'content_disposition': response.headers.get('Content-Disposition')
         })
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -653,7 +915,7 @@ def get_media_preview(local_config, filename, media_type, width, height, callbac
         
         callback(response.body)
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -685,7 +947,7 @@ def del_media_content(local_config, filename, media_type, callback):
         
         callback()
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -717,7 +979,7 @@ def del_media_group(local_config, group, media_type, callback):
         
         callback()
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
 
 
@@ -748,5 +1010,5 @@ def exec_action(local_config, action, callback):
         
         callback()
 
-    http_client = AsyncHTTPClient()
+    http_client = _get_http_client()
     http_client.fetch(request, _callback_wrapper(on_response))
@@ -0,0 +1,170 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import logging
+import time
+
+from tornado.ioloop import IOLoop
+
+import mediafiles
+import remote
+import settings
+
+
+_IDLE_TIMEOUT = 60  # relays that were not accessed for this many seconds are removed
+_SIZE_TIMEOUT = 5  # sizes that were not requested for this many seconds no longer count for fetching
+
+_relays = {}  # frame relays of remote cameras, indexed by camera id
+
+
+def start():
+    # schedule the garbage collector
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=_IDLE_TIMEOUT), _garbage_collector)
+
+
+def get_current_picture(local_config, width, height, callback):
+    # a single frame is fetched from the remote motionEye server at a time (and at most once per
+    # REMOTE_RELAY_INTERVAL seconds) and is shared by all the viewers of the remote camera;
+    # the callback has the same signature as the one of remote.get_current_picture()
+
+    camera_id = local_config['@id']
+    relay = _relays.get(camera_id)
+    if relay is None or relay['local_config'] != local_config:
+        logging.debug('creating frame relay for remote camera %(id)s' % {'id': camera_id})
+
+        relay = _relays[camera_id] = {
+            'local_config': dict(local_config),
+            'jpg': None,
+            'time': 0,
+            'resized_jpgs': {},  # resized versions of the last jpg, indexed by size
+            'sizes': {},  # sizes recently requested by the viewers, with the time of the last request
+            'motion_detected': False,
+            'capture_fps': 0,
+            'monitor_info': None,
+            'fetching': False,
+            'callbacks': [],
+            'last_access': 0
+        }
+
+    now = time.time()
+    relay['last_access'] = now
+    relay['sizes'][(width, height)] = now
+
+    if relay['jpg'] is not None and now - relay['time'] < settings.REMOTE_RELAY_INTERVAL:
+        return _respond(relay, width, height, callback)
+
+    relay['callbacks'].append((width, height, callback))
+    if not relay['fetching']:
+        _fetch(relay)
+
+
+def get_stats():
+    return {
+        'relays': len(_relays),
+        'waiting': sum(len(r['callbacks']) for r in _relays.itervalues())
+    }
+
+
+def _fetch(relay):
+    relay['fetching'] = True
+
+    def on_response(motion_detected=False, capture_fps=None, monitor_info=None, picture=None, error=None):
+        relay['fetching'] = False
+        callbacks, relay['callbacks'] = relay['callbacks'], []
+
+        if error:
+            relay['jpg'] = None
+
+        else:
+            relay['jpg'] = picture
+            relay['time'] = time.time()
+            relay['resized_jpgs'] = {}
+            relay['motion_detected'] = motion_detected
+            relay['capture_fps'] = capture_fps
+            relay['monitor_info'] = monitor_info
+
+        for width, height, callback in callbacks:
+            if relay['jpg'] is None:
+                callback(error=error)
+
+            else:
+                _respond(relay, width, height, callback)
+
+    if settings.REMOTE_RELAY_RESIZE:
+        # frames are fetched at full size and resized here, once for each size requested by the viewers
+        width, height = None, None
+
+    else:
+        width, height = _get_fetch_size(relay)
+
+    remote.get_current_picture(relay['local_config'], width=width, height=height, callback=on_response)
+
+
+def _get_fetch_size(relay):
+    # the frame is fetched at the largest size recently requested by the viewers, so that the remote server
+    # does the resizing (and enforces its own streaming resolution); a dimension is left unbounded (None)
+    # if any viewer wants it at full size, or if fractions and pixels are mixed and thus cannot be compared
+
+    now = time.time()
+    sizes = relay['sizes']
+    for size, t in sizes.items():
+        if now - t > _SIZE_TIMEOUT:
+            del sizes[size]
+
+    def largest(values):
+        if not values or None in values:
+            return None
+
+        fractions = [v < 1 for v in values]
+        if any(fractions) and not all(fractions):
+            return None
+
+        return max(values)
+
+    return (largest([w for w, h in sizes]) if sizes else None,
+            largest([h for w, h in sizes]) if sizes else None)
+
+
+def _respond(relay, width, height, callback):
+    picture = relay['jpg']
+    if settings.REMOTE_RELAY_RESIZE and (width is not None or height is not None):
+        try:
+            picture = mediafiles.resize_picture(picture, width, height, cache=relay['resized_jpgs'])
+
+        except Exception as e:
+            logging.error('failed to resize frame of remote camera %(id)s: %(msg)s' % {
+                    'id': relay['local_config']['@id'], 'msg': unicode(e)})
+
+            return callback(error=unicode(e))
+
+    # otherwise, the frame already has the largest size requested by the viewers and is scaled by the browsers
+    callback(relay['motion_detected'], relay['capture_fps'], relay['monitor_info'], picture)
+
+
+def _garbage_collector():
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=_IDLE_TIMEOUT), _garbage_collector)
+
+    now = time.time()
+    for camera_id, relay in _relays.items():
+        if now - relay['last_access'] > _IDLE_TIMEOUT and not relay['fetching']:
+            logging.debug('frame relay for remote camera %(id)s has been idle for %(timeout)s seconds, removing it' % {
+                    'id': camera_id, 'timeout': _IDLE_TIMEOUT})
+
+            del _relays[camera_id]
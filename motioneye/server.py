@@ -148,6 +148,12 @@ class Daemon(object):
 
 
 def _log_request(handler):
+    import metrics
+
+    metrics.observe('http_request_duration_seconds', handler.request.request_time(),
+                    handler=handler.__class__.__name__, op=(handler.path_kwargs or {}).get('op') or '',
+                    status=handler.get_status())
+
     log_method = None
 
     if handler.get_status() < 400:
@@ -171,10 +177,10 @@ handler_mapping = [
     (r'^/config/main/(?P<op>set|get)/?$', handlers.ConfigHandler),
     (r'^/config/(?P<camera_id>\d+)/(?P<op>get|set|rem|set_preview|test|authorize)/?$', handlers.ConfigHandler),
     (r'^/config/(?P<op>add|list|backup|restore)/?$', handlers.ConfigHandler),
-    (r'^/picture/(?P<camera_id>\d+)/(?P<op>current|list|frame)/?$', handlers.PictureHandler),
+    (r'^/picture/(?P<camera_id>\d+)/(?P<op>current|stream|burst|list|groups|frame)/?$', handlers.PictureHandler),
     (r'^/picture/(?P<camera_id>\d+)/(?P<op>download|preview|delete)/(?P<filename>.+?)/?$', handlers.PictureHandler),
     (r'^/picture/(?P<camera_id>\d+)/(?P<op>zipped|timelapse|delete_all)/(?P<group>.*?)/?$', handlers.PictureHandler),
-    (r'^/movie/(?P<camera_id>\d+)/(?P<op>list)/?$', handlers.MovieHandler),
+    (r'^/movie/(?P<camera_id>\d+)/(?P<op>list|groups)/?$', handlers.MovieHandler),
     (r'^/movie/(?P<camera_id>\d+)/(?P<op>preview|delete)/(?P<filename>.+?)/?$', handlers.MovieHandler),
     (r'^/movie/(?P<camera_id>\d+)/(?P<op>delete_all)/(?P<group>.*?)/?$', handlers.MovieHandler),
     (r'^/movie/(?P<camera_id>\d+)/playback/(?P<filename>.+?)/?$', handlers.MoviePlaybackHandler,{'path':r''}),
@@ -186,6 +192,8 @@ handler_mapping = [
     (r'^/update/?$', handlers.UpdateHandler),
     (r'^/power/(?P<op>shutdown|reboot)/?$', handlers.PowerHandler),
     (r'^/version/?$', handlers.VersionHandler),
+    (r'^/stats/?$', handlers.StatsHandler),
+    (r'^/metrics/?$', handlers.MetricsHandler),
     (r'^/login/?$', handlers.LoginHandler),
     (r'^.*$', handlers.NotFoundHandler),
 ]
@@ -348,11 +356,16 @@ def parse_options(parser, args):
 
 def run():
     import cleanup
+    import mediaindex
+    import metrics
     import mjpgclient
     import motionctl
     import motioneye
+    import remoterelay
     import smbctl
     import tasks
+    import thumbnails
+    import watchdog
     import wsswitch
 
     configure_signals()
@@ -372,6 +385,10 @@ def run():
     if settings.CLEANUP_INTERVAL:
         cleanup.start()
         logging.info('cleanup started')
+
+    if settings.MEDIA_INDEX_INTERVAL:
+        mediaindex.start()
+        logging.info('media index started')
         
     wsswitch.start()
     logging.info('wsswitch started')
@@ -379,10 +396,24 @@ def run():
     tasks.start()
     logging.info('tasks started')
 
+    metrics.start()
+    logging.info('metrics started')
+
+    if settings.IOLOOP_BLOCKING_THRESHOLD:
+        watchdog.start()
+        logging.info('IO loop watchdog started')
+
     if settings.MJPG_CLIENT_TIMEOUT:
         mjpgclient.start()
         logging.info('mjpg client garbage collector started')
 
+    remoterelay.start()
+    logging.info('remote frame relay garbage collector started')
+
+    if thumbnails.enabled():
+        thumbnails.start()
+        logging.info('thumbnail cache started')
+
     if settings.SMB_SHARES:
         smbctl.start()
         logging.info('smb mounts started')
@@ -407,8 +438,12 @@ def run():
         cleanup.stop()
         logging.info('cleanup stopped')
 
+    if mediaindex.running():
+        mediaindex.stop()
+        logging.info('media index stopped')
+
     if motionctl.running():
-        motionctl.stop()
+        motionctl.stop(wait=True)  # the IO loop is no longer running
         logging.info('motion stopped')
     
     if settings.SMB_SHARES:
@@ -44,6 +44,10 @@ MEDIA_PATH = '/var/lib/motioneye'
 # the log level (use FATAL, ERROR, WARNING, INFO or DEBUG)
 LOG_LEVEL = logging.INFO
 
+# log a stack sample whenever a callback blocks the IO loop for more than this many seconds
+# (set to 0 to disable)
+IOLOOP_BLOCKING_THRESHOLD = 0.0
+
 # the IP address to listen on
 # (0.0.0.0 for all interfaces, 127.0.0.1 for localhost)
 LISTEN = '0.0.0.0'
@@ -74,9 +78,65 @@ MOUNT_CHECK_INTERVAL = 300
 # to remove old pictures and movies
 CLEANUP_INTERVAL = 43200
 
+# maximum number of seconds a cleanup pass may run; the media files that are left to remove
+# (oldest first) are removed by the following passes, that run a minute apart
+# (set to 0 to remove all the expired media files in one pass)
+CLEANUP_TIME_SLICE = 0
+
+# minimum percentage of free space kept on each volume that holds media files; the oldest media files
+# of the cameras on a volume are removed whenever its free space drops below this percentage
+# (requires the media index; set to 0 to disable)
+MIN_FREE_SPACE = 0
+
+# interval in seconds at which the media index is reconciled with the files on disk
+# (set to 0 to disable the media index and always scan the media folders)
+MEDIA_INDEX_INTERVAL = 3600
+
+# server-side resized JPEG pictures are first decoded at a reduced scale (1/2, 1/4 or 1/8)
+# that keeps at least this many times the requested size; higher values improve
+# the quality of resized pictures at the expense of CPU time
+# (set to 0 to always decode pictures at full resolution before resizing)
+RESIZE_DRAFT_FACTOR = 1
+
+# maximum size in megabytes of the cache of media preview thumbnails (kept in MEDIA_PATH/.thumbnails);
+# the least recently used thumbnails are removed first (set to 0 to disable)
+THUMBNAIL_CACHE_SIZE = 64
+
+# media files that are ready to be uploaded within this many seconds
+# are sent together, over the same connection to the upload service
+# (set to 0 to upload each file separately)
+UPLOAD_BATCH_WINDOW = 2
+
+# number of worker processes that run background tasks
+# (such as movie previews and uploads to external services)
+TASK_WORKERS = 2
+
 # timeout in seconds to wait for response from a remote motionEye server
 REMOTE_REQUEST_TIMEOUT = 10
 
+# maximum number of requests that are simultaneously sent to remote motionEye servers
+REMOTE_MAX_IN_FLIGHT = 16
+
+# maximum number of (persistent) connections opened to each remote motionEye server
+REMOTE_HOST_CONNECTIONS = 4
+
+# frames of remote cameras are fetched from the remote motionEye servers at most once
+# every this many seconds and are shared by all the viewers of each camera
+REMOTE_RELAY_INTERVAL = 0.1
+
+# set to True to fetch the frames of remote cameras at full size and resize them here for each viewer,
+# instead of having the remote motionEye servers send them at the largest size requested by the viewers
+# (uses more bandwidth and CPU on this server and ignores the streaming resolution of the remote cameras)
+REMOTE_RELAY_RESIZE = False
+
+# number of seconds the configuration of remote cameras is considered fresh;
+# older configurations are still used, while being refreshed in the background
+# (set to 0 to always wait for the remote motionEye servers)
+REMOTE_CONFIG_CACHE_TTL = 30
+
+# timeout in seconds after which a camera monitor command is killed
+MONITOR_COMMAND_TIMEOUT = 10
+
 # timeout in seconds to wait for mjpg data from the motion daemon
 MJPG_CLIENT_TIMEOUT = 10
 
@@ -84,6 +144,14 @@ MJPG_CLIENT_TIMEOUT = 10
 # (set to 0 to disable)
 MJPG_CLIENT_IDLE_TIMEOUT = 10
 
+# number of seconds of recent frames kept in memory for each local camera,
+# available for download as a burst of pictures; mjpg clients are kept running while buffering
+# (set to 0 to disable)
+FRAME_BUFFER_DURATION = 0
+
+# maximum size in megabytes of the recent frames kept in memory for each local camera
+FRAME_BUFFER_SIZE = 16
+
 # enable SMB shares (requires motionEye to run as root) 
 SMB_SHARES = False
 
@@ -114,10 +182,10 @@ LIST_MEDIA_TIMEOUT = 120
 # timeout in seconds to wait for media files list, when sending emails
 LIST_MEDIA_TIMEOUT_EMAIL = 10
 
-# timeout in seconds to wait for zip file creation
+# timeout in seconds to wait for the list of files to be zipped
 ZIP_TIMEOUT = 500
 
-# timeout in seconds to wait for timelapse creation
+# timeout in seconds to wait for a timelapse job to make progress
 TIMELAPSE_TIMEOUT = 500
 
 # enable adding and removing cameras from UI
@@ -7,6 +7,7 @@ var pushConfigReboot = false;
 var adminPasswordChanged = false;
 var normalPasswordChanged = false;
 var refreshDisabled = {}; /* dictionary indexed by cameraId, tells if refresh is disabled for a given camera */
+var activeStreamImgs = []; /* camera imgs that are currently fed by a frame stream */
 var fullScreenCameraId = null;
 var inProgress = false;
 var refreshInterval = 15; /* milliseconds */
@@ -1839,6 +1840,7 @@ function cameraUi2Dict() {
         'network_username': $('#networkUsernameEntry').val(),
         'network_password': $('#networkPasswordEntry').val(),
         'root_directory': $('#rootDirectoryEntry').val(),
+        'max_storage': $('#maxStorageEntry').val(),
         'upload_enabled': $('#uploadEnabledSwitch')[0].checked,
         'upload_picture': $('#uploadPictureSwitch')[0].checked,
         'upload_movie': $('#uploadMovieSwitch')[0].checked,
@@ -2156,6 +2158,7 @@ function dict2CameraUi(dict) {
         this.setProgress(percent);
         this.setText((dict['disk_used'] / 1073741824).toFixed(1)  + '/' + (dict['disk_total'] / 1073741824).toFixed(1) + ' GB (' + percent + '%)');
     }); markHideIfNull('disk_used', 'diskUsageProgressBar');
+    $('#maxStorageEntry').val(dict['max_storage']); markHideIfNull('max_storage', 'maxStorageEntry');
     
     $('#uploadEnabledSwitch')[0].checked = dict['upload_enabled']; markHideIfNull('upload_enabled', 'uploadEnabledSwitch');
     $('#uploadPictureSwitch')[0].checked = dict['upload_picture']; markHideIfNull('upload_picture', 'uploadPictureSwitch');
@@ -3943,7 +3946,7 @@ function runAddCameraDialog() {
     updateUi();
 }
 
-function runTimelapseDialog(cameraId, groupKey, group) {
+function runTimelapseDialog(cameraId, groupKey, count) {
     var content = 
             $('<table class="timelapse-dialog">' +
                 '<tr><td colspan="2" class="timelapse-warning"></td></tr>' +
@@ -3979,7 +3982,7 @@ function runTimelapseDialog(cameraId, groupKey, group) {
     var framerateSlider = content.find('#framerateSlider');
     var timelapseWarning = content.find('td.timelapse-warning');
 
-    if (group.length > 1440) { /* one day worth of pictures, taken 1 minute apart */
+    if (count > 1440) { /* one day worth of pictures, taken 1 minute apart */
         timelapseWarning.html('Given the large number of pictures, creating your timelapse might take a while!');
         timelapseWarning.css('display', 'table-cell');
     }
@@ -4079,8 +4082,10 @@ function runMediaDialog(cameraId, mediaType) {
     var groupsDiv = $('<div class="media-dialog-groups"></div>');
     var buttonsDiv = $('<div class="media-dialog-buttons"></div>');
     
-    var groups = {};
+    var groups = {}; /* entries loaded so far, by group key */
+    var groupInfos = {}; /* count & paging state, by group key */
     var groupKey = null;
+    var pageSize = 100;
     
     dialogDiv.append(groupsDiv);
     dialogDiv.append(mediaListDiv);
@@ -4092,121 +4097,107 @@ function runMediaDialog(cameraId, mediaType) {
     var height = tempDiv.height();
     tempDiv.remove();
 
-    function showGroup(key) {
-        groupKey = key;
-        
-        if (mediaListDiv.find('img.media-list-progress').length) {
-            return; /* already in progress of loading */
-        }
-        
-        /* (re)set the current state of the group buttons */
+    function updateGroupButton(key) {
         groupsDiv.find('div.media-dialog-group-button').each(function () {
-            var $this = $(this);
             if (this.key == key) {
-                $this.addClass('current');
-            }
-            else {
-                $this.removeClass('current');
+                $(this).text((key || '(ungrouped)') + ' (' + groupInfos[key].count + ')');
             }
         });
-        
-        var mediaListByName = {};
-        var entries = groups[key];
-        
-        /* cleanup the media list */
-        mediaListDiv.children('div.media-list-entry').detach();
-        mediaListDiv.html('');
-        
-        function addEntries() {
-            /* add the entries to the media list */
-            entries.forEach(function (entry) {
-                var entryDiv = entry.div;
-                var detailsDiv = null;
-                
-                if (!entryDiv) {
-                    entryDiv = $('<div class="media-list-entry"></div>');
-                    
-                    var previewImg = $('<img class="media-list-preview" src="' + staticPath + 'img/modal-progress.gif"/>');
-                    entryDiv.append(previewImg);
-                    previewImg[0]._src = addAuthParams('GET', basePath + mediaType + '/' + cameraId + '/preview' + entry.path + '?height=' + height);
-                    
-                    var downloadButton = $('<div class="media-list-download-button button">Download</div>');
-                    entryDiv.append(downloadButton);
-                    
-                    var deleteButton = $('<div class="media-list-delete-button button">Delete</div>');
-                    if (isAdmin()) {
-                        entryDiv.append(deleteButton);
-                    }
+    }
 
-                    var nameDiv = $('<div class="media-list-entry-name">' + entry.name + '</div>');
-                    entryDiv.append(nameDiv);
-                    
-                    detailsDiv = $('<div class="media-list-entry-details"></div>');
-                    entryDiv.append(detailsDiv);
-                    
-                    downloadButton.click(function () {
-                        downloadFile(mediaType + '/' + cameraId + '/download' + entry.path);
-                        return false;
-                    });
-                    
-                    deleteButton.click(function () {
-                        doDeleteFile(basePath + mediaType + '/' + cameraId + '/delete' + entry.path, function () {
-                            entryDiv.remove();
-                            var pos = entries.indexOf(entry);
-                            if (pos >= 0) {
-                                entries.splice(pos, 1); /* remove entry from group */
-                            }
+    function addEntries(entries) {
+        /* add the entries to the media list */
+        entries.forEach(function (entry) {
+            var entryDiv = entry.div;
+            var detailsDiv = null;
+            
+            if (!entryDiv) {
+                entryDiv = $('<div class="media-list-entry"></div>');
+                
+                var previewImg = $('<img class="media-list-preview" src="' + staticPath + 'img/modal-progress.gif"/>');
+                entryDiv.append(previewImg);
+                previewImg[0]._src = addAuthParams('GET', basePath + mediaType + '/' + cameraId + '/preview' + entry.path + '?height=' + height);
+                
+                var downloadButton = $('<div class="media-list-download-button button">Download</div>');
+                entryDiv.append(downloadButton);
+                
+                var deleteButton = $('<div class="media-list-delete-button button">Delete</div>');
+                if (isAdmin()) {
+                    entryDiv.append(deleteButton);
+                }
 
-                            /* update text on group button */
-                            groupsDiv.find('div.media-dialog-group-button').each(function () {
-                                var $this = $(this);
-                                if (this.key == groupKey) {
-                                    var text = this.innerHTML;
-                                    text = text.substring(0, text.lastIndexOf(' '));
-                                    text += ' (' + entries.length + ')';
-                                    this.innerHTML = text;
-                                }
-                            });
-                        });
-                        
-                        return false;
-                    });
+                var nameDiv = $('<div class="media-list-entry-name">' + entry.name + '</div>');
+                entryDiv.append(nameDiv);
+                
+                detailsDiv = $('<div class="media-list-entry-details"></div>');
+                entryDiv.append(detailsDiv);
+                
+                downloadButton.click(function () {
+                    downloadFile(mediaType + '/' + cameraId + '/download' + entry.path);
+                    return false;
+                });
+                
+                deleteButton.click(function () {
+                    doDeleteFile(basePath + mediaType + '/' + cameraId + '/delete' + entry.path, function () {
+                        entryDiv.remove();
+                        var group = groups[entry.group];
+                        var pos = group.indexOf(entry);
+                        if (pos >= 0) {
+                            group.splice(pos, 1); /* remove entry from group */
+                        }
 
-                    entryDiv.click(function () {
-                        var pos = entries.indexOf(entry);
-                        runPictureDialog(entries, pos, mediaType);
+                        /* update text on group button */
+                        groupInfos[entry.group].count--;
+                        updateGroupButton(entry.group);
                     });
                     
-                    entry.div = entryDiv;
-                }
-                else {
-                    detailsDiv = entry.div.find('div.media-list-entry-details');
-                }                    
+                    return false;
+                });
+
+                entryDiv.click(function () {
+                    var group = groups[entry.group];
+                    var pos = group.indexOf(entry);
+                    runPictureDialog(group, pos, mediaType);
+                });
                 
-                var momentSpan = $('<span class="details-moment">' + entry.momentStr + ', </span>');
-                var momentShortSpan = $('<span class="details-moment-short">' + entry.momentStrShort + '</span>');
-                var sizeSpan = $('<span class="details-size">' + entry.sizeStr + '</span>');
-                detailsDiv.empty();
-                detailsDiv.append(momentSpan);
-                detailsDiv.append(momentShortSpan);
-                detailsDiv.append(sizeSpan);
-                mediaListDiv.append(entryDiv);
-            });
+                entry.div = entryDiv;
+            }
+            else {
+                detailsDiv = entry.div.find('div.media-list-entry-details');
+            }                    
+            
+            var momentSpan = $('<span class="details-moment">' + entry.momentStr + ', </span>');
+            var momentShortSpan = $('<span class="details-moment-short">' + entry.momentStrShort + '</span>');
+            var sizeSpan = $('<span class="details-size">' + entry.sizeStr + '</span>');
+            detailsDiv.empty();
+            detailsDiv.append(momentSpan);
+            detailsDiv.append(momentShortSpan);
+            detailsDiv.append(sizeSpan);
+            mediaListDiv.append(entryDiv);
+        });
 
-            /* trigger a scroll event */
-            mediaListDiv.scroll();
+        /* trigger a scroll event */
+        mediaListDiv.scroll();
+    }
+    
+    function loadNextPage(key) {
+        var info = groupInfos[key];
+        if (info.loading || info.complete) {
+            return;
         }
         
-        /* if details are already fetched, simply add the entries and return */
-        if (entries[0].timestamp) {
-            return addEntries();
-        }
+        info.loading = true;
         
         var previewImg = $('<img class="media-list-progress" src="' + staticPath + 'img/modal-progress.gif"/>');
         mediaListDiv.append(previewImg);
         
-        var url = basePath + mediaType + '/' + cameraId + '/list/?prefix=' + (key || 'ungrouped');
-        ajax('GET', url, null, function (data) {
+        var query = {group: key || 'ungrouped', limit: pageSize};
+        if (info.nextCursor) {
+            query.cursor = info.nextCursor;
+        }
+        
+        ajax('GET', basePath + mediaType + '/' + cameraId + '/list/', query, function (data) {
+            info.loading = false;
             previewImg.remove();
             
             if (data == null || data.error) {
@@ -4215,32 +4206,62 @@ function runMediaDialog(cameraId, mediaType) {
                 return;
             }
             
-            /* index the media list by name */
-            data.mediaList.forEach(function (media) {
-                var path = media.path;
-                var parts = path.split('/');
-                var name = parts[parts.length - 1];
+            var entries = data.mediaList.map(function (media) {
+                var parts = media.path.split('/');
                 
-                mediaListByName[name] = media;
+                return {
+                    'path': media.path,
+                    'group': key,
+                    'name': parts[parts.length - 1],
+                    'cameraId': cameraId,
+                    'mimeType': media.mimeType,
+                    'momentStr': media.momentStr,
+                    'momentStrShort': media.momentStrShort,
+                    'sizeStr': media.sizeStr,
+                    'timestamp': media.timestamp
+                };
             });
             
-            /* assign details to entries */
-                entries.forEach(function (entry) {
-                    var media = mediaListByName[entry.name];
-                    if (media) {
-                        entry.mimeType = media.mimeType;
-                        entry.momentStr = media.momentStr;
-                        entry.momentStrShort = media.momentStrShort;
-                        entry.sizeStr = media.sizeStr;
-                        entry.timestamp = media.timestamp;
-                    }
-                });
- 
-                /* sort the entries by timestamp */
-            entries.sortKey(function (e) {return e.timestamp || e.name;}, true);
+            /* servers that don't support paging return the whole group at once */
+            info.nextCursor = data.nextCursor;
+            info.complete = !data.nextCursor;
+            if (info.complete && !('nextCursor' in data)) {
+                entries.sortKey(function (e) {return e.timestamp || e.name;}, true);
+            }
+            
+            entries.forEach(function (entry) {
+                groups[key].push(entry);
+            });
             
-            addEntries();
+            if (groupKey == key) { /* the user might have switched to another group in the meantime */
+                addEntries(entries);
+            }
+        });
+    }
+    
+    function showGroup(key) {
+        groupKey = key;
+        
+        /* (re)set the current state of the group buttons */
+        groupsDiv.find('div.media-dialog-group-button').each(function () {
+            var $this = $(this);
+            if (this.key == key) {
+                $this.addClass('current');
+            }
+            else {
+                $this.removeClass('current');
+            }
         });
+        
+        /* cleanup the media list */
+        mediaListDiv.children('div.media-list-entry').detach();
+        mediaListDiv.html('');
+        
+        /* show the entries that were already fetched and load the next page, if any */
+        addEntries(groups[key]);
+        if (!groups[key].length) {
+            loadNextPage(key);
+        }
     }
     
     if (mediaType == 'picture') {
@@ -4258,7 +4279,7 @@ function runMediaDialog(cameraId, mediaType) {
         
         timelapseButton.click(function () {
             if (groupKey != null) {
-                runTimelapseDialog(cameraId, groupKey, groups[groupKey]);
+                runTimelapseDialog(cameraId, groupKey, groupInfos[groupKey].count);
             }
         });
     }
@@ -4280,10 +4301,13 @@ function runMediaDialog(cameraId, mediaType) {
                     
                     /* delete the group itself */
                     delete groups[groupKey];
+                    delete groupInfos[groupKey];
                     
                     /* show the first existing group, if any */
                     var keys = Object.keys(groups);
                     if (keys.length) {
+                        keys.sort();
+                        keys.reverse();
                         showGroup(keys[0]);
                     }
                     else {
@@ -4338,33 +4362,22 @@ function runMediaDialog(cameraId, mediaType) {
     
     showModalDialog('<div class="modal-progress"></div>');
     
-    /* fetch the media list */
-    ajax('GET', basePath + mediaType + '/' + cameraId + '/list/', null, function (data) {
+    /* fetch the media groups; the media entries are loaded later, page by page */
+    ajax('GET', basePath + mediaType + '/' + cameraId + '/groups/', null, function (data) {
         if (data == null || data.error) {
             hideModalDialog();
             showErrorMessage(data && data.error);
             return;
         }
         
-        /* group the media */
-        data.mediaList.forEach(function (media) {
-            var path = media.path;
-            var parts = path.split('/');
-            var keyParts = parts.splice(0, parts.length - 1);
-            var key = keyParts.join('/');
-            
-            if (key.indexOf('/') === 0) {
-                key = key.substring(1);
-            }
-            
-            var list = (groups[key] = groups[key] || []);
-            
-            list.push({
-                'path': path,
-                'group': key,
-                'name': parts[parts.length - 1],
-                'cameraId': cameraId
-            });
+        data.groups.forEach(function (group) {
+            groups[group.group] = [];
+            groupInfos[group.group] = {
+                count: group.count,
+                nextCursor: null,
+                complete: false,
+                loading: false
+            };
         });
         
         updateDialogSize();
@@ -4376,7 +4389,7 @@ function runMediaDialog(cameraId, mediaType) {
         if (keys.length) {
             keys.forEach(function (key) {
                 var groupButton = $('<div class="media-dialog-group-button"></div>');
-                groupButton.text((key || '(ungrouped)') + ' (' + groups[key].length + ')');
+                groupButton.text((key || '(ungrouped)') + ' (' + groupInfos[key].count + ')');
                 groupButton[0].key = key;
                 
                 groupButton.click(function () {
@@ -4450,6 +4463,13 @@ function runMediaDialog(cameraId, mediaType) {
                 delete this._src;
             }
         });
+        
+        /* load the next page of the current group when scrolled close to the bottom */
+        if (groupKey != null && groupInfos[groupKey] &&
+            mediaListDiv.scrollTop() + height >= mediaListDiv.prop('scrollHeight') - 2 * height) {
+            
+            loadNextPage(groupKey);
+        }
     });
 }
 
@@ -4743,7 +4763,10 @@ function addCameraFrameUi(cameraConfig) {
         /* there's no point in looking for a cookie update more often than once every second */
         var now = new Date().getTime();
         if ((!this.lastCookieTime || now - this.lastCookieTime > 1000) && (cameraFrameDiv[0].config['proto'] != 'mjpeg')) {
-            if (getCookie('motion_detected_' + cameraId) == 'true') {
+            /* frame metadata comes in-band when streaming, in cookies when polling */
+            var streamMeta = this.streamMeta;
+            var motionDetected = streamMeta ? streamMeta.motionDetected : getCookie('motion_detected_' + cameraId) == 'true';
+            if (motionDetected) {
                 cameraFrameDiv.addClass('motion-detected');
             }
             else {
@@ -4757,8 +4780,8 @@ function addCameraFrameUi(cameraConfig) {
                 recordButton.removeClass('record-stop').addClass('record-start');
             }
             
-            var captureFps = getCookie('capture_fps_' + cameraId);
-            var monitorInfo = getCookie('monitor_info_' + cameraId);
+            var captureFps = streamMeta ? streamMeta.captureFps : getCookie('capture_fps_' + cameraId);
+            var monitorInfo = streamMeta ? streamMeta.monitorInfo : getCookie('monitor_info_' + cameraId);
             
             this.lastCookieTime = now;
 
@@ -4817,6 +4840,9 @@ function remCameraFrameUi(cameraId) {
 
 function recreateCameraFrames(cameras) {
     function updateCameras(cameras) {
+        var pendingCameraIds = cameras.filter(function (camera) {return camera.pending;}).map(function (camera) {
+            return camera.id;
+        });
         cameras = cameras.filter(function (camera) {return camera.enabled;});
         var i, camera;
 
@@ -4839,6 +4865,26 @@ function recreateCameraFrames(cameras) {
                     '<a href="javascript:runAddCameraDialog()">You have not configured any camera yet. Click here to add one...</a></div>');
             getPageContainer().append(addCameraLink);
         }
+
+        /* remote cameras whose configuration was not available yet are added as soon as it arrives */
+        if (pendingCameraIds.length) {
+            ajax('GET', basePath + 'config/list/?wait=true', null, function (data) {
+                if (data == null || data.error) {
+                    return;
+                }
+                
+                data.cameras.forEach(function (camera) {
+                    if (pendingCameraIds.indexOf(camera.id) < 0) {
+                        return;
+                    }
+                    
+                    $('#cameraSelect').find('option[value=' + camera.id + ']').html(camera.name);
+                    if (camera.enabled && !getCameraFrame(camera.id).length) {
+                        addCameraFrameUi(camera);
+                    }
+                });
+            });
+        }
     }
     
     if (cameras != null) {
@@ -4986,11 +5032,163 @@ function isFullScreen() {
     return fullScreenCameraId != null;   
 }
 
+function isCameraStreamingSupported() {
+    return Boolean(window.fetch && window.ReadableStream && window.Uint8Array && window.Blob &&
+                   window.URL && window.URL.createObjectURL);
+}
+
+function parseCameraStreamParts(buffer, onPart) {
+    /* consumes all the complete parts found in the buffer and returns what's left of it */
+    while (true) {
+        var headersEnd = -1;
+        for (var i = 0; i < buffer.length - 3; i++) {
+            if (buffer[i] == 13 && buffer[i + 1] == 10 && buffer[i + 2] == 13 && buffer[i + 3] == 10) {
+                headersEnd = i;
+                break;
+            }
+        }
+        
+        if (headersEnd < 0) {
+            return buffer; /* headers not completely received yet */
+        }
+        
+        var headers = {};
+        var lines = String.fromCharCode.apply(null, buffer.subarray(0, headersEnd)).split('\r\n');
+        lines.forEach(function (line) {
+            var pos = line.indexOf(':');
+            if (pos > 0) {
+                headers[line.substring(0, pos).trim().toLowerCase()] = line.substring(pos + 1).trim();
+            }
+        });
+        
+        var length = parseInt(headers['content-length']);
+        var start = headersEnd + 4;
+        if (isNaN(length)) {
+            buffer = buffer.subarray(start);
+            continue;
+        }
+        
+        if (buffer.length < start + length) {
+            return buffer; /* body not completely received yet */
+        }
+        
+        onPart(headers, buffer.subarray(start, start + length));
+        buffer = buffer.subarray(start + length);
+    }
+}
+
+function startCameraStream(cameraId, img, query) {
+    var controller = window.AbortController ? new AbortController() : null;
+    var stream = {query: query, controller: controller, reader: null, stopped: false};
+    
+    img.stream = stream;
+    activeStreamImgs.push(img);
+    
+    function endStream(retry) {
+        if (img.stream !== stream) {
+            return; /* stopped or replaced in the meantime */
+        }
+        
+        stopCameraStream(img);
+        if (retry) {
+            /* fall back to polling for a while */
+            img.streamRetryTime = new Date().getTime() + 5000;
+        }
+        else {
+            img.streamUnsupported = true;
+        }
+    }
+    
+    function onPart(headers, jpg) {
+        if (stream.stopped || img.loading) {
+            return; /* the previous frame is still being decoded, skip this one */
+        }
+        
+        img.streamMeta = {
+            motionDetected: headers['x-motion-detected'] == 'true',
+            captureFps: headers['x-capture-fps'],
+            monitorInfo: headers['x-monitor-info']
+        };
+        
+        if (img.streamUrl) {
+            URL.revokeObjectURL(img.streamUrl);
+        }
+        
+        img.streamUrl = URL.createObjectURL(new Blob([jpg], {type: 'image/jpeg'}));
+        img.src = img.streamUrl;
+        img.loading = 1;
+    }
+    
+    var path = basePath + 'picture/' + cameraId + '/stream/?_=' + new Date().getTime() + query;
+    path = addAuthParams('GET', path);
+    
+    var options = {credentials: 'same-origin'};
+    if (controller) {
+        options.signal = controller.signal;
+    }
+
+    fetch(path, options).then(function (response) {
+        if (response.status == 400) {
+            /* streaming not available for this camera (e.g. remote cameras) */
+            return endStream(false);
+        }
+        if (!response.ok || !response.body || stream.stopped) {
+            return endStream(true);
+        }
+        
+        stream.reader = response.body.getReader();
+        var buffer = new Uint8Array(0);
+        
+        function read() {
+            return stream.reader.read().then(function (result) {
+                if (result.done || stream.stopped) {
+                    return endStream(true);
+                }
+                
+                var newBuffer = new Uint8Array(buffer.length + result.value.length);
+                newBuffer.set(buffer, 0);
+                newBuffer.set(result.value, buffer.length);
+                buffer = parseCameraStreamParts(newBuffer, onPart);
+                
+                return read();
+            });
+        }
+        
+        return read();
+    }).catch(function () {
+        endStream(true);
+    });
+}
+
+function stopCameraStream(img) {
+    var pos = activeStreamImgs.indexOf(img);
+    if (pos >= 0) {
+        activeStreamImgs.splice(pos, 1);
+    }
+    
+    var stream = img.stream;
+    if (!stream) {
+        return;
+    }
+    
+    stream.stopped = true;
+    if (stream.controller) {
+        stream.controller.abort();
+    }
+    else if (stream.reader) {
+        stream.reader.cancel();
+    }
+    
+    img.stream = null;
+    img.loading = 0;
+}
+
 function refreshCameraFrames() {
     var timestamp = new Date().getTime();
 
     if ($('div.modal-container').is(':visible')) {
         /* pause camera refresh if hidden by a dialog */
+        activeStreamImgs.slice().forEach(stopCameraStream);
         return setTimeout(refreshCameraFrames, 1000);
     }
 
@@ -5022,9 +5220,15 @@ function refreshCameraFrames() {
         
         path = addAuthParams('GET', path);
         
+        img.streamMeta = null;
         img.src = path;
         img.loading = 1;
     }
+    
+    function canStreamCameraFrame(img) {
+        return (isCameraStreamingSupported() && !img.streamUnsupported && framerateFactor != 0 &&
+                !(img.streamRetryTime > timestamp));
+    }
 
     var cameraFrames;
     if (fullScreenCameraId != null && fullScreenCameraId >= 0) {
@@ -5034,6 +5238,14 @@ function refreshCameraFrames() {
         cameraFrames = getCameraFrames();
     }
     
+    /* stop the streams of the cameras that are no longer refreshed (hidden or removed) */
+    var refreshedImgs = cameraFrames.map(function () {return this.img;}).get();
+    activeStreamImgs.slice().forEach(function (img) {
+        if (refreshedImgs.indexOf(img) < 0) {
+            stopCameraStream(img);
+        }
+    });
+    
     cameraFrames.each(function () {
         if (!this.img) {
             this.img = $(this).find('img.camera')[0];
@@ -5059,6 +5271,34 @@ function refreshCameraFrames() {
 
         count /= framerateFactor;
 
+        /* frames are pushed by the server, whenever streaming is possible */
+        if (canStreamCameraFrame(this.img)) {
+            if (refreshDisabled[cameraId]) {
+                stopCameraStream(this.img);
+                return;
+            }
+            
+            var query = '&fps=' + this.config['streaming_framerate'] * framerateFactor;
+            if (resolutionFactor != 1) {
+                query += '&width=' + resolutionFactor;
+            }
+            else if (serverSideResize && this.img.width) {
+                query += '&width=' + this.img.width;
+            }
+            
+            if (this.img.stream && this.img.stream.query != query) {
+                stopCameraStream(this.img);
+            }
+            if (!this.img.stream) {
+                startCameraStream(cameraId, this.img, query);
+            }
+            
+            return;
+        }
+        else if (this.img.stream) {
+            stopCameraStream(this.img);
+        }
+
         /* if frameFactor is 0, we only want one camera refresh at the beginning,
          * and no subsequent refreshes at all */
         if (framerateFactor == 0 && this.refreshDivider == 0) {
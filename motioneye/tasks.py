@@ -18,26 +18,56 @@
 import calendar
 import cPickle
 import datetime
+import heapq
 import logging
 import multiprocessing
+import multiprocessing.queues
 import os
 import time
 
 from tornado.ioloop import IOLoop
 
+import metrics
 import settings
 
 
 _INTERVAL = 2
 _STATE_FILE_NAME = 'tasks.pickle'
-_MAX_TASKS = 100
-
-# we must be sure there's only one extra process that handles all tasks
-# TODO replace the pool with one simple thread
-_POOL_SIZE = 1
-
-_tasks = []
+_JOURNAL_FILE_NAME = 'tasks.journal'
+_JOURNAL_COMPACT_RECORDS = 1000  # the journal is rewritten once it holds this many records more than twice the pending tasks
+_MAX_TASKS = 1000
+
+PRIORITY_LOW = -10
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 10
+
+# maximum number of tasks of a group that may run at the same time;
+# tasks are grouped by the module of their function
+# (all the upload services share one state file, so they must run one at a time)
+_GROUP_LIMITS = {
+    'uploadservices': 1
+}
+
+_tasks = []  # heap of scheduled tasks: [when, -priority, seq, func, tag, callback, params, added]
+_ready = []  # heap of due tasks, ordered by priority: (-priority, seq, task)
+_seq = 0
+_running = {}  # number of running tasks indexed by group
+_in_flight = {}  # (task, group) of the running tasks indexed by seq, kept in the journal until done
+_task_pids = {}  # pids of the worker processes running the tasks, indexed by seq
+_started_queue = None  # (seq, pid) of the tasks started by the worker processes
+_result_handlers = {}  # functions called in the main process with the results of tasks, indexed by task function
 _pool = None
+_journal_file = None
+_journal_records = 0
+
+_stats = {
+    'added': 0,
+    'dropped': 0,
+    'completed': 0,
+    'failed': 0,
+    'wait_time': 0,
+    'run_time': 0
+}
 
 
 def start():
@@ -52,19 +82,31 @@ def start():
         signal.signal(signal.SIGINT, signal.SIG_IGN)
         signal.signal(signal.SIGTERM, signal.SIG_IGN)
 
+    global _started_queue
+
     _load()
-    _pool = multiprocessing.Pool(_POOL_SIZE, initializer=init_pool_process)
+    _started_queue = multiprocessing.queues.SimpleQueue()
+    _pool = multiprocessing.Pool(max(1, settings.TASK_WORKERS), initializer=init_pool_process)
 
 
 def stop():
     global _pool
+    global _journal_file
     
     _pool = None
 
+    if _journal_file:
+        _journal_file.close()
+        _journal_file = None
 
-def add(when, func, tag=None, callback=None, **params):
-    if len(_tasks) >= _MAX_TASKS:
-        return logging.error('the maximum number of tasks (%d) has been reached' % _MAX_TASKS)
+
+def add(when, func, tag=None, callback=None, priority=PRIORITY_NORMAL, **params):
+    global _seq
+
+    if len(_tasks) + len(_ready) >= _MAX_TASKS:
+        _stats['dropped'] += 1
+        return logging.error('the maximum number of tasks (%d) has been reached, dropping task "%s"' % (
+                _MAX_TASKS, tag or func.func_name))
     
     now = time.time()
     
@@ -77,14 +119,43 @@ def add(when, func, tag=None, callback=None, **params):
     elif isinstance(when, datetime.datetime):
         when = calendar.timegm(when.timetuple())
 
-    i = 0
-    while i < len(_tasks) and _tasks[i][0] <= when:
-        i += 1
+    _seq += 1
+    task = [when, -priority, _seq, func, tag, callback, params, now]
 
     logging.debug('adding task "%s" in %d seconds' % (tag or func.func_name, when - now))
-    _tasks.insert(i, (when, func, tag, callback, params))
+    heapq.heappush(_tasks, task)
+    _stats['added'] += 1
+
+    # tasks that have a callback cannot be restored after a restart
+    if not callback:
+        _journal_append(('add', task))
+
+
+def add_result_handler(func, handler):
+    # handler will be called in the main process with the result of each successful task running func;
+    # unlike callbacks, result handlers don't prevent tasks from being restored after a restart
+    _result_handlers[func] = handler
+
+
+def get_stats():
+    finished = _stats['completed'] + _stats['failed']
+
+    return {
+        'queued': len(_tasks) + len(_ready),
+        'due': len(_ready),
+        'running': len(_in_flight),
+        'workers': settings.TASK_WORKERS,
+        'added': _stats['added'],
+        'dropped': _stats['dropped'],
+        'completed': _stats['completed'],
+        'failed': _stats['failed'],
+        'avg_wait_time': finished and _stats['wait_time'] / finished,
+        'avg_run_time': finished and _stats['run_time'] / finished
+    }
+
 
-    _save()
+def _get_group(func):
+    return func.__module__
 
 
 def _check_tasks():
@@ -92,67 +163,252 @@ def _check_tasks():
     io_loop.add_timeout(datetime.timedelta(seconds=_INTERVAL), _check_tasks)
     
     now = time.time()
-    changed = False
     while _tasks and _tasks[0][0] <= now:
-        (when, func, tag, callback, params) = _tasks.pop(0)  # @UnusedVariable
-        
-        logging.debug('executing task "%s"' % tag or func.func_name)
-        _pool.apply_async(func, kwds=params, callback=callback if callable(callback) else None)
+        task = heapq.heappop(_tasks)
+        heapq.heappush(_ready, (task[1], task[2], task))
 
-        changed = True
-    
-    if changed:
-        _save()
+    _reap_lost()
+    _dispatch()
+
+    if _tasks or _ready or _in_flight:
+        logging.debug('tasks: %(queued)s queued, %(due)s due, %(running)s running' % get_stats())
+
+
+def _dispatch():
+    # tasks are handed to the pool only when a worker is free,
+    # otherwise they would wait in the pool's own queue regardless of their priority
+
+    if _pool is None:
+        return
+
+    now = time.time()
+    postponed = []
+    while _ready and len(_in_flight) < max(1, settings.TASK_WORKERS):
+        task = heapq.heappop(_ready)[2]
+        func, tag = task[3], task[4]
+
+        group = _get_group(func)
+        limit = _GROUP_LIMITS.get(group)
+        if limit and _running.get(group, 0) >= limit:
+            postponed.append(task)
+            continue
+
+        logging.debug('executing task "%s"' % (tag or func.func_name))
+        _running[group] = _running.get(group, 0) + 1
+        _in_flight[task[2]] = (task, group)
+        _pool.apply_async(_run_task, args=(task[2], func, task[6]), callback=_make_done_callback(task, group, now))
+
+    for task in postponed:
+        heapq.heappush(_ready, (task[1], task[2], task))
+
+
+def _reap_lost():
+    # the pool never reports the tasks whose worker process died (there's no error callback in python 2),
+    # so these are given up on, to free their worker slot and group; tasks are never given up on
+    # while their worker is alive, as the group limits must hold for as long as they actually run
+
+    if _pool is None:
+        return
+
+    while not _started_queue.empty():
+        (seq, pid) = _started_queue.get()
+        if seq in _in_flight:
+            _task_pids[seq] = pid
+
+    # the pool replaces the workers that died
+    alive_pids = set(p.pid for p in _pool._pool if p.is_alive())
+
+    for seq, pid in _task_pids.items():
+        if pid in alive_pids:
+            continue
+
+        (task, group) = _in_flight.pop(seq)
+        del _task_pids[seq]
+        (when, priority, seq, func, tag, callback, params, added) = task  # @UnusedVariable
+
+        logging.error('worker process %s of task "%s" died, giving up on it' % (pid, tag or func.func_name))
+
+        _running[group] -= 1
+        _stats['failed'] += 1
+
+        if not callback:
+            _journal_append(('done', seq))
+
+
+def _run_task(seq, func, params):
+    # this will be executed in a pool process;
+    # exceptions are caught here so that the main process is always notified
+    # and the running counters are kept accurate
+
+    _started_queue.put((seq, os.getpid()))  # so that the main process notices if this worker dies
+
+    started = time.time()
+    try:
+        return (True, func(**params), time.time() - started)
+
+    except Exception as e:
+        logging.error('task "%s" failed: %s' % (func.func_name, e), exc_info=True)
+
+        return (False, None, time.time() - started)
+
+
+def _make_done_callback(task, group, started):
+    def on_result(result):
+        # called from the pool's result thread
+        io_loop.add_callback(on_done, result)
+
+    def on_done(result):
+        (success, value, run_time) = result
+        (when, priority, seq, func, tag, callback, params, added) = task  # @UnusedVariable
+
+        _task_pids.pop(seq, None)
+        if _in_flight.pop(seq, None) is None:
+            logging.debug('ignoring the late result of task "%s"' % (tag or func.func_name))
+
+            return _dispatch()
+
+        _running[group] -= 1
+        _stats['completed' if success else 'failed'] += 1
+        _stats['wait_time'] += started - max(when, added)
+        _stats['run_time'] += run_time
+        metrics.observe('task_wait_seconds', started - max(when, added), func=func.func_name)
+        metrics.observe('task_run_seconds', run_time, func=func.func_name)
+
+        logging.debug('task "%s" finished in %.2f seconds' % (tag or func.func_name, run_time))
+
+        if not callback:
+            _journal_append(('done', seq))
+
+        if callable(callback) and success:
+            callback(value)
+
+        handler = _result_handlers.get(func)
+        if handler and success:
+            try:
+                handler(value)
+
+            except Exception as e:
+                logging.error('result handler of task "%s" failed: %s' % (tag or func.func_name, e), exc_info=True)
+
+        _dispatch()
+
+    io_loop = IOLoop.instance()
+
+    return on_result
 
 
 def _load():
     global _tasks
+    global _seq
     
     _tasks = []
+    tasks_by_seq = {}
 
+    # tasks saved by older versions as one pickled list
     file_path = os.path.join(settings.CONF_PATH, _STATE_FILE_NAME)
-    
     if os.path.exists(file_path):
         logging.debug('loading tasks from "%s"...' % file_path)
-    
+
         try:
-            f = open(file_path, 'r')
-        
+            with open(file_path, 'r') as f:
+                for (when, func, tag, callback, params) in cPickle.load(f):  # @UnusedVariable
+                    _seq += 1
+                    tasks_by_seq[_seq] = [when, -PRIORITY_NORMAL, _seq, func, tag, None, params, when]
+
+            os.remove(file_path)
+
         except Exception as e:
-            logging.error('could not open tasks file "%s": %s' % (file_path, e))
-            
-            return
-        
+            logging.error('could not read tasks from file "%s": %s' % (file_path, e))
+
+    file_path = os.path.join(settings.CONF_PATH, _JOURNAL_FILE_NAME)
+    if os.path.exists(file_path):
+        logging.debug('loading tasks from "%s"...' % file_path)
+
         try:
-            _tasks = cPickle.load(f)
+            with open(file_path, 'rb') as f:
+                while True:
+                    try:
+                        (op, arg) = cPickle.load(f)
+
+                    except EOFError:
+                        break
+
+                    except Exception as e:  # most likely a record truncated by a crash
+                        logging.error('could not read task record from file "%s": %s' % (file_path, e))
+                        break
+
+                    if op == 'add':
+                        tasks_by_seq[arg[2]] = arg
+                        _seq = max(_seq, arg[2])
+
+                    elif op == 'done':
+                        tasks_by_seq.pop(arg, None)
 
         except Exception as e:
-            logging.error('could not read tasks from file "%s": %s' % (file_path, e))
+            logging.error('could not open tasks file "%s": %s' % (file_path, e))
 
-        finally:
-            f.close()
-            
+    _tasks = tasks_by_seq.values()
+    heapq.heapify(_tasks)
 
-def _save():
-    file_path = os.path.join(settings.CONF_PATH, _STATE_FILE_NAME)
+    _journal_compact()
 
-    logging.debug('saving tasks to "%s"...' % file_path)
+
+def _journal_append(record):
+    global _journal_records
+
+    # compacting relative to the number of pending tasks keeps the cost of each record constant,
+    # even when the journal holds many pending tasks
+    pending = len(_tasks) + len(_ready) + len(_in_flight)
+    if _journal_records > 2 * pending + _JOURNAL_COMPACT_RECORDS:
+        return _journal_compact()
+
+    if not _journal_file:
+        return
 
     try:
-        f = open(file_path, 'w')
+        cPickle.dump(record, _journal_file, cPickle.HIGHEST_PROTOCOL)
+        _journal_file.flush()
+        _journal_records += 1
 
     except Exception as e:
-        logging.error('could not open tasks file "%s": %s' % (file_path, e))
-        
-        return
+        logging.error('could not save task to file "%s": %s' % (_journal_file.name, e))
+
+
+def _journal_compact():
+    # rewrites the journal so that it only contains the pending tasks
+    global _journal_file
+    global _journal_records
+
+    file_path = os.path.join(settings.CONF_PATH, _JOURNAL_FILE_NAME)
+
+    logging.debug('saving tasks to "%s"...' % file_path)
+
+    if _journal_file:
+        _journal_file.close()
+        _journal_file = None
+
+    _journal_records = 0
 
     try:
-        # don't save tasks that have a callback
-        tasks = [t for t in _tasks if not t[3]]
-        cPickle.dump(tasks, f)
+        with open(file_path + '.tmp', 'wb') as f:
+            # don't save tasks that have a callback
+            for task in _tasks + [t[2] for t in _ready] + [t for (t, g) in _in_flight.values()]:
+                if not task[5]:
+                    cPickle.dump(('add', task), f, cPickle.HIGHEST_PROTOCOL)
+                    _journal_records += 1
+
+        os.rename(file_path + '.tmp', file_path)
+        _journal_file = open(file_path, 'ab')
 
     except Exception as e:
         logging.error('could not save tasks to file "%s": %s' % (file_path, e))
 
-    finally:
-        f.close()
+
+def _collect_metrics():
+    return [
+        ('tasks_queued', {}, len(_tasks) + len(_ready)),
+        ('tasks_running', {}, len(_in_flight))
+    ]
+
+
+metrics.add_collector(_collect_metrics)
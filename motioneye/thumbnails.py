@@ -0,0 +1,236 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import errno
+import hashlib
+import logging
+import math
+import os
+import StringIO
+
+from PIL import Image
+
+import metrics
+import settings
+
+
+_CACHE_DIR_NAME = '.thumbnails'
+_SIZES = (128, 256, 512)  # the pyramid levels, as the maximum width and height of the thumbnails
+_QUALITY = 85
+
+PREVIEW_MAX_AGE = 86400  # seconds browsers may keep a preview before revalidating it
+
+_entries = collections.OrderedDict()  # cached thumbnail sizes, indexed by path, least recently used first
+_total_size = 0
+
+
+def start():
+    # the cache index is rebuilt from the files on disk, in the order they were last used
+    global _total_size
+
+    cache_dir = get_cache_dir()
+    files = []
+    for (dir_path, dir_names, file_names) in os.walk(cache_dir):  # @UnusedVariable
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            try:
+                st = os.stat(path)
+
+            except OSError:
+                continue
+
+            files.append((st.st_mtime, path, st.st_size))
+
+    files.sort()
+    _entries.clear()
+    _total_size = 0
+    for (mtime, path, size) in files:  # @UnusedVariable
+        _entries[path] = size
+        _total_size += size
+
+    logging.debug('thumbnail cache contains %(count)s files (%(size)s bytes)' % {
+            'count': len(_entries), 'size': _total_size})
+
+    _evict()
+
+
+def enabled():
+    return bool(settings.THUMBNAIL_CACHE_SIZE)
+
+
+def get_cache_dir():
+    return os.path.join(settings.MEDIA_PATH, _CACHE_DIR_NAME)
+
+
+def get_etag(full_path, width, height):
+    # the etag changes whenever the picture file is replaced, without having to read it
+    try:
+        st = os.stat(full_path)
+
+    except OSError:
+        return None
+
+    return '"%s-%s-%s"' % (_get_key(full_path, st), width or '', height or '')
+
+
+def get_thumbnail(full_path, width, height):
+    # returns the picture resized to fit in width x height, made out of the smallest cached thumbnail
+    # that is large enough, or None if the cache cannot be used for this size
+
+    try:
+        st = os.stat(full_path)
+        size = Image.open(full_path).size  # only the header is read here
+
+    except Exception as e:
+        logging.error('failed to open picture %(path)s: %(msg)s' % {'path': full_path, 'msg': unicode(e)})
+        return None
+
+    width = width and int(width) or size[0]
+    height = height and int(height) or size[1]
+    scale = min(float(width) / size[0], float(height) / size[1], 1)
+    needed = int(math.ceil(max(size) * scale))
+
+    levels = [l for l in _SIZES if l >= needed]
+    if not levels:
+        return None
+
+    path = _get_path(_get_key(full_path, st), levels[0])
+    if path in _entries:
+        metrics.inc('thumbnail_cache_hits_total')
+        _touch(path)
+
+    else:
+        metrics.inc('thumbnail_cache_misses_total')
+        add_files(make_thumbnails(full_path))
+
+    try:
+        with open(path) as f:
+            content = f.read()
+
+    except IOError as e:
+        logging.error('failed to read thumbnail %(path)s: %(msg)s' % {'path': path, 'msg': unicode(e)})
+        return None
+
+    image = Image.open(StringIO.StringIO(content))
+    if image.size[0] <= width and image.size[1] <= height:
+        return content
+
+    image.thumbnail((width, height), Image.ANTIALIAS)
+
+    sio = StringIO.StringIO()
+    image.save(sio, format='JPEG', quality=_QUALITY)
+
+    return sio.getvalue()
+
+
+def make_thumbnails(full_path):
+    # decodes the picture once and writes all the levels of its thumbnail pyramid to the cache;
+    # may run in a task worker, in which case the returned (path, size) list is passed to add_files()
+    # in the main process
+
+    try:
+        st = os.stat(full_path)
+        image = Image.open(full_path)
+        image.draft(None, (_SIZES[-1], _SIZES[-1]))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+    except Exception as e:
+        logging.error('failed to open picture %(path)s: %(msg)s' % {'path': full_path, 'msg': unicode(e)})
+        return []
+
+    key = _get_key(full_path, st)
+    files = []
+    for level in reversed(_SIZES):
+        image.thumbnail((level, level), Image.ANTIALIAS)
+
+        path = _get_path(key, level)
+        try:
+            dir_path = os.path.dirname(path)
+            if not os.path.exists(dir_path):
+                os.makedirs(dir_path)
+
+            # written under a temporary name first, so that a thumbnail is never read while incomplete
+            temp_path = path + '.tmp'
+            image.save(temp_path, format='JPEG', quality=_QUALITY)
+            os.rename(temp_path, path)
+            files.append((path, os.path.getsize(path)))
+
+        except (IOError, OSError) as e:
+            logging.error('failed to write thumbnail %(path)s: %(msg)s' % {'path': path, 'msg': unicode(e)})
+            break
+
+    logging.debug('created %(count)s thumbnails of %(path)s' % {'count': len(files), 'path': full_path})
+
+    return files
+
+
+def add_files(files):
+    global _total_size
+
+    for (path, size) in files:
+        _total_size -= _entries.pop(path, 0)
+        _entries[path] = size
+        _total_size += size
+
+    _evict()
+
+
+def _get_key(full_path, st):
+    # thumbnails are addressed by the identity of the picture contents, not only by its path
+    return hashlib.sha1('%s:%s:%s' % (os.path.abspath(full_path), st.st_size, st.st_mtime)).hexdigest()
+
+
+def _get_path(key, level):
+    return os.path.join(get_cache_dir(), key[:2], '%s-%s.jpg' % (key, level))
+
+
+def _touch(path):
+    # the modification time records the last use, so that the LRU order survives restarts
+    _entries[path] = _entries.pop(path)
+    try:
+        os.utime(path, None)
+
+    except OSError:
+        pass
+
+
+def _evict():
+    global _total_size
+
+    limit = settings.THUMBNAIL_CACHE_SIZE * 1024 * 1024
+    while _total_size > limit and _entries:
+        (path, size) = _entries.popitem(last=False)
+        _total_size -= size
+
+        try:
+            os.remove(path)
+
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logging.error('failed to remove thumbnail %(path)s: %(msg)s' % {'path': path, 'msg': unicode(e)})
+
+
+def _collect_metrics():
+    return [
+        ('thumbnail_cache_bytes', {}, _total_size),
+        ('thumbnail_cache_files', {}, len(_entries))
+    ]
+
+
+metrics.add_collector(_collect_metrics)
@@ -25,16 +25,20 @@ import urllib
 import urllib2
 import pycurl
 
+import metrics
 import settings
+import tasks
 import utils
 
 
 _STATE_FILE_NAME = 'uploadservices.json'
 _services = None
+_services_mtime = None
 
 
 class UploadService(object):
     MAX_FILE_SIZE = 1024 * 1024 * 1024  # 1GB
+    CHUNK_SIZE = 8 * 1024 * 1024  # 8MB, the largest part of a file kept in memory while uploading
 
     NAME = 'base'
 
@@ -82,26 +86,56 @@ class UploadService(object):
             raise Exception(msg)
 
         try:
-            f = open(filename)
+            f = open(filename, 'rb')
 
         except Exception as e:
             msg = 'failed to open file "%s": %s' % (filename, e)
             self.error(msg)
             raise Exception(msg)
 
-        data = f.read()
-        self.debug('size of "%s" is %.3fMB' % (filename, len(data) / 1024.0 / 1024))
+        self.debug('size of "%s" is %.3fMB' % (filename, st.st_size / 1024.0 / 1024))
 
         mime_type = mimetypes.guess_type(filename)[0] or 'image/jpeg'
         self.debug('mime type of "%s" is "%s"' % (filename, mime_type))
 
-        self.upload_data(rel_filename, mime_type, data)
+        try:
+            self.upload_stream(rel_filename, mime_type, f, st.st_size)
+
+        finally:
+            f.close()
 
         self.debug('file "%s" successfully uploaded' % filename)
 
-    def upload_data(self, filename, mime_type, data):
+        return st.st_size
+
+    def upload_files(self, target_dir, filenames):
+        # uploads several files in one go, reusing the connection to the service;
+        # returns the number of files that failed to upload and the number of bytes uploaded
+
+        failed = 0
+        size = 0
+        for filename in filenames:
+            try:
+                size += self.upload_file(target_dir, filename) or 0
+
+            except Exception as e:
+                self.error('failed to upload file "%s": %s' % (filename, e), exc_info=True)
+                failed += 1
+
+        return failed, size
+
+    def close(self):
+        # releases any connection kept open to the service
         pass
 
+    def upload_stream(self, filename, mime_type, f, size):
+        # the single upload entry point, implemented by every service;
+        # f is a file-like object holding size bytes, read by the services at most CHUNK_SIZE at a time
+        raise NotImplementedError()
+
+    def upload_data(self, filename, mime_type, data):
+        self.upload_stream(filename, mime_type, StringIO.StringIO(data), len(data))
+
     def dump(self):
         return {}
 
@@ -146,10 +180,10 @@ class GoogleDrive(UploadService):
     SCOPE = 'https://www.googleapis.com/auth/drive'
     CHILDREN_URL = 'https://www.googleapis.com/drive/v2/files/%(parent_id)s/children?q=%(query)s'
     CHILDREN_QUERY = "'%(parent_id)s' in parents and title = '%(child_name)s' and trashed = false"
-    UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v2/files?uploadType=multipart'
+    UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v2/files?uploadType=resumable'
     CREATE_FOLDER_URL = 'https://www.googleapis.com/drive/v2/files'
 
-    BOUNDARY = 'motioneye_multipart_boundary'
+    CHUNK_RETRIES = 3
 
     FOLDER_ID_LIFE_TIME = 300  # 5 minutes
 
@@ -183,7 +217,7 @@ class GoogleDrive(UploadService):
         except Exception as e:
             return str(e)
 
-    def upload_data(self, filename, mime_type, data):
+    def upload_stream(self, filename, mime_type, f, size):
         path = os.path.dirname(filename)
         filename = os.path.basename(filename)
 
@@ -192,26 +226,58 @@ class GoogleDrive(UploadService):
             'parents': [{'id': self._get_folder_id(path)}]
         }
 
-        body = ['--' + self.BOUNDARY]
-        body.append('Content-Type: application/json; charset=UTF-8')
-        body.append('')
-        body.append(json.dumps(metadata))
-        body.append('')
-
-        body.append('--' + self.BOUNDARY)
-        body.append('Content-Type: %s' % mime_type)
-        body.append('')
-        body.append('')
-        body = '\r\n'.join(body)
-        body += data
-        body += '\r\n--%s--' % self.BOUNDARY
-
         headers = {
-            'Content-Type': 'multipart/related; boundary="%s"' % self.BOUNDARY,
-            'Content-Length': len(body)
+            'Content-Type': 'application/json; charset=UTF-8',
+            'X-Upload-Content-Type': mime_type,
+            'X-Upload-Content-Length': size
         }
 
-        self._request(self.UPLOAD_URL, body, headers)
+        # start a resumable upload session; the session uri is returned in the location header
+        response = self._request(self.UPLOAD_URL, json.dumps(metadata), headers, raw=True)
+        session_url = response.info().get('Location')
+        if not session_url:
+            msg = 'no upload session url received'
+            self.error(msg)
+            raise Exception(msg)
+
+        offset = 0
+        retries = 0
+        while True:
+            f.seek(offset)
+            chunk = f.read(self.CHUNK_SIZE)
+            end = offset + len(chunk)
+
+            headers = {'Content-Type': mime_type}
+            if chunk:
+                headers['Content-Range'] = 'bytes %s-%s/%s' % (offset, end - 1, size)
+
+            else:  # empty file
+                headers['Content-Range'] = 'bytes */%s' % size
+
+            self.debug('uploading bytes %s-%s/%s of "%s"' % (offset, end, size, filename))
+
+            try:
+                response = self._request(session_url, chunk, headers, method='PUT', raw=True)
+
+            except Exception:
+                retries += 1
+                if retries > self.CHUNK_RETRIES:
+                    raise
+
+                # ask the server how much it actually received and continue from there
+                self.debug('chunk upload failed, querying upload status (retry %s/%s)' % (retries, self.CHUNK_RETRIES))
+                response = self._request(session_url, '', {'Content-Range': 'bytes */%s' % size},
+                                         method='PUT', raw=True)
+
+            else:
+                retries = 0
+
+            if response.code != 308:  # upload complete
+                break
+
+            # the range header holds the bytes received so far, e.g. "bytes=0-1048575"
+            received = response.info().get('Range')
+            offset = int(received.split('-')[-1]) + 1 if received else 0
 
     def dump(self):
         return {
@@ -316,7 +382,10 @@ class GoogleDrive(UploadService):
 
         self._request(self.CREATE_FOLDER_URL, body, headers)
 
-    def _request(self, url, body=None, headers=None, retry_auth=True):
+    def _request(self, url, body=None, headers=None, retry_auth=True, method=None, raw=False):
+        # when raw is True, the response object is returned instead of the response body
+        # (an "incomplete" 308 response of a resumable upload is returned as well)
+
         if not self._credentials:
             if not self._authorization_key:
                 msg = 'missing authorization key'
@@ -337,10 +406,16 @@ class GoogleDrive(UploadService):
 
         self.debug('requesting %s' % url)
         request = urllib2.Request(url, data=body, headers=headers)
+        if method:
+            request.get_method = lambda: method
+
         try:
             response = utils.urlopen(request)
 
         except urllib2.HTTPError as e:
+            if e.code == 308 and raw:
+                return e
+
             if e.code == 401 and retry_auth:  # unauthorized, access token may have expired
                 try:
                     self.debug('credentials have probably expired, refreshing them')
@@ -348,7 +423,7 @@ class GoogleDrive(UploadService):
                     self.save()
 
                     # retry the request with refreshed credentials
-                    return self._request(url, body, headers, retry_auth=False)
+                    return self._request(url, body, headers, retry_auth=False, method=method, raw=raw)
 
                 except Exception:
                     self.error('refreshing credentials failed')
@@ -369,6 +444,9 @@ class GoogleDrive(UploadService):
             self.error('request failed: %s' % e)
             raise
 
+        if raw:
+            return response
+
         return response.read()
 
     def _request_credentials(self, authorization_key):
@@ -443,6 +521,9 @@ class Dropbox(UploadService):
 
     LIST_FOLDER_URL = 'https://api.dropboxapi.com/2/files/list_folder'
     UPLOAD_URL = 'https://content.dropboxapi.com/2/files/upload'
+    UPLOAD_SESSION_START_URL = 'https://content.dropboxapi.com/2/files/upload_session/start'
+    UPLOAD_SESSION_APPEND_URL = 'https://content.dropboxapi.com/2/files/upload_session/append_v2'
+    UPLOAD_SESSION_FINISH_URL = 'https://content.dropboxapi.com/2/files/upload_session/finish'
 
     def __init__(self, camera_id):
         self._location = None
@@ -484,20 +565,42 @@ class Dropbox(UploadService):
 
             return msg
 
-    def upload_data(self, filename, mime_type, data):
-        metadata = {
+    def upload_stream(self, filename, mime_type, f, size):
+        commit = {
             'path': os.path.join(self._clean_location(), filename),
             'mode': 'add',
             'autorename': True,
             'mute': False
         }
 
-        headers = {
-            'Content-Type': 'application/octet-stream',
-            'Dropbox-API-Arg': json.dumps(metadata)
+        chunk = f.read(self.CHUNK_SIZE)
+        if len(chunk) >= size:  # small file, upload it with a single request
+            self._request(self.UPLOAD_URL, chunk, self._make_upload_headers(commit))
+
+            return
+
+        # larger files are sent in chunks, using an upload session
+        response = self._request(self.UPLOAD_SESSION_START_URL, chunk, self._make_upload_headers({'close': False}))
+        cursor = {
+            'session_id': json.loads(response)['session_id'],
+            'offset': len(chunk)
         }
 
-        self._request(self.UPLOAD_URL, data, headers)
+        while True:
+            chunk = f.read(self.CHUNK_SIZE)
+            if cursor['offset'] + len(chunk) >= size or not chunk:
+                break
+
+            self.debug('uploading bytes %s-%s/%s of "%s"' % (cursor['offset'], cursor['offset'] + len(chunk),
+                                                             size, filename))
+
+            self._request(self.UPLOAD_SESSION_APPEND_URL, chunk,
+                          self._make_upload_headers({'cursor': cursor, 'close': False}))
+            cursor['offset'] += len(chunk)
+
+        # the last chunk is sent along with the commit request
+        self._request(self.UPLOAD_SESSION_FINISH_URL, chunk,
+                      self._make_upload_headers({'cursor': cursor, 'commit': commit}))
 
     def dump(self):
         return {
@@ -515,6 +618,12 @@ class Dropbox(UploadService):
         if data.get('credentials'):
             self._credentials = data['credentials']
 
+    def _make_upload_headers(self, arg):
+        return {
+            'Content-Type': 'application/octet-stream',
+            'Dropbox-API-Arg': json.dumps(arg)
+        }
+
     def _clean_location(self):
         location = self._location
         if location == '/':
@@ -609,7 +718,7 @@ class Dropbox(UploadService):
 
 class FTP(UploadService):
     NAME = 'ftp'
-    CONN_LIFE_TIME = 60  # don't keep an FTP connection for more than 1 minute
+    CONN_IDLE_TIME = 30  # an FTP connection idle for longer than this is checked before being reused
 
     def __init__(self, camera_id):
         self._server = None
@@ -620,11 +729,13 @@ class FTP(UploadService):
 
         self._conn = None
         self._conn_time = 0
+        self._dirs = set()  # remote directories known to exist
 
         UploadService.__init__(self, camera_id)
 
     def test_access(self):
         try:
+            self._dirs = set()
             conn = self._get_conn(create=True)
 
             path = self._make_dirs(self._location, conn=conn)
@@ -642,19 +753,44 @@ class FTP(UploadService):
 
             return str(e)
 
-    def upload_data(self, filename, mime_type, data):
+    def upload_stream(self, filename, mime_type, f, size):
         path = os.path.dirname(filename)
         filename = os.path.basename(filename)
 
-        conn = self._get_conn()
-        path = self._make_dirs(self._location + '/' + path, conn=conn)
-        conn.cwd(path)
+        try:
+            conn = self._get_conn()
+            path = self._make_dirs(self._location + '/' + path, conn=conn)
+
+        except ftplib.all_errors as e:
+            # the server may have dropped the connection between our checks, try once more
+            self.debug('ftp connection failed (%s), reconnecting' % e)
+            conn = self._get_conn(create=True)
+            path = self._make_dirs(self._location + '/' + path, conn=conn)
+
+        self.debug('uploading %s of %s bytes' % (filename, size))
+        try:
+            conn.storbinary('STOR %s' % filename, f, blocksize=64 * 1024)
 
-        self.debug('uploading %s of %s bytes' % (filename, len(data)))
-        conn.storbinary('STOR %s' % filename, StringIO.StringIO(data))
+        except ftplib.all_errors:
+            self.close()
+            raise
+
+        self._conn_time = time.time()
 
         self.debug('upload done')
 
+    def close(self):
+        if self._conn is None:
+            return
+
+        try:
+            self._conn.quit()
+
+        except ftplib.all_errors:
+            self._conn.close()
+
+        self._conn = None
+
     def dump(self):
         return {
             'server': self._server,
@@ -665,6 +801,10 @@ class FTP(UploadService):
         }
 
     def load(self, data):
+        # the connection and the known directories may not be valid for the new settings
+        self.close()
+        self._dirs = set()
+
         if data.get('server') is not None:
             self._server = data['server']
         if data.get('port') is not None:
@@ -678,7 +818,19 @@ class FTP(UploadService):
 
     def _get_conn(self, create=False):
         now = time.time()
-        if self._conn is None or now - self._conn_time > self.CONN_LIFE_TIME or create:
+        if self._conn is not None and not create and now - self._conn_time > self.CONN_IDLE_TIME:
+            # keepalive: make sure the idle connection is still usable
+            try:
+                self._conn.voidcmd('NOOP')
+                self._conn_time = now
+
+            except ftplib.all_errors as e:
+                self.debug('idle connection to %s is no longer usable: %s' % (self._server, e))
+                self.close()
+
+        if self._conn is None or create:
+            self.close()
+
             self.debug('creating connection to %s@%s:%s' % (self._username or 'anonymous', self._server, self._port))
             self._conn = ftplib.FTP()
             self._conn.set_pasv(True)
@@ -693,8 +845,17 @@ class FTP(UploadService):
 
         path = path.split('/')
         path = [p for p in path if p]
+        full_path = '/' + '/'.join(path)
+
+        if full_path in self._dirs:
+            try:
+                conn.cwd(full_path)
+                return full_path
 
-        self.debug('ensuring path /%s' % '/'.join(path))
+            except ftplib.error_perm:  # removed meanwhile on the remote side
+                self._dirs.discard(full_path)
+
+        self.debug('ensuring path %s' % full_path)
 
         conn.cwd('/')
         for p in path:
@@ -704,7 +865,9 @@ class FTP(UploadService):
 
             conn.cwd(p)
 
-        return '/' + '/'.join(path)
+        self._dirs.add(full_path)
+
+        return full_path
 
 
 class SFTP(UploadService):
@@ -717,9 +880,14 @@ class SFTP(UploadService):
         self._password = None
         self._location = None
 
+        self._conn = None
+
         UploadService.__init__(self, camera_id)
 
-    def curl_perform_filetransfer(self, conn):
+    def curl_perform_filetransfer(self, conn, keep=False):
+        # when keep is True, the curl handle (and its ssh connection)
+        # is left open to be reused for the next transfer, unless the transfer fails
+
         curl_url = conn.getinfo(pycurl.EFFECTIVE_URL)
 
         try:
@@ -729,13 +897,17 @@ class SFTP(UploadService):
             curl_error = conn.errstr()
             msg = 'cURL upload failed on {}: {}'.format(curl_url, curl_error)
             self.error(msg)
+            keep = False
             raise
 
         else:
             self.debug('upload done: {}'.format(curl_url))
 
         finally:
-            conn.close()
+            if not keep:
+                conn.close()
+                if conn is self._conn:
+                    self._conn = None
 
     def test_access(self):
         filename = time.time()
@@ -746,7 +918,7 @@ class SFTP(UploadService):
         rm_operations = ['RM {}/{}'.format(self._location, test_file),
                          'RMDIR {}/{}'.format(self._location, test_folder)]
 
-        conn = self._get_conn(test_file)
+        conn = self._get_conn(test_file, reuse=False)
         conn.setopt(conn.POSTQUOTE, rm_operations)  # Executed after transfer.
         conn.setopt(pycurl.READFUNCTION, StringIO.StringIO().read)
 
@@ -759,11 +931,17 @@ class SFTP(UploadService):
 
             return str(e)
 
-    def upload_data(self, filename, mime_type, data):
+    def upload_stream(self, filename, mime_type, f, size):
         conn = self._get_conn(filename)
-        conn.setopt(pycurl.READFUNCTION, StringIO.StringIO(data).read)
+        conn.setopt(pycurl.READFUNCTION, f.read)
+        conn.setopt(pycurl.INFILESIZE_LARGE, size)
+
+        self.curl_perform_filetransfer(conn, keep=True)
 
-        self.curl_perform_filetransfer(conn)
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
 
     def dump(self):
         return {
@@ -775,6 +953,8 @@ class SFTP(UploadService):
         }
 
     def load(self, data):
+        self.close()
+
         if data.get('server') is not None:
             self._server = data['server']
         if data.get('port') is not None:
@@ -786,37 +966,48 @@ class SFTP(UploadService):
         if data.get('location'):
             self._location = data['location']
 
-    def _get_conn(self, filename, auth_type='password'):
+    def _get_conn(self, filename, auth_type='password', reuse=True):
+        # the same curl handle is reused for consecutive uploads,
+        # so that libcurl can keep the ssh connection alive between them
+
         sftp_url = 'sftp://{}:{}/{}/{}'.format(self._server, self._port,
                                                self._location, filename)
 
+        if reuse and self._conn is not None:
+            self._conn.setopt(self._conn.URL, sftp_url)
+
+            return self._conn
+
         self.debug('creating sftp connection to {}@{}:{}'.format(
                 self._username, self._server, self._port))
 
-        self._conn = pycurl.Curl()
-        self._conn.setopt(self._conn.URL, sftp_url)
-        self._conn.setopt(self._conn.FTP_CREATE_MISSING_DIRS, 2)  # retry once if MKD fails
+        conn = pycurl.Curl()
+        conn.setopt(conn.URL, sftp_url)
+        conn.setopt(conn.FTP_CREATE_MISSING_DIRS, 2)  # retry once if MKD fails
 
         auth_types = {
-            'password': self._conn.SSH_AUTH_PASSWORD,
-            # 'private_key': self._conn.SSH_PRIVATE_KEYFILE
+            'password': conn.SSH_AUTH_PASSWORD,
+            # 'private_key': conn.SSH_PRIVATE_KEYFILE
             # ref: https://curl.haxx.se/libcurl/c/CURLOPT_SSH_PRIVATE_KEYFILE.html
         }
 
         try:
-            self._conn.setopt(self._conn.SSH_AUTH_TYPES, auth_types[auth_type])
+            conn.setopt(conn.SSH_AUTH_TYPES, auth_types[auth_type])
 
         except KeyError:
             self.error("invalid SSH auth type: {}".format(auth_type))
             raise
 
         if auth_type == 'password':
-            self._conn.setopt(self._conn.USERNAME, self._username)
-            self._conn.setopt(self._conn.PASSWORD, self._password)
+            conn.setopt(conn.USERNAME, self._username)
+            conn.setopt(conn.PASSWORD, self._password)
 
-        self._conn.setopt(self._conn.UPLOAD, 1)
+        conn.setopt(conn.UPLOAD, 1)
 
-        return self._conn
+        if reuse:
+            self._conn = conn
+
+        return conn
 
 
 def get_authorize_url(service_name):
@@ -831,9 +1022,28 @@ def get_authorize_url(service_name):
 
 def get(camera_id, service_name):
     global _services
+    global _services_mtime
+
+    # the state file may have been changed by another task process
+    mtime = _get_state_file_mtime()
+    if _services is None or mtime != _services_mtime:
+        services = _load()
+        if _services is not None:
+            # keep the existing services (and their open connections) whose state has not changed
+            for cid, camera_services in services.iteritems():
+                for name, service in camera_services.items():
+                    old_service = _services.get(cid, {}).get(name)
+                    if old_service is None:
+                        continue
+
+                    if old_service.dump() == service.dump():
+                        camera_services[name] = old_service
+
+                    else:
+                        old_service.close()
 
-    if _services is None:
-        _services = _load()
+        _services = services
+        _services_mtime = mtime
 
     camera_id = str(camera_id)
 
@@ -871,11 +1081,53 @@ def upload_media_file(camera_id, target_dir, service_name, filename):
     if not service:
         return logging.error('service "%s" not initialized for camera with id %s' % (service_name, camera_id))
 
+    started = time.time()
+    failed, size = 0, 0
     try:
-        service.upload_file(target_dir, filename)
+        size = service.upload_file(target_dir, filename) or 0
 
     except Exception as e:
         logging.error('failed to upload file "%s" with service %s: %s' % (filename, service, e), exc_info=True)
+        failed = 1
+
+    return {'service': service_name, 'files': 1, 'failed': failed, 'bytes': size,
+            'duration': time.time() - started}
+
+
+def upload_media_files(camera_id, target_dir, service_name, filenames):
+    service = get(camera_id, service_name)
+    if not service:
+        return logging.error('service "%s" not initialized for camera with id %s' % (service_name, camera_id))
+
+    logging.debug('uploading %s files with service %s' % (len(filenames), service))
+
+    started = time.time()
+    failed, size = service.upload_files(target_dir, filenames)
+    if failed:
+        logging.error('failed to upload %s out of %s files with service %s' % (failed, len(filenames), service))
+
+    return {'service': service_name, 'files': len(filenames), 'failed': failed, 'bytes': size,
+            'duration': time.time() - started}
+
+
+def _record_upload_metrics(result):
+    # called in the main process with the results of the upload tasks
+    if not result:
+        return
+
+    service = result['service']
+    metrics.observe('upload_seconds', result['duration'], service=service)
+    metrics.inc('upload_files_total', result['files'] - result['failed'], service=service)
+    metrics.inc('upload_failures_total', result['failed'], service=service)
+    metrics.inc('upload_bytes_total', result['bytes'], service=service)
+
+
+def _get_state_file_mtime():
+    try:
+        return os.path.getmtime(os.path.join(settings.CONF_PATH, _STATE_FILE_NAME))
+
+    except OSError:
+        return None
 
 
 def _load():
@@ -946,3 +1198,7 @@ def _save(services):
 
     finally:
         f.close()
+
+
+tasks.add_result_handler(upload_media_file, _record_upload_metrics)
+tasks.add_result_handler(upload_media_files, _record_upload_metrics)
@@ -0,0 +1,158 @@
+
+# Copyright (c) 2013 Calin Crisan
+# This file is part of motionEye.
+#
+# motionEye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import logging
+import os.path
+import sys
+import threading
+import time
+import traceback
+
+from tornado.ioloop import IOLoop
+
+import metrics
+import settings
+
+
+_STACK_LIMIT = 20  # maximum number of frames kept in a stack sample
+
+_interval = None  # seconds between two heartbeats
+_last_beat = 0  # the time of the last heartbeat of the IO loop
+_main_thread_id = None  # the id of the thread running the IO loop
+_blocked = None  # the stall currently being measured, as a dict
+_lock = threading.Lock()
+_callsites = {}  # aggregate blocking stats, indexed by call site
+
+
+def start():
+    # the IO loop regularly updates a heartbeat timestamp; a separate thread takes a stack sample
+    # of the IO loop thread as soon as the heartbeat is late by more than the threshold,
+    # and the stall is measured when the loop gets to run the next heartbeat
+
+    global _interval
+    global _main_thread_id
+    global _last_beat
+
+    _interval = settings.IOLOOP_BLOCKING_THRESHOLD / 2.0
+    _main_thread_id = threading.current_thread().ident
+    _last_beat = time.time()
+
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=_interval), _beat)
+
+    thread = threading.Thread(target=_watch, name='watchdog')
+    thread.daemon = True
+    thread.start()
+
+
+def get_stats():
+    callsites = []
+    for (callsite, stats) in _callsites.iteritems():
+        stats = dict(stats, callsite=callsite)
+        stats['avg_time'] = stats['total_time'] / stats['count']
+        callsites.append(stats)
+
+    callsites.sort(key=lambda s: s['total_time'], reverse=True)
+
+    return {
+        'threshold': settings.IOLOOP_BLOCKING_THRESHOLD,
+        'blocked': sum(s['count'] for s in callsites),
+        'callsites': callsites
+    }
+
+
+def _beat():
+    global _last_beat
+    global _blocked
+
+    now = time.time()
+    with _lock:
+        blocked, _blocked = _blocked, None
+        _last_beat = now
+
+    io_loop = IOLoop.instance()
+    io_loop.add_timeout(datetime.timedelta(seconds=_interval), _beat)
+
+    if blocked is None:
+        return
+
+    duration = now - blocked['start']
+    callsite = blocked['callsite']
+
+    logging.warning('IO loop blocked for %(duration).3f seconds in %(callsite)s:\n%(stack)s' % {
+            'duration': duration, 'callsite': callsite, 'stack': blocked['stack']})
+
+    stats = _callsites.get(callsite)
+    if stats is None:
+        stats = _callsites[callsite] = {
+            'count': 0,
+            'total_time': 0,
+            'max_time': 0
+        }
+
+    stats['count'] += 1
+    stats['total_time'] += duration
+    stats['max_time'] = max(stats['max_time'], duration)
+    stats['last_time'] = duration
+    stats['last_stack'] = blocked['stack']
+
+    metrics.observe('ioloop_blocked_seconds', duration, callsite=callsite)
+
+
+def _watch():
+    global _blocked
+
+    while True:
+        time.sleep(_interval / 2.0)
+
+        with _lock:
+            if _blocked is not None:
+                continue  # already sampled
+
+            # the heartbeat was due at _last_beat + _interval
+            due = _last_beat + _interval
+            if time.time() - due < settings.IOLOOP_BLOCKING_THRESHOLD:
+                continue
+
+            frame = sys._current_frames().get(_main_thread_id)
+            if frame is None:
+                continue
+
+            stack = traceback.extract_stack(frame, _STACK_LIMIT)
+            del frame
+
+            _blocked = {
+                'start': due,
+                'callsite': _get_callsite(stack),
+                'stack': ''.join(traceback.format_list(stack))
+            }
+
+
+def _get_callsite(stack):
+    # the innermost motionEye frame is considered responsible for the stall
+    # (blocking calls usually end up in the standard library)
+
+    for (filename, lineno, name, line) in reversed(stack):  # @UnusedVariable
+        if os.path.dirname(os.path.abspath(filename)) == settings.PROJECT_PATH:
+            return '%s:%s:%s' % (os.path.basename(filename), name, lineno)
+
+    if stack:
+        (filename, lineno, name, line) = stack[-1]  # @UnusedVariable
+        return '%s:%s:%s' % (os.path.basename(filename), name, lineno)
+
+    return 'unknown'
@@ -0,0 +1,78 @@
+
+import random
+import unittest
+
+from mjpgclient import MjpgParser
+
+
+_BOUNDARY = 'BoundaryString'
+
+
+def _make_stream(frames, content_length):
+    parts = []
+    for frame in frames:
+        headers = '--%s\r\nContent-Type: image/jpeg\r\n' % _BOUNDARY
+        if content_length:
+            headers += 'Content-Length: %s\r\n' % len(frame)
+
+        parts.append(headers + '\r\n' + frame + '\r\n')
+
+    # without a content length, a frame is only complete once the next boundary is seen
+    return ''.join(parts) + '--%s\r\n' % _BOUNDARY
+
+
+def _feed(parser, data, rand, max_chunk):
+    frames = []
+    offset = 0
+    while offset < len(data):
+        size = rand.randint(1, max_chunk)
+        frames += parser.feed(data[offset:offset + size])
+        offset += size
+
+    return frames
+
+
+class MjpgParserTest(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(1234)
+
+        # payloads that contain header terminators and dashes, like the ones of real jpegs may
+        self.frames = [self.random_bytes(1, 5000) + '\r\n\r\n--x' + self.random_bytes(0, 100)
+                       for i in xrange(50)]  # @UnusedVariable
+
+    def random_bytes(self, min_size, max_size):
+        return ''.join(chr(self.rand.randint(0, 255)) for i in xrange(self.rand.randint(min_size, max_size)))
+
+    def check(self, content_length, boundary, max_chunk):
+        data = _make_stream(self.frames, content_length)
+        frames = _feed(MjpgParser(boundary), data, self.rand, max_chunk)
+
+        self.assertEqual(len(frames), len(self.frames))
+        self.assertEqual(frames, self.frames)
+
+    def test_content_length(self):
+        for max_chunk in (1, 7, 1000, 70000):
+            self.check(content_length=True, boundary=_BOUNDARY, max_chunk=max_chunk)
+
+    def test_no_content_length(self):
+        for max_chunk in (1, 7, 1000, 70000):
+            self.check(content_length=False, boundary=_BOUNDARY, max_chunk=max_chunk)
+
+    def test_boundary_from_stream(self):
+        # the boundary is taken from the first part when the http headers lack it
+        for content_length in (True, False):
+            self.check(content_length=content_length, boundary=None, max_chunk=5000)
+
+    def test_whole_stream_at_once(self):
+        for content_length in (True, False):
+            self.check(content_length=content_length, boundary=_BOUNDARY, max_chunk=10 * 1024 * 1024)
+
+    def test_no_delimiter(self):
+        parser = MjpgParser()
+        self.assertRaises(Exception, parser.feed, 'Content-Type: image/jpeg\r\n\r\ndata')
+
+    def test_frame_too_large(self):
+        parser = MjpgParser(_BOUNDARY)
+        parser._MAX_BUFFER_SIZE = 1000
+        parser.feed('--%s\r\nContent-Type: image/jpeg\r\n\r\n' % _BOUNDARY)
+        self.assertRaises(Exception, parser.feed, 'x' * 2000)
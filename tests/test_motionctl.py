@@ -0,0 +1,176 @@
+
+import datetime
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncTestCase
+
+import config
+import motionctl
+import settings
+
+
+# a motion stand-in that opens its control port after a delay and optionally ignores the TERM signal
+_FAKE_MOTION = '''#!%(python)s
+import BaseHTTPServer
+import os
+import signal
+import sys
+import time
+
+if '-h' in sys.argv:
+    print 'motion Version 4.1.1, Copyright 2000-2017'
+    sys.exit(0)
+
+if os.environ.get('FAKE_MOTION_IGNORE_TERM'):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+time.sleep(float(os.environ.get('FAKE_MOTION_DELAY', 0)))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('ok')
+
+
+BaseHTTPServer.HTTPServer(('127.0.0.1', int(os.environ['FAKE_MOTION_PORT'])), Handler).serve_forever()
+'''
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    return port
+
+
+class MotionCtlTest(AsyncTestCase):
+    def get_new_ioloop(self):
+        return IOLoop.instance()  # motionctl schedules its polls on the global IO loop
+
+    def setUp(self):
+        super(MotionCtlTest, self).setUp()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_settings = dict((n, getattr(settings, n)) for n in (
+                'CONF_PATH', 'LOG_PATH', 'RUN_PATH', 'MOTION_BINARY', 'MOTION_CONTROL_PORT',
+                'FRAME_BUFFER_DURATION', 'MJPG_CLIENT_IDLE_TIMEOUT'))
+        self.saved_config = config.get_enabled_local_motion_cameras, config.get_camera_ids
+        self.saved_stop_timeout = motionctl._MOTION_STOP_TIMEOUT
+
+        binary = os.path.join(self.tmp_dir, 'motion')
+        with open(binary, 'w') as f:
+            f.write(_FAKE_MOTION % {'python': sys.executable})
+
+        os.chmod(binary, 0755)
+
+        settings.CONF_PATH = settings.LOG_PATH = settings.RUN_PATH = self.tmp_dir
+        settings.MOTION_BINARY = binary
+        settings.MOTION_CONTROL_PORT = _free_port()
+        settings.FRAME_BUFFER_DURATION = 0
+        settings.MJPG_CLIENT_IDLE_TIMEOUT = 10
+        config.get_enabled_local_motion_cameras = lambda: [{'@id': 1}]
+        config.get_camera_ids = lambda: []
+        motionctl._motion_binary_cache = None
+
+        os.environ['FAKE_MOTION_PORT'] = str(settings.MOTION_CONTROL_PORT)
+        os.environ['FAKE_MOTION_DELAY'] = '1'
+        os.environ.pop('FAKE_MOTION_IGNORE_TERM', None)
+
+        # the largest interval between two consecutive runs of a periodic callback
+        self.max_gap = 0
+        self.last_tick = time.time()
+        self.tick()
+
+    def tearDown(self):
+        self.io_loop.remove_timeout(self.tick_timeout)
+        motionctl.stop(wait=True)
+
+        for name, value in self.saved_settings.items():
+            setattr(settings, name, value)
+
+        config.get_enabled_local_motion_cameras, config.get_camera_ids = self.saved_config
+        motionctl._MOTION_STOP_TIMEOUT = self.saved_stop_timeout
+        motionctl._motion_binary_cache = None
+
+        shutil.rmtree(self.tmp_dir)
+
+        super(MotionCtlTest, self).tearDown()
+
+    def tick(self):
+        now = time.time()
+        self.max_gap = max(self.max_gap, now - self.last_tick)
+        self.last_tick = now
+        self.tick_timeout = self.io_loop.add_timeout(datetime.timedelta(seconds=0.05), self.tick)
+
+    def wait_until(self, condition, timeout=15):
+        def check():
+            if condition():
+                self.stop()
+
+            else:
+                self.io_loop.add_timeout(datetime.timedelta(seconds=0.05), check)
+
+        check()
+        self.wait(timeout=timeout)
+
+    def test_start_does_not_block(self):
+        started = time.time()
+        motionctl.start()
+        self.assertLess(time.time() - started, 0.5)
+        self.assertIsNotNone(motionctl._starting_process)
+
+        self.wait_until(lambda: motionctl._starting_process is None)
+
+        self.assertTrue(motionctl.running())
+        self.assertGreaterEqual(time.time() - started, 1)
+        self.assertLess(self.max_gap, 0.5)
+
+    def test_stop_does_not_block(self):
+        os.environ['FAKE_MOTION_DELAY'] = '0'
+        os.environ['FAKE_MOTION_IGNORE_TERM'] = '1'
+        motionctl._MOTION_STOP_TIMEOUT = 1
+
+        motionctl.start()
+        self.wait_until(lambda: motionctl._starting_process is None)
+        self.max_gap = 0
+
+        stopped = []
+        started = time.time()
+        motionctl.stop(callback=lambda: stopped.append(time.time()))
+        self.assertLess(time.time() - started, 0.5)
+        self.assertTrue(motionctl.running())
+
+        self.wait_until(lambda: stopped)
+
+        # the TERM signal is ignored, so motion is killed once the stop timeout has elapsed
+        self.assertGreaterEqual(stopped[0] - started, 1)
+        self.assertFalse(motionctl.running())
+        self.assertLess(self.max_gap, 0.5)
+
+    def test_start_waits_for_stop(self):
+        os.environ['FAKE_MOTION_DELAY'] = '0'
+        os.environ['FAKE_MOTION_IGNORE_TERM'] = '1'
+        motionctl._MOTION_STOP_TIMEOUT = 1
+
+        motionctl.start()
+        self.wait_until(lambda: motionctl._starting_process is None)
+        old_pid = motionctl._get_pid()
+
+        motionctl.stop()
+        motionctl.start()
+        self.assertTrue(motionctl._start_pending)
+
+        self.wait_until(lambda: motionctl._get_pid() != old_pid and motionctl._starting_process is None)
+
+        self.assertTrue(motionctl.running())
+        self.assertTrue(motionctl.started())
@@ -0,0 +1,60 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import settings
+import tasks
+
+
+def _work(x):
+    return x
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_conf_path = settings.CONF_PATH
+        settings.CONF_PATH = self.tmp_dir
+
+        self.compactions = 0
+        self.saved_compact = tasks._journal_compact
+
+        def compact():
+            self.compactions += 1
+            self.saved_compact()
+
+        tasks._journal_compact = compact
+        tasks._load()
+        self.compactions = 0
+
+    def tearDown(self):
+        tasks.stop()
+        tasks._journal_compact = self.saved_compact
+        tasks._tasks = []
+        tasks._ready = []
+        tasks._in_flight = {}
+        settings.CONF_PATH = self.saved_conf_path
+
+        shutil.rmtree(self.tmp_dir)
+
+    def test_appends_are_constant_time_with_many_pending_tasks(self):
+        # far in the future, so that the tasks stay queued
+        for i in xrange(tasks._MAX_TASKS):
+            tasks.add(3600, _work, x=i)
+
+        # keep the queue full while another 3000 tasks go through it
+        for i in xrange(3000):
+            task = tasks._tasks.pop()
+            tasks._journal_append(('done', task[2]))
+            tasks.add(3600, _work, x=i)
+
+        # 8000 records in all, each compaction leaving 1000 pending tasks in the journal
+        self.assertLessEqual(self.compactions, 3)
+
+        pending = sorted(t[2] for t in tasks._tasks)
+        tasks.stop()
+        tasks._load()
+
+        self.assertEqual(sorted(t[2] for t in tasks._tasks), pending)
@@ -0,0 +1,212 @@
+
+import BaseHTTPServer
+import json
+import threading
+import unittest
+
+import uploadservices
+
+
+class _StandInServer(BaseHTTPServer.HTTPServer):
+    # a local stand-in for the upload endpoints of the services, recording the requests it receives
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _StandInHandler)
+
+        self.url = 'http://127.0.0.1:%s' % self.server_address[1]
+        self.requests = []
+        self.data = ''
+        self.max_chunk_accepted = None  # only this many bytes of each drive chunk are kept, when set
+        self.failures = 0  # number of drive chunk uploads that fail with a server error
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append(('POST', self.path, dict(self.headers), body))
+
+        if self.path == '/drive/upload':
+            self.send_response(200)
+            self.send_header('Location', self.server.url + '/drive/session')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        elif self.path.startswith('/dropbox/'):
+            self.handle_dropbox(body)
+
+        else:
+            self.send_error(404)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append(('PUT', self.path, dict(self.headers), body))
+
+        content_range = self.headers['Content-Range']
+        size = int(content_range.split('/')[-1])
+
+        if body:
+            if self.server.failures:
+                self.server.failures -= 1
+                self.send_error(500)
+
+                return
+
+            start = int(content_range.split(' ')[1].split('-')[0])
+            if start != len(self.server.data):
+                self.send_error(400)
+
+                return
+
+            if self.server.max_chunk_accepted:
+                body = body[:self.server.max_chunk_accepted]
+
+            self.server.data += body
+
+        if len(self.server.data) < size:
+            self.send_response(308)
+            if self.server.data:
+                self.send_header('Range', 'bytes=0-%s' % (len(self.server.data) - 1))
+
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def handle_dropbox(self, body):
+        arg = json.loads(self.headers['Dropbox-API-Arg'])
+        cursor = arg.get('cursor')
+        if cursor and cursor['offset'] != len(self.server.data):
+            self.send_error(400)
+
+            return
+
+        self.server.data += body
+
+        response = json.dumps({'session_id': 'session'})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class UploadServiceTest(unittest.TestCase):
+    def test_upload_data_requires_upload_stream(self):
+        service = uploadservices.UploadService(1)
+        self.assertRaises(NotImplementedError, service.upload_data, 'a.jpg', 'image/jpeg', 'data')
+
+
+class GoogleDriveTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _StandInServer()
+
+        self.service = uploadservices.GoogleDrive(1)
+        self.service.UPLOAD_URL = self.server.url + '/drive/upload'
+        self.service.CHUNK_SIZE = 10
+        self.service._location = '/'
+        self.service._credentials = {'access_token': 'access', 'refresh_token': 'refresh'}
+        self.service._folder_ids[''] = 'root'
+        self.service._folder_id_times[''] = float('inf')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def puts(self):
+        return [r for r in self.server.requests if r[0] == 'PUT']
+
+    def test_upload_in_chunks(self):
+        data = ''.join(chr(i % 256) for i in xrange(35))
+        self.service.upload_data('a.jpg', 'image/jpeg', data)
+
+        self.assertEqual(self.server.data, data)
+        self.assertEqual([r[2]['content-range'] for r in self.puts()],
+                         ['bytes 0-9/35', 'bytes 10-19/35', 'bytes 20-29/35', 'bytes 30-34/35'])
+
+        start = self.server.requests[0]
+        self.assertEqual(json.loads(start[3])['title'], 'a.jpg')
+        self.assertEqual(start[2]['x-upload-content-length'], '35')
+
+    def test_upload_resumes_from_received_range(self):
+        # the server keeps only part of each chunk and reports it in the range header of the 308 response
+        self.server.max_chunk_accepted = 7
+        data = 'x' * 25
+        self.service.upload_data('a.jpg', 'image/jpeg', data)
+
+        self.assertEqual(self.server.data, data)
+        self.assertEqual([r[2]['content-range'] for r in self.puts()],
+                         ['bytes 0-9/25', 'bytes 7-16/25', 'bytes 14-23/25', 'bytes 21-24/25'])
+
+    def test_upload_queries_status_after_failure(self):
+        self.server.failures = 1
+        data = 'y' * 15
+        self.service.upload_data('a.jpg', 'image/jpeg', data)
+
+        self.assertEqual(self.server.data, data)
+        self.assertEqual([r[2]['content-range'] for r in self.puts()],
+                         ['bytes 0-9/15', 'bytes */15', 'bytes 0-9/15', 'bytes 10-14/15'])
+
+    def test_upload_gives_up_after_retries(self):
+        self.server.failures = self.service.CHUNK_RETRIES + 1
+        self.assertRaises(Exception, self.service.upload_data, 'a.jpg', 'image/jpeg', 'z' * 15)
+
+    def test_upload_empty_file(self):
+        self.service.upload_data('a.jpg', 'image/jpeg', '')
+
+        self.assertEqual([r[2]['content-range'] for r in self.puts()], ['bytes */0'])
+
+
+class DropboxTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _StandInServer()
+
+        self.service = uploadservices.Dropbox(1)
+        self.service.UPLOAD_URL = self.server.url + '/dropbox/upload'
+        self.service.UPLOAD_SESSION_START_URL = self.server.url + '/dropbox/start'
+        self.service.UPLOAD_SESSION_APPEND_URL = self.server.url + '/dropbox/append'
+        self.service.UPLOAD_SESSION_FINISH_URL = self.server.url + '/dropbox/finish'
+        self.service.CHUNK_SIZE = 10
+        self.service._location = '/camera'
+        self.service._credentials = {'access_token': 'access'}
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_small_file_single_request(self):
+        self.service.upload_data('a.jpg', 'image/jpeg', 'small')
+
+        self.assertEqual(self.server.data, 'small')
+        self.assertEqual([r[1] for r in self.server.requests], ['/dropbox/upload'])
+
+        arg = json.loads(self.server.requests[0][2]['dropbox-api-arg'])
+        self.assertEqual(arg['path'], '/camera/a.jpg')
+
+    def test_large_file_session(self):
+        data = ''.join(chr(65 + i % 26) for i in xrange(35))
+        self.service.upload_data('a.jpg', 'image/jpeg', data)
+
+        self.assertEqual(self.server.data, data)
+        self.assertEqual([r[1] for r in self.server.requests],
+                         ['/dropbox/start', '/dropbox/append', '/dropbox/append', '/dropbox/finish'])
+
+        args = [json.loads(r[2]['dropbox-api-arg']) for r in self.server.requests]
+        self.assertEqual([a['cursor']['offset'] for a in args[1:]], [10, 20, 30])
+        self.assertEqual(args[-1]['commit']['path'], '/camera/a.jpg')
+
+    def test_file_size_multiple_of_chunk_size(self):
+        data = 'z' * 20
+        self.service.upload_data('a.jpg', 'image/jpeg', data)
+
+        self.assertEqual(self.server.data, data)
+        self.assertEqual([r[1] for r in self.server.requests], ['/dropbox/start', '/dropbox/finish'])